@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# microbenchmark of the numpy sequence kernels (pb_seqkernel) against the original python implementations
+# usage: python benchmarks/bench_seqkernel.py [n_sequences] [length]
+import sys, time, random, xxhash
+from Bio import Seq
+from Bio.SeqRecord import SeqRecord
+from phylobarcode import pb_common, pb_seqkernel
+
+def old_freq_N (genome):
+    return sum([genome.upper().count(nuc) for nuc in ["N", "-"]]) / len(genome)
+
+def old_quality (sequences):
+    return [len(str(x.seq)) - sum([str(x.seq).upper().count(nuc) for nuc in ["N", "-"]]) for x in sequences]
+
+def old_kmers (seq, k):
+    return set ([xxhash.xxh64_intdigest(seq[i:i+k].encode()) for i in range(len(seq)-k + 1)])
+
+def timeit (label, func, *args, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    print (f"{label:<40} {best*1000:10.2f} ms")
+    return best, result
+
+if __name__ == '__main__':
+    n_seqs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    random.seed (42)
+    seqs = ["".join(random.choices("ACGTN-acgtRy", weights=[30,30,30,30,1,1,1,1,1,1,1,1], k=length)) for _ in range(n_seqs)]
+    records = [SeqRecord(Seq.Seq(s), id=f"s{i}") for i, s in enumerate(seqs)]
+    primers = ["".join(random.choices("ACGT", k=20)) for _ in range(20000)]
+
+    genomes = ["".join(random.choices("ACGTN", weights=[30,30,30,30,1], k=2000000)) for _ in range(5)]
+
+    print (f"{n_seqs} sequences of length {length}; 20000 primers of length 20; 5 genomes of 2Mb")
+    t_old, r_old = timeit ("freq_N of genomes, python", lambda: [old_freq_N(g) for g in genomes])
+    t_new, r_new = timeit ("freq_N of genomes, numpy", lambda: [pb_common.calc_freq_N_from_string(g) for g in genomes])
+    assert all([abs(a-b) < 1e-12 for a, b in zip(r_old, r_new)])
+    print (f"{'speedup':<40} {t_old/t_new:10.1f} x")
+
+    t_old, r_old = timeit ("missing counts, python (per sequence)", lambda: [sum([s.upper().count(c) for c in "N-"]) for s in seqs])
+    t_new, r_new = timeit ("missing counts, numpy (batched)", pb_seqkernel.missing_counts, seqs)
+    assert r_old == r_new.tolist()
+    print (f"{'speedup':<40} {t_old/t_new:10.1f} x")
+
+    t_old, r_old = timeit ("quality of records, python", old_quality, records)
+    t_new, r_new = timeit ("quality of records, numpy", lambda: pb_common.remove_duplicated_sequences_list(records)[1])
+    assert r_old == list(r_new.values())
+    print (f"{'speedup':<40} {t_old/t_new:10.1f} x")
+
+    t_old, r_old = timeit ("k-mer sets (k=5), xxhash", lambda: [old_kmers(p, 5) for p in primers])
+    t_new, r_new = timeit ("k-mer sets (k=5), numpy batched", lambda: pb_seqkernel.kmer_sets(primers, 5))
+    assert [len(x) for x in r_old] == [len(x) for x in r_new] # hash values differ, but not the k-mers
+    print (f"{'speedup':<40} {t_old/t_new:10.1f} x")
+
+    t_old, r_old = timeit ("reverse complement, Biopython", lambda: [str(Seq.Seq(s).reverse_complement()) for s in seqs])
+    t_new, r_new = timeit ("reverse complement, numpy batched", pb_seqkernel.reverse_complement_list, seqs)
+    assert r_old == r_new
+    print (f"{'speedup':<40} {t_old/t_new:10.1f} x")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# startup time of the command line and of each subcommand (i.e. importing the main script plus the task module it
+# calls), each measured in a fresh interpreter, and which heavy optional modules it loads. With `--profile` also lists
+# the slowest imports (python -X importtime)
+# usage: python benchmarks/bench_startup.py [--profile] [repeats]
+import sys, subprocess, time
+
+subcommands = { # subcommand: module imported by its run_* function in pb_main
+    "--help": None,
+    "merge_fasta_gff": "task_fasta_gff",
+    "index_fasta": "task_fasta_gff",
+    "pack_fasta": "task_fasta_gff",
+    "extract_coordinates": "task_extract_riboprot_gff",
+    "extract_operons": "task_extract_riboprot_fasta",
+    "extract_genes": "task_extract_riboprot_fasta",
+    "cluster_align_genes": "task_align",
+    "estimate_trees": "task_align",
+    "find_primers": "task_find_primers",
+    "get_flanks": "task_cluster",
+    "cluster_primers": "task_cluster",
+    "subsample_primers": "task_cluster",
+    "blast_primers": "task_blast_primers",
+    "select_primers": "task_pair_primers",
+    }
+
+heavy_modules = ["sklearn", "scipy", "parasail", "Bio", "dendropy", "treeswift", "gffutils"]
+
+def import_statement (module):
+    code = "import phylobarcode.pb_main"
+    if module is not None: code += f"; import phylobarcode.{module}"
+    return code
+
+def startup_time (module, repeats = 3):
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        proc = subprocess.run ([sys.executable, "-c", import_statement (module)], stderr=subprocess.PIPE, universal_newlines=True)
+        dt = time.perf_counter() - t0
+        if proc.returncode != 0: return None, proc.stderr.strip().split("\n")[-1]
+        best = dt if best is None else min(best, dt)
+    return best, None
+
+def loaded_heavy_modules (module):
+    code = import_statement (module) + f"; import sys; print (' '.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    proc = subprocess.run ([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return proc.stdout.strip()
+
+def slowest_imports (module, n = 8):
+    proc = subprocess.run ([sys.executable, "-X", "importtime", "-c", import_statement (module)], 
+            stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.split("\n"):
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        fields = line[len("import time:"):].split("|") # self time, cumulative time (microseconds), module name
+        name = fields[2].strip() # nested imports are indented
+        if name.startswith("phylobarcode") or "." not in name: rows.append ((int(fields[1]), name))
+    return sorted(rows, reverse=True)[:n]
+
+if __name__ == '__main__':
+    profile = "--profile" in sys.argv
+    args = [a for a in sys.argv[1:] if a != "--profile"]
+    repeats = int(args[0]) if args else 3
+    print (f"{'subcommand':<24} {'module':<30} {'startup (s)':>12}  heavy modules loaded")
+    for cmd, module in subcommands.items():
+        t, error = startup_time (module, repeats)
+        if t is None: print (f"{cmd:<24} {str(module):<30} {'failed':>12}  ({error})")
+        else: print (f"{cmd:<24} {str(module):<30} {t:12.3f}  {loaded_heavy_modules (module)}")
+        if profile and t is not None:
+            for us, name in slowest_imports (module): print (f"{'':<8} {name:<46} {us/1e6:8.3f}")
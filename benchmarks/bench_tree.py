@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# all-pairs leaf distances of a random tree: LCA-based ArrayTree (pb_tree) against treeswift's dict of dicts filled
+# into a matrix pair by pair, as done by the original silhouette functions
+# usage: python benchmarks/bench_tree.py [n_leaves]
+import sys, time, random, itertools
+import numpy as np, treeswift
+from phylobarcode import pb_tree
+
+def random_newick (n_leaves):
+    nodes = [f"t{i}:{random.random():.4f}" for i in range(n_leaves)]
+    while len(nodes) > 1:
+        a = nodes.pop(random.randrange(len(nodes)))
+        b = nodes.pop(random.randrange(len(nodes)))
+        nodes.append (f"({a},{b}):{random.random():.4f}")
+    return nodes[0] + ";"
+
+def old_distance_matrix (tree):
+    labels = [x.label for x in tree.traverse_leaves() if x.label is not None]
+    distmat = np.zeros((len(labels), len(labels)))
+    dist_dict = tree.distance_matrix(leaf_labels=True)
+    for i,j in itertools.combinations(range(len(labels)), 2):
+        distmat[j,i] = distmat[i,j] = dist_dict[labels[i]][labels[j]]
+    return labels, distmat
+
+def new_distance_matrix (tree):
+    atree = pb_tree.ArrayTree.from_treeswift (tree)
+    return atree.leaf_labels, atree.distance_matrix()
+
+if __name__ == '__main__':
+    n_leaves = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(42)
+    tree = treeswift.read_tree_newick (random_newick (n_leaves))
+    results = []
+    for label, func in [("treeswift dict + python loop", old_distance_matrix), ("ArrayTree (Euler tour LCA)", new_distance_matrix)]:
+        t0 = time.perf_counter()
+        labels, mat = func (tree)
+        print (f"{label:<40} {time.perf_counter() - t0:10.3f} s")
+        order = np.argsort(labels)
+        results.append (mat[np.ix_(order, order)])
+    print (f"max absolute difference: {np.abs(results[0] - results[1]).max():.2e} (float32 output)")
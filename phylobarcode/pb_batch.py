@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+import array
+import numpy as np, pandas as pd
+
+# tables built by pool workers (e.g. one row per riboprotein of each GFF3 file) are accumulated column by column, with
+# integer columns in typed arrays, and returned as DataFrames. The parent process concatenates them column-wise, instead
+# of flattening the lists of rows from all workers, transposing them, and building the DataFrame from python objects
+# (which for millions of rows took most of the memory and time of the parent).
+
+class ColumnBatch:
+    ''' columns of a table, appended one row at a time; integer_columns are stored as int64 '''
+    def __init__ (self, columns, integer_columns = []):
+        self.columns = list(columns)
+        self.data = {c: array.array ("q") if c in integer_columns else [] for c in self.columns}
+        self.appenders = [self.data[c].append for c in self.columns]
+
+    def __len__ (self): return len(self.data[self.columns[0]])
+
+    def append (self, *values):
+        for append, value in zip (self.appenders, values): append (value)
+
+    def extend (self, rows):
+        for row in rows: self.append (*row)
+
+    def dataframe (self):
+        columns = {c: np.frombuffer (v, dtype=np.int64) if isinstance (v, array.array) else v for c, v in self.data.items()}
+        return pd.DataFrame (columns, columns = self.columns)
+
+def concat_batches (dataframes, columns):
+    ''' single table from the DataFrames returned by the workers (None are skipped), in the given order '''
+    dataframes = [df for df in dataframes if df is not None]
+    if not dataframes: return pd.DataFrame (columns = columns)
+    return pd.concat (dataframes, ignore_index = True)
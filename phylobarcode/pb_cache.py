@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import os, logging, shutil, subprocess, random, xxhash, functools
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# on-disk cache of results from external programs (mafft, cd-hit, fasttree, rapidnj), keyed by an xxh128 digest of
+# the (canonicalised) input sequences, the program name and version, and its arguments. Each entry is a directory
+# with the output files; its modification time is updated at each hit s.t. the least recently used are deleted first
+# once the cache is larger than max_size.
+
+cache_settings = {
+    "enabled": not os.environ.get("PHYLOBARCODE_NO_CACHE"),
+    "directory": os.environ.get("PHYLOBARCODE_CACHE",
+        os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "phylobarcode")),
+    "max_size": int(float(os.environ.get("PHYLOBARCODE_CACHE_SIZE", 4096)) * 1e6) # in MB
+    }
+
+version_commands = { # how to get the version of each program; output may be in stdout or stderr
+    "mafft": ["mafft", "--version"],
+    "cd-hit": ["cd-hit", "-h"],
+    "fasttree": ["fasttree"],
+    "rapidnj": ["rapidnj", "-h"]
+    }
+
+def set_cache (enabled = None, directory = None, max_size = None):
+    if enabled is not None: cache_settings["enabled"] = enabled
+    if directory is not None: cache_settings["directory"] = directory
+    if max_size is not None: cache_settings["max_size"] = max_size
+    if cache_settings["enabled"]:
+        logger.debug (f"Using cache for external programs at {cache_settings['directory']}")
+
+@functools.lru_cache(maxsize=None)
+def tool_version (tool):
+    ''' first line mentioning the version (or first line) of program output; "unknown" if program cannot run '''
+    command = version_commands.get(tool, [tool, "--version"])
+    try:
+        proc = subprocess.run (command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                universal_newlines=True, timeout=20)
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+    lines = [l.strip() for l in proc.stdout.splitlines() if l.strip()]
+    version = [l for l in lines if "version" in l.lower()]
+    if version: return version[0]
+    return lines[0] if lines else "unknown"
+
+def cache_key (tool, arguments, sequences):
+    '''
+    digest of tool, version, arguments and sequences (list of SeqRecords), or None if cache is disabled. Sequences
+    are canonicalised (no line breaks, uppercase, single spaces in header) but their order is kept.
+    '''
+    if not cache_settings["enabled"]: return None
+    h = xxhash.xxh3_128()
+    h.update (f"{tool}\n{tool_version(tool)}\n{arguments}\n".encode())
+    for s in sequences:
+        header = " ".join(f"{s.id} {s.description}".split()) # description usually starts with id (SeqIO)
+        h.update (f">{header}\n{str(s.seq).upper()}\n".encode())
+    return f"{tool}-{h.hexdigest()}"
+
+def cache_fetch (key, destinations):
+    ''' copies cached files (dict name -> destination path) and returns True if found, o.w. returns False '''
+    if key is None: return False
+    entry = os.path.join (cache_settings["directory"], key)
+    if not all ([os.path.isfile (os.path.join(entry, name)) for name in destinations.keys()]):
+        logger.debug (f"Cache miss for {key}")
+        return False
+    for name, dest in destinations.items():
+        shutil.copyfile (os.path.join(entry, name), dest)
+    try:
+        os.utime (entry) # most recently used
+    except OSError: pass
+    logger.info (f"Using cached results from {key[:key.index('-')]} (cache entry {key})")
+    return True
+
+def cache_store (key, sources):
+    ''' stores files (dict name -> source path) as a new cache entry, and evicts old entries if cache is too large '''
+    if key is None: return
+    entry = os.path.join (cache_settings["directory"], key)
+    tmpdir = entry + '.tmp.%012x' % random.randrange(16**12) # atomic: other processes never see an incomplete entry
+    try:
+        os.makedirs (tmpdir)
+        for name, src in sources.items():
+            shutil.copyfile (src, os.path.join(tmpdir, name))
+        os.rename (tmpdir, entry)
+    except OSError as e: # includes entry created by another process meanwhile
+        logger.debug (f"Could not store {key} in cache: {e}")
+        shutil.rmtree (tmpdir, ignore_errors=True)
+        return
+    evict_old_entries ()
+
+def evict_old_entries (max_size = None):
+    ''' deletes least recently used entries until cache is smaller than max_size '''
+    if max_size is None: max_size = cache_settings["max_size"]
+    cachedir = cache_settings["directory"]
+    entries = []
+    total_size = 0
+    for e in os.scandir (cachedir):
+        if not e.is_dir() or ".tmp." in e.name: continue
+        try:
+            size = sum([f.stat().st_size for f in os.scandir(e.path)])
+            entries.append ((e.stat().st_mtime, size, e.path))
+        except OSError: continue # removed by another process
+        total_size += size
+    if total_size <= max_size: return
+    entries.sort()
+    n_removed = 0
+    for mtime, size, path in entries:
+        if total_size <= max_size: break
+        shutil.rmtree (path, ignore_errors=True)
+        total_size -= size
+        n_removed += 1
+    logger.info (f"Removed {n_removed} old entries from cache {cachedir} (now using {round(total_size/1e6,1)} MB)")
@@ -1,8 +1,10 @@
 import os, logging, xxhash
-from Bio import Seq, SeqIO, AlignIO
 import random, datetime, sys, re, glob, collections, subprocess, itertools, pathlib, base64, string
-import lzma, gzip, bz2, dendropy, treeswift, copy, numpy as np
-from sklearn import metrics
+import lzma, gzip, bz2, multiprocessing, copy
+from phylobarcode import pb_cache
+from phylobarcode.pb_executor import run_tool
+# heavy modules (Bio, numpy, dendropy, treeswift, sklearn) are imported only by the functions that need them, s.t. the
+# command line (and each task, or spawned pool worker) loads only what it uses. Task modules import them explicitly.
 
 # legacy code, now every module shares the same parent logger
 #log_format = logging.Formatter(fmt='phylobarcode_common %(asctime)s [%(levelname)s] %(message)s', datefmt="%Y-%m-%d %H:%M")
@@ -33,12 +35,12 @@ def split_gtdb_taxonomy_from_dataframe (taxon_df, gtdb_column = "gtdb_taxonomy",
     '''
     Splits the GTDB taxonomy string into a list of taxonomic ranks: 
     d__Bacteria;p__Firmicutes;c__Bacilli;o__Bacillales;f__Bacillaceae_H;g__Priestia;s__Priestia megaterium
+    Each distinct string is split only once (see pb_taxonomy for lookups by seqid)
     '''
-    linneus = {"phylum":1, "class":2, "order":3, "family":4, "genus":5, "species":6}
-    for k,v in linneus.items():
-        taxon_df[k] = taxon_df[gtdb_column].str.split(";").str[v].str.split("__").str[1]
-    if replace is not None:
-        for k in linneus.keys():
+    from phylobarcode.pb_taxonomy import split_gtdb_taxonomy
+    for k, v in split_gtdb_taxonomy (taxon_df[gtdb_column]).items():
+        taxon_df[k] = v
+        if replace is not None:
             taxon_df[k] = taxon_df[k].fillna(replace)
     if (drop_gtdb_column): taxon_df.drop(columns = [gtdb_column], inplace = True)
     return taxon_df
@@ -56,26 +58,94 @@ def seq_to_base62 (seq): # https://stackoverflow.com/questions/1119722/base-62-c
         integer //= len_base62
     return ret
 
+def fasta_iterator (filename, headers_only = False, seqids = None, select = None, clean_sequence = True, 
+        as_seqrecord = False, blocksize = 1 << 22):
+    '''
+    Generator over the records of a (possibly compressed) fasta file, working on raw bytes instead of SeqIO.
+    Yields (description, sequence) tuples of strings, or SeqRecords if as_seqrecord=True. Sequence lines are skipped
+    without being decoded if headers_only=True (sequence is None) or if the record is not wanted, where wanted records
+    are those with id (first word) in `seqids` and/or with description accepted by function `select`.
+    If `seqids` is given, the file is closed as soon as all of them were found.
+    '''
+    if seqids is not None: seqids = set(seqids)
+    if as_seqrecord: 
+        from Bio.SeqRecord import SeqRecord
+        from Bio import Seq
+    buf = bytearray()
+    with open_anyformat (filename, "rb") as handle:
+        eof = False
+        while True: # skip anything before first header
+            block = handle.read(blocksize)
+            if not block: return
+            start = block.find(b">")
+            if start >= 0: buf += block[start+1:]; break
+        header = None 
+        search_from = 0
+        while True:
+            if header is None: # we are at beginning of header line (">" already removed)
+                nl = buf.find(b"\n")
+                if nl < 0 and not eof:
+                    block = handle.read(blocksize)
+                    if not block: eof = True
+                    buf += block
+                    continue
+                if nl < 0: nl = len(buf)
+                header = bytes(buf[:nl]).rstrip().decode("utf-8", errors="replace")
+                del buf[:nl+1]
+                seqid = header.split(None, 1)[0] if header else ""
+                keep = (seqids is None or seqid in seqids) and (select is None or select(header))
+                search_from = 0
+            if buf[:1] == b">": pos = -1 # empty sequence, next header starts right away
+            else: 
+                pos = buf.find(b"\n>", search_from)
+                if pos < 0 and not eof: # record continues in next block
+                    if keep and not headers_only: search_from = max(0, len(buf) - 1)
+                    else: # sequence not needed, keep only a trailing newline (which may precede a ">")
+                        del buf[:len(buf) - 1 if buf[-1:] == b"\n" else len(buf)] 
+                        search_from = 0
+                    block = handle.read(blocksize)
+                    if not block: eof = True
+                    buf += block
+                    continue
+                if pos < 0: pos = len(buf) # last record in file
+            if keep:
+                if headers_only: sequence = None
+                else:
+                    sequence = bytes(buf[:max(pos,0)]).translate(None, b" \t\r\n")
+                    if clean_sequence: sequence = sequence.upper().replace(b".", b"N")
+                    sequence = sequence.decode("ascii", errors="replace")
+                if as_seqrecord:
+                    yield SeqRecord(Seq.Seq(sequence) if sequence is not None else None, id=seqid, name=seqid, description=header)
+                else:
+                    yield header, sequence
+                if seqids is not None:
+                    seqids.discard(seqid)
+                    if not seqids: return # all requested sequences were found
+            del buf[:pos+2] # removes "\n>" (or ">" if pos == -1)
+            header = None
+            if eof and not buf: return
+
 def read_fasta_as_list (filename, clean_sequence=True, substring=None):
-    unaligned = []
-    with open_anyformat (filename, "r") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            if clean_sequence:
-                record.seq  = Seq.Seq(str(record.seq.upper()).replace(".","N"))
-            if substring is None or any([x in record.description for x in substring]):
-                unaligned.append(record)
+    if substring is None: select = None
+    else: select = lambda description: any([x in description for x in substring])
+    unaligned = list(fasta_iterator (filename, select = select, clean_sequence = clean_sequence, as_seqrecord = True))
     logger.debug("Read %s sequences from file %s", str(len(unaligned)), filename)
     return unaligned
 
 def read_fasta_headers_as_list (filename):
-    seqnames = []
-    with open_anyformat (filename, "r") as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            seqnames.append(record.description)
+    seqnames = [description for description, _ in fasta_iterator (filename, headers_only = True)]
     logger.debug("Read %s sequence headers from file %s", str(len(seqnames)), filename)
     return seqnames
 
+def read_fasta_sequence_by_id (filename, seqid, clean_sequence=True):
+    ''' returns Seq object of first record with given id, stopping as soon as it is found (or None if not found)'''
+    from Bio import Seq
+    for _, sequence in fasta_iterator (filename, seqids = [seqid], clean_sequence = clean_sequence):
+        return Seq.Seq(sequence)
+    return None
+
 def mafft_align_seqs (sequences=None, infile = None, outfile = None, prefix = None, nthreads = 1): # list not dict
+    from Bio import SeqIO, AlignIO
     if (sequences is None) and (infile is None):
         logger.error("You must give me a fasta object or a file")
         return None
@@ -88,13 +158,16 @@ def mafft_align_seqs (sequences=None, infile = None, outfile = None, prefix = No
     if sequences: SeqIO.write(sequences, ifl, "fasta") ## else it should be present in infile
     if nthreads < 1: nthreads = -1 # mafft default to use all available threads
 
-    runstr = f"mafft --auto --ep 0.23 --leavegappyregion --thread {nthreads} {ifl} > {ofl}"
+    options = "--auto --ep 0.23 --leavegappyregion" # number of threads does not change the result
+    cachekey = pb_cache.cache_key ("mafft", options, fasta_iterator (ifl, as_seqrecord = True)) # None if cache is disabled
+    cached = pb_cache.cache_fetch (cachekey, {"aln": ofl})
     try:
-        proc_run = subprocess.check_output(runstr, shell=True, universal_newlines=True)
+        if not cached: run_tool (["mafft"] + options.split() + ["--thread", nthreads, ifl], output_file = ofl)
     except subprocess.CalledProcessError as e:
         logger.error("Error running mafft: %s", e)
         aligned = None
     else:
+        if not cached: pb_cache.cache_store (cachekey, {"aln": ofl})
         aligned = AlignIO.read(ofl, "fasta")
 
     if infile is None:  os.remove(ifl)
@@ -103,6 +176,7 @@ def mafft_align_seqs (sequences=None, infile = None, outfile = None, prefix = No
 
 def cdhit_cluster_seqs (sequences=None, infile = None, outfile = None, prefix = None, nthreads = 1, 
         id = 0.9, fast = True): # list not dict
+    from Bio import SeqIO
     def read_clstr_file (clstr_file):
         clusters = {}
         with open(clstr_file, "r") as clstr:
@@ -129,14 +203,17 @@ def cdhit_cluster_seqs (sequences=None, infile = None, outfile = None, prefix =
     if fast is True: algo = "0" # sequence is clustered to the first cluster that meet the threshold
     else: algo = "1" # sequence is clustered to the most similar cluster that meet the threshold
 
-    runstr = f"cd-hit -i {ifl} -o {ofl} -c {id} -M 0 -T {nthreads} -d 0 -aS 0.5 -aL 0.5 -g {algo} -s 0.5 -p 0"
+    options = f"-c {id} -M 0 -d 0 -aS 0.5 -aL 0.5 -g {algo} -s 0.5 -p 0" # number of threads does not change the result
+    cachekey = pb_cache.cache_key ("cd-hit", options, fasta_iterator (ifl, as_seqrecord = True))
+    cached = pb_cache.cache_fetch (cachekey, {"reps.fasta": ofl, "reps.fasta.clstr": f"{ofl}.clstr"})
     try:
-        proc_run = subprocess.check_output(runstr, shell=True, universal_newlines=True)
+        if not cached: run_tool (["cd-hit", "-i", ifl, "-o", ofl] + options.split() + ["-T", nthreads])
     except subprocess.CalledProcessError as e:
         logger.error("Error running cdhit: %s", e)
         representatives = None
         clusters = None
     else:
+        if not cached: pb_cache.cache_store (cachekey, {"reps.fasta": ofl, "reps.fasta.clstr": f"{ofl}.clstr"})
         representatives = SeqIO.parse(ofl, "fasta")
         clusters = read_clstr_file(f"{ofl}.clstr")
 
@@ -147,60 +224,88 @@ def cdhit_cluster_seqs (sequences=None, infile = None, outfile = None, prefix =
 
 # In general (not here particularly) we use dendropy since it can handle commented nodes (metadata)
 #   e.g. the GTDB tree
-def silhouette_score_from_newick_dendropy (newick, class_dict):
+def silhouette_score_from_newick_dendropy (newick, class_dict, memmap_dir = None):
     """
     returns silhouette scores for all tips in the tree as dictionaries: one considering 
     branch lengths and another considering only number of nodes
     """
+    import dendropy
+    from sklearn import metrics
+    from phylobarcode import pb_tree
     if isinstance (newick, str):
         tree = dendropy.Tree.get(data=newick, schema="newick", preserve_underscores=True)
     elif isinstance (newick, dendropy.Tree):
         tree = newick
     else: tree = dendropy.Tree.get(data=str(newick), schema="newick", preserve_underscores=True) # treeswift?
     
-    species = [class_dict[x.label] for x in tree.taxon_namespace]
-    ntaxa = len(species)
-    distmat = np.zeros((ntaxa, ntaxa))
-    nodemat = np.zeros((ntaxa, ntaxa))
-    # STEP 1: pairwise distances along the tree
-    pdm = tree.phylogenetic_distance_matrix()
-    for i,j in itertools.combinations(range(ntaxa), 2):
-        distmat[j,i] = distmat[i,j] = pdm.distance(tree.taxon_namespace[i], tree.taxon_namespace[j])
-        nodemat[j,i] = nodemat[i,j] = pdm.path_edge_count(tree.taxon_namespace[i], tree.taxon_namespace[j])
+    # STEP 1: pairwise distances along the tree (LCA-based, for all pairs at once)
+    atree = pb_tree.ArrayTree.from_dendropy (tree)
+    labels = atree.leaf_labels
+    species = [class_dict[x] for x in labels]
+    distmat, nodemat = atree.distance_matrices (patristic = True, edge_count = True, memmap_dir = memmap_dir)
     # STEP 2: silhouette score using pairwise distances and taxonomic information
     mdist = metrics.silhouette_samples(distmat, species, metric="precomputed")
     mnode = metrics.silhouette_samples(nodemat, species, metric="precomputed")
-    mdist = {tree.taxon_namespace[i].label: mdist[i] for i in range(ntaxa)}
-    mnode = {tree.taxon_namespace[i].label: mnode[i] for i in range(ntaxa)}
+    mdist = {labels[i]: mdist[i] for i in range(len(labels))}
+    mnode = {labels[i]: mnode[i] for i in range(len(labels))}
     return mdist, mnode # dictionaries with the silhouette score for each sequence
 
-def silhouette_score_from_newick_swift (newick, class_dict):
+def silhouette_score_from_newick_swift (newick, class_dict, memmap_dir = None, matrix_free = False):
     """ 
     returns silhouette scores for all tips in the tree as one dictionary, considering branch lengths.
-    Much faster than the alternative function (if you want number of nodes)
+    Much faster than the alternative function (if you want number of nodes). If matrix_free, the mean distances to
+    each class are computed along the tree, with memory linear in the number of tips (for very large trees)
     """
-    if isinstance (newick, dendropy.Tree): tree = treeswift.read_tree_dendropy (newick)
-    else: tree = treeswift.read_tree_newick (newick) # treeswift object _or_ string 
-    for node in tree.traverse_leaves(): node.label = node.label.replace("'", "")
-    labels = [x.label for x in tree.traverse_leaves() if x.label is not None]
+    from sklearn import metrics
+    from phylobarcode import pb_tree
+    # STEP 1: pairwise distances along the tree (LCA-based, for all pairs at once)
+    atree = pb_tree.ArrayTree.from_any (newick) # string, treeswift or dendropy
+    labels = atree.leaf_labels
     species = [class_dict[x] for x in labels]
-    ntaxa = len(species)
-    distmat = np.zeros((ntaxa, ntaxa))
-    # STEP 1: pairwise distances along the tree
-    dist_dict = tree.distance_matrix(leaf_labels=True) ## dictionary of dictionaries, with leaf labels (ow. node objects)
-    for i,j in itertools.combinations(range(ntaxa), 2):
-        distmat[j,i] = distmat[i,j] = dist_dict[labels[i]][labels[j]]
-    # STEP 2: silhouette score using pairwise distances and taxonomic information
-    mdist = metrics.silhouette_samples(distmat, species, metric="precomputed")
-    mdist = {labels[i]: mdist[i] for i in range(ntaxa)}
+    if matrix_free: 
+        mdist = atree.silhouette_samples (species)
+    else:
+        distmat = atree.distance_matrix (memmap_dir = memmap_dir)
+        # STEP 2: silhouette score using pairwise distances and taxonomic information
+        mdist = metrics.silhouette_samples(distmat, species, metric="precomputed")
+    mdist = {labels[i]: mdist[i] for i in range(len(labels))}
     return mdist # dictionaries with the silhouette score for each sequence
 
+def silhouette_score_from_newick_ranks (newick, class_table, ranks = None, memmap_dir = None, matrix_free = False):
+    """
+    returns silhouette scores for all tips in the tree at several taxonomic ranks, sharing the tree parsing and the
+    distance calculation. class_table maps each tip label to a dict with its class at each rank. Returns dict of
+    dictionaries (rank -> tip -> score), with None for ranks where score is undefined (e.g. one class only)
+    """
+    from sklearn import metrics
+    from phylobarcode import pb_tree
+    if ranks is None: ranks = ["species", "genus", "family", "order"]
+    atree = pb_tree.ArrayTree.from_any (newick) # string, treeswift or dendropy
+    labels = atree.leaf_labels
+    if matrix_free: distmat = None
+    else: distmat = atree.distance_matrix (memmap_dir = memmap_dir)
+    scores = {}
+    for rank in ranks:
+        classes = [class_table[x][rank] for x in labels]
+        try:
+            if matrix_free: mdist = atree.silhouette_samples (classes)
+            else: mdist = metrics.silhouette_samples(distmat, classes, metric="precomputed")
+        except ValueError as e: # number of classes must be between 2 and n_tips - 1
+            logger.debug (f"Silhouette score undefined at rank {rank}: {e}")
+            scores[rank] = None
+        else:
+            scores[rank] = {labels[i]: mdist[i] for i in range(len(labels))}
+    return scores
+
 def newick_string_from_alignment (sequences=None, infile = None, simple_names = None, outfile = None, prefix = None, 
-        protein = False, rapidnj = None, nthreads = 1): 
+        protein = False, rapidnj = None, collapse_identical = True, nthreads = 1): 
     """
     rapidnj uses whole fasta header description, while fasttree uses only the sequence id;
-    therefore to use rapidnj is advised to use simple_names=True and give _sequences_ and not _infile_
+    therefore to use rapidnj is advised to use simple_names=True and give _sequences_ and not _infile_.
+    If collapse_identical, the tree is estimated from distinct sequences and identical ones are added back as
+    zero-length sister leaves.
     """
+    from Bio import Seq, SeqIO
     if (sequences is None) and (infile is None):
         logger.error("You must give me a fasta object or a file")
         return None
@@ -210,7 +315,7 @@ def newick_string_from_alignment (sequences=None, infile = None, simple_names =
     else: program = "fasttree" 
     if outfile is None: ofl = f"{prefix}/{program}_{hash_name}.tree"
     else: ofl = outfile # in this case it will not exclude_reference
-    ifl = f"{prefix}/{program}_{hash_name}.fasta" #always generate a fasta file 
+    ifl = f"{prefix}/{program}_{hash_name}.fasta" # rapidnj needs a file, while fasttree reads from stdin
 
     # read infile since we need to simplify the names, and infile may be compressed
     if sequences is None: new_seqs = read_fasta_as_list (infile)
@@ -219,49 +324,66 @@ def newick_string_from_alignment (sequences=None, infile = None, simple_names =
     if simple_names is True: # create a copy of all SeqRecords with no description (i.e. long names after space) 
         if sequences is None: # then we have new_seqs which we can overwrite (o.w. careful not to overwtite sequences)
             for x in new_seqs: x.description = "" # remove the description
-        else: new_seqs = [SeqRecord(Seq(str(s.seq)), id=s.id, description="") for i, s in enumerate(sequences)] # copy
-    SeqIO.write(new_seqs, ifl, "fasta")
+        else: 
+            from Bio.SeqRecord import SeqRecord
+            new_seqs = [SeqRecord(Seq.Seq(str(s.seq)), id=s.id, description="") for i, s in enumerate(sequences)] # copy
     if nthreads < 1: nthreads = 1 # rapidnj default to use 1 thread; fastree has no control (all or nothing)
+    if collapse_identical is True: # leaf names as written by each program
+        leaf_name = (lambda x: x.description) if (program == "rapidnj" and simple_names is not True) else None
+        new_seqs, members = collapse_identical_sequences (new_seqs, leaf_name = leaf_name)
+    else: members = {}
 
     if program == "rapidnj":
         seqtype = "d" if protein is False else "p"
-        runstr = f"rapidnj {ifl} -i fa -c {nthreads} -t {seqtype} -n -x {ofl}"
+        options = f"-i fa -t {seqtype} -n"
     else:
         seqtype = "-nt" if protein is False else ""
-        runstr = f"fasttree {seqtype} -quiet -nni 4 -spr 4 -mlnni 2 -nocat -nosupport {ifl} > {ofl}"
+        options = f"{seqtype} -quiet -nni 4 -spr 4 -mlnni 2 -nocat -nosupport"
+    cachekey = pb_cache.cache_key (program, options, new_seqs)
+    cached = pb_cache.cache_fetch (cachekey, {"tree": ofl})
     try:
-        proc_run = subprocess.check_output(runstr, shell=True, universal_newlines=True)
+        if cached: pass
+        elif program == "rapidnj":
+            SeqIO.write(new_seqs, ifl, "fasta")
+            run_tool (["rapidnj", ifl] + options.split() + ["-c", nthreads, "-x", ofl])
+        else: # alignment is streamed to fasttree, without temporary file
+            run_tool (["fasttree"] + options.split(), input = (f">{s.id}\n{s.seq}\n" for s in new_seqs), output_file = ofl)
     except subprocess.CalledProcessError as e:
-        logger.error("Error running {program} %s", e)
+        logger.error(f"Error running {program}: %s", e)
         treestring = None
     else:
+        if not cached: pb_cache.cache_store (cachekey, {"tree": ofl})
         treestring = open(ofl).readline().rstrip().replace("\'","").replace("\"","").replace("[&R]","")
+        if len(new_seqs) < sum([len(v) for v in members.values()]):
+            treestring = expand_collapsed_leaves (treestring, members)
+            if outfile is not None:
+                with open (ofl, "w") as f: f.write (treestring + "\n")
 
-    os.remove(ifl) ## always delete since it's created here
-    if outfile is None: os.remove(ofl)
+    if os.path.exists (ifl): os.remove(ifl) 
+    if outfile is None and os.path.exists (ofl): os.remove(ofl)
     return treestring
 
 def calc_freq_N_from_string (genome):
+    from phylobarcode import pb_seqkernel
     l = len(genome)
-    if (l):
-        number_Ns = sum([genome.upper().count(nuc) for nuc in ["N", "-"]])
-        return number_Ns / l
+    if (l): return float (pb_seqkernel.missing_counts ([genome])[0] / l)
     else: return 1.
 
 def calc_freq_ACGT_from_string (genome):
+    from phylobarcode import pb_seqkernel
     l = len(genome)
-    if (l):
-        number_ACGTs = sum([genome.upper().count(nuc) for nuc in ["A", "C", "G", "T"]])
-        return number_ACGTs / l
+    if (l): return float (pb_seqkernel.acgt_counts ([genome])[0] / l)
     else: return 0.
 
 def remove_duplicated_sequences_list (sequences): # input is list, returns a dict
+    from phylobarcode import pb_seqkernel
     uniq_seqs = {}
     uniq_qual = {}
     duplicates = []
-    for x in sequences:
-        seq = str(x.seq)
-        quality = len(seq) - sum([seq.upper().count(nuc) for nuc in ["N", "-"]])
+    sequences = list(sequences)
+    # quality = number of non-N, non-gap sites; calculated for all sequences at once
+    qualities = [len(x.seq) - int(n) for x, n in zip(sequences, pb_seqkernel.missing_counts ([x.seq for x in sequences]))]
+    for x, quality in zip(sequences, qualities):
         if x.id in uniq_seqs.keys(): # sequence name has been seen before 
             if uniq_qual[x.id] < quality: # replaces if better quality
                 uniq_qual[x.id] = quality
@@ -278,6 +400,42 @@ def remove_duplicated_sequences_list (sequences): # input is list, returns a dic
         logger.info ("Checked for duplicates but all sequences have distinct names")
     return uniq_seqs, uniq_qual
 
+def collapse_identical_sequences (sequences, leaf_name = None):
+    '''
+    groups sequences (list of SeqRecords) by the xxh128 digest of their uppercase sequence and keeps the first of each
+    group. Returns list of representatives and dict with members (representative first) of each representative, s.t.
+    its multiplicity is len(members[name]). Names are x.id unless given by function leaf_name(x).
+    '''
+    if leaf_name is None: leaf_name = lambda x: x.id
+    representatives = {} # digest -> representative
+    members = {}
+    for x in sequences:
+        digest = xxhash.xxh128_digest (str(x.seq).upper().encode())
+        if digest in representatives: members[leaf_name(representatives[digest])].append (leaf_name(x))
+        else:
+            representatives[digest] = x
+            members[leaf_name(x)] = [leaf_name(x)]
+    n_seqs = sum([len(v) for v in members.values()])
+    logger.debug (f"Collapsed {n_seqs} sequences into {len(representatives)} distinct ones")
+    return list(representatives.values()), members
+
+def expand_collapsed_clusters (clusters, members):
+    ''' replaces each representative in each cluster (list of lists of names) by all its members '''
+    return [[m for x in cl for m in members.get(x, [x])] for cl in clusters]
+
+def expand_collapsed_leaves (treestring, members):
+    ''' replaces each representative leaf by a cherry (or polytomy) of all its members, with zero branch lengths '''
+    import treeswift
+    if all ([len(v) < 2 for v in members.values()]): return treestring
+    tree = treeswift.read_tree_newick (treestring)
+    for node in list(tree.traverse_leaves()): # list() since new leaves would confuse the iterator
+        if node.label not in members or len(members[node.label]) < 2: continue
+        names = members[node.label]
+        node.label = None # becomes internal node
+        for name in names:
+            node.add_child (treeswift.Node(label=name, edge_length=0.))
+    return tree.newick()
+
 def save_sequence_dict_to_file (seqs, fname=None, use_seq_id = False):
     if fname is None: fname = "tmp." + '%012x' % random.randrange(16**12) + ".aln.xz"
     logger.info(f"Saving sequences to file {fname}")
@@ -292,14 +450,184 @@ def save_sequence_dict_to_file (seqs, fname=None, use_seq_id = False):
     logger.info(f"Finished saving sequences")
     return os.path.basename(fname)
 
+# compression level per profile (chosen with `--compression`, or env variable PHYLOBARCODE_COMPRESSION) and codec
+compression_profiles = {
+    "fast":    {"xz": 1, "gz": 1, "bz2": 1, "zst": 3},
+    "default": {"xz": 6, "gz": 9, "bz2": 9, "zst": 10},
+    "best":    {"xz": 9, "gz": 9, "bz2": 9, "zst": 19}
+    }
+compression_settings = {
+    "profile": os.environ.get("PHYLOBARCODE_COMPRESSION", "default"),
+    "threads": 1, # xz and zstd can compress in parallel
+    "xz_block_size": 1 << 22 # each block of uncompressed data is an independent xz stream
+    }
+if compression_settings["profile"] not in compression_profiles: compression_settings["profile"] = "default"
+
+try: # optional, faster codecs
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from isal import igzip as fast_gzip  # isa-l is much faster for decompression
+except ImportError:
+    try: 
+        from zlib_ng import gzip_ng as fast_gzip
+    except ImportError:
+        fast_gzip = gzip
+gzip_writer = fast_gzip if fast_gzip.__name__.endswith("gzip_ng") else gzip # isa-l levels are not the same as zlib's
+
+def set_compression (profile = None, threads = None):
+    if profile is not None:
+        if profile not in compression_profiles:
+            logger.warning (f"Unknown compression profile {profile}, using {compression_settings['profile']} instead")
+        else: compression_settings["profile"] = profile
+    if threads is not None: compression_settings["threads"] = max(1, threads)
+    logger.debug (f"Compression profile is {compression_settings['profile']} with up to {compression_settings['threads']} threads")
+
+def compression_level (codec):
+    return compression_profiles[compression_settings["profile"]][codec]
+
+class ThreadedXZWriter:
+    '''
+    writes xz files as a concatenation of independent streams, each compressed in a thread pool. The result is a
+    valid xz file (also for lzma.open and pandas), and the streams can be decompressed independently
+    '''
+    def __init__ (self, fname, preset = 6, threads = 2, block_size = 1 << 22):
+        from concurrent.futures import ThreadPoolExecutor
+        self.handle = open (fname, "wb")
+        self.preset = preset
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.max_pending = 2 * threads # limits memory usage if compression is slower than input
+        self.executor = ThreadPoolExecutor (max_workers = threads)
+        self.closed = False
+
+    def _submit (self, data):
+        self.pending.append (self.executor.submit (lzma.compress, bytes(data), format=lzma.FORMAT_XZ, preset=self.preset))
+        while len(self.pending) > self.max_pending:
+            self.handle.write (self.pending.popleft().result()) # in order
+
+    def write (self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit (self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush (self): pass # blocks are only written when full, or at close()
+
+    def writable (self): return True
+    def readable (self): return False
+    def seekable (self): return False
+
+    def close (self):
+        if self.closed: return
+        if self.buffer or not self.pending: self._submit (self.buffer) # empty file must still be valid xz
+        self.buffer = bytearray()
+        while self.pending: self.handle.write (self.pending.popleft().result())
+        self.executor.shutdown()
+        self.handle.close()
+        self.closed = True
+
+    def __enter__ (self): return self
+    def __exit__ (self, *args): self.close()
+
 def open_anyformat (fname, mode = "r"):
-    if (mode == "r"): openmode = "rt"
-    else:             openmode = "wb"
-    if   fname.endswith(".bz2"): this_open = bz2.open #if "bz2" in filename[-5:]: this_open = bz2.open
-    elif fname.endswith(".gz"):  this_open = gzip.open
-    elif fname.endswith(".xz"):  this_open = lzma.open
-    else:  
-        this_open = open
-#      if (mode == "w"): openmode = "w"  ## only raw file for writting doesn't need "wb"
-    return this_open (fname, openmode) 
+    ''' mode "r" opens in text mode; "rb" reads bytes; otherwise opens for writing bytes, using compression profile '''
+    if   (mode == "r"):  openmode = "rt"
+    elif (mode == "rb"): openmode = "rb"
+    else:                openmode = "wb"
+    reading = openmode != "wb"
+    # pool workers (e.g. writing per-thread files) compress in a single thread, since all cores are already busy
+    threads = compression_settings["threads"] if multiprocessing.current_process().name == "MainProcess" else 1
+    if fname.endswith(".bz2"): 
+        if reading: return bz2.open (fname, openmode)
+        return bz2.open (fname, openmode, compresslevel = compression_level("bz2"))
+    if fname.endswith(".gz"):
+        if reading: return fast_gzip.open (fname, openmode)
+        return gzip_writer.open (fname, openmode, compresslevel = compression_level("gz"))
+    if fname.endswith(".xz"):
+        if reading: return lzma.open (fname, openmode)
+        if threads > 1:
+            return ThreadedXZWriter (fname, preset = compression_level("xz"), threads = threads, 
+                    block_size = compression_settings["xz_block_size"])
+        return lzma.open (fname, openmode, preset = compression_level("xz"))
+    if fname.endswith(".zst"):
+        if zstandard is None:
+            logger.error (f"Python module `zstandard` is needed to read or write file {fname}")
+            sys.exit(1)
+        if reading: return zstandard.open (fname, openmode)
+        cctx = zstandard.ZstdCompressor (level = compression_level("zst"), threads = threads if threads > 1 else 0)
+        return zstandard.open (fname, openmode, cctx = cctx)
+    return open (fname, openmode) 
+
+class BackgroundWriter:
+    '''
+    file-like writer where encoding, compression and disk writes happen on a background thread. Records (str or bytes)
+    are grouped into batches of about `batch_size` bytes, and at most `max_batches` are waiting s.t. memory is bounded
+    (the caller blocks if the background thread cannot keep up). Can be used in place of open_anyformat(fname, "w").
+    '''
+    def __init__ (self, fname, batch_size = 1 << 18, max_batches = 4):
+        import threading, queue
+        self.fname = fname
+        self.batch = []
+        self.batch_len = 0
+        self.batch_size = batch_size
+        self.queue = queue.Queue (maxsize = max_batches)
+        self.error = None
+        self.closed = False
+        self.handle = open_anyformat (fname, "w") # opened here s.t. errors are raised by caller
+        self.thread = threading.Thread (target = self._consume, daemon = True)
+        self.thread.start()
+
+    def _consume (self):
+        while True:
+            batch = self.queue.get()
+            if batch is None: break
+            if self.error is not None: continue # keep draining s.t. caller is never blocked
+            try:
+                self.handle.write (b"".join([x if isinstance(x, bytes) else x.encode() for x in batch]))
+            except Exception as e:
+                self.error = e
+        try:
+            self.handle.close()
+        except Exception as e:
+            if self.error is None: self.error = e
+
+    def _check_error (self):
+        if self.error is not None: raise IOError (f"Error writing to {self.fname}: {self.error}")
+
+    def write (self, data):
+        self.batch.append (data)
+        self.batch_len += len(data)
+        if self.batch_len >= self.batch_size: self.flush()
+        return len(data)
+
+    def flush (self):
+        ''' sends current batch to background thread (does not wait for it to be written) '''
+        self._check_error()
+        if self.batch: self.queue.put (self.batch)
+        self.batch = []
+        self.batch_len = 0
+
+    def close (self):
+        if self.closed: return
+        self.flush()
+        self.queue.put (None)
+        self.thread.join()
+        self.closed = True
+        self._check_error()
+
+    def __enter__ (self): return self
+    def __exit__ (self, *args): self.close()
+
+def save_dataframe_as_tsv (df, fname):
+    ''' like df.to_csv(fname, sep="\\t", index=False) but compressing with open_anyformat (i.e. threads and profile) '''
+    import io
+    with open_anyformat (fname, "w") as fw:
+        fw_text = io.TextIOWrapper (fw, encoding="utf-8", newline="", write_through=True)
+        df.to_csv (fw_text, sep="\t", index=False)
+        fw_text.flush()
+        fw_text.detach() # o.w. closing the wrapper would close fw before the context manager does
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+import os, sys, logging, subprocess, threading, time, collections, tempfile
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# single entry point for running external programs (mafft, cd-hit, fasttree, rapidnj, primer3, blast, vsearch): the
+# command is a list of arguments (no shell), input can be streamed through stdin, stdout can go to a file, stderr is
+# always captured, and the call can be killed after a timeout. Wall time, CPU time and peak memory of each call are
+# appended to a usage file (shared by all pool workers) and summarised at the end of the run. The settings are also
+# exported as environment variables, s.t. pool workers started with spawn or forkserver (which import this module anew)
+# inherit them.
+
+executor_settings = {
+    "timeout": float(os.environ["PHYLOBARCODE_TOOL_TIMEOUT"]) if os.environ.get("PHYLOBARCODE_TOOL_TIMEOUT") else None,
+    "usage_file": os.environ.get("PHYLOBARCODE_TOOL_USAGE_FILE") or None # tsv file with one row per call; named by
+    }                                    # start_tool_usage_log() but only created by the first call to an external program
+
+class ToolTimeoutError (subprocess.CalledProcessError):
+    ''' subclass of CalledProcessError s.t. existing handlers also catch timeouts '''
+    def __str__ (self): return f"Command '{self.cmd[0]}' timed out and was killed"
+
+def set_tool_timeout (timeout = None):
+    if timeout is not None and timeout > 0:
+        executor_settings["timeout"] = timeout
+        os.environ["PHYLOBARCODE_TOOL_TIMEOUT"] = str(timeout)
+
+def start_tool_usage_log (directory = None):
+    ''' names the usage file (in directory, or the system temporary directory); it is removed by summarise_tool_usage() '''
+    if directory is None: directory = tempfile.gettempdir()
+    fname = os.path.join (directory, f"pb_tool_usage.{os.getpid()}.{time.time_ns():x}.tsv")
+    executor_settings["usage_file"] = os.environ["PHYLOBARCODE_TOOL_USAGE_FILE"] = fname
+    return fname
+
+def exit_status (status):
+    if os.WIFSIGNALED (status): return -os.WTERMSIG (status)
+    return os.WEXITSTATUS (status)
+
+def run_tool (command, input = None, output_file = None, timeout = None, text = True, check = True):
+    '''
+    runs command (list of strings) and returns (stdout, stderr); stdout is None if sent to output_file. `input` can be a
+    string/bytes or an iterable of them (e.g. a generator of fasta records), written to stdin by a separate thread.
+    Raises subprocess.CalledProcessError (or ToolTimeoutError) if check is True and program fails.
+    '''
+    command = [str(x) for x in command]
+    if timeout is None: timeout = executor_settings["timeout"]
+    f_out = open (output_file, "wb") if output_file is not None else None
+    t_start = time.perf_counter()
+    try:
+        proc = subprocess.Popen (command, stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout = f_out if f_out is not None else subprocess.PIPE, stderr = subprocess.PIPE)
+    except OSError as e: # program not found, etc.
+        if f_out is not None: f_out.close()
+        raise subprocess.CalledProcessError (127, command, stderr = str(e))
+
+    buffers = {"stdout": [], "stderr": []}
+    def feed_stdin ():
+        try:
+            chunks = [input] if isinstance (input, (str, bytes)) else input
+            for chunk in chunks:
+                proc.stdin.write (chunk.encode() if isinstance(chunk, str) else chunk)
+        except (BrokenPipeError, OSError): pass # program exited before reading all input
+        finally:
+            try: proc.stdin.close()
+            except OSError: pass
+    def read_stream (stream, name):
+        buffers[name].append (stream.read())
+        stream.close()
+    threads = [threading.Thread (target = read_stream, args = (proc.stderr, "stderr"), daemon = True)]
+    if f_out is None: threads.append (threading.Thread (target = read_stream, args = (proc.stdout, "stdout"), daemon = True))
+    if input is not None: threads.append (threading.Thread (target = feed_stdin, daemon = True))
+    for t in threads: t.start()
+
+    timed_out = []
+    def kill_process ():
+        timed_out.append (True)
+        proc.kill()
+    timer = threading.Timer (timeout, kill_process) if timeout else None
+    if timer is not None: timer.start()
+    if hasattr (os, "wait4"): # resource usage of this child only (unlike getrusage(RUSAGE_CHILDREN), which accumulates)
+        _, status, rusage = os.wait4 (proc.pid, 0)
+        proc.returncode = exit_status (status)
+    else:
+        proc.wait()
+        rusage = None
+    if timer is not None: timer.cancel()
+    for t in threads: t.join()
+    if f_out is not None: f_out.close()
+    wall = time.perf_counter() - t_start
+
+    stdout = b"".join(buffers["stdout"]) if f_out is None else None
+    stderr = b"".join(buffers["stderr"])
+    if text:
+        stdout = stdout.decode(errors="replace") if stdout is not None else None
+        stderr = stderr.decode(errors="replace")
+    record_tool_usage (command[0], wall, rusage, proc.returncode)
+    if timed_out:
+        logger.error (f"{command[0]} was killed after {timeout} seconds")
+        if check: raise ToolTimeoutError (proc.returncode, command, output = stdout, stderr = stderr)
+    elif check and proc.returncode != 0:
+        logger.debug (f"{command[0]} failed with exit code {proc.returncode}; stderr:\n{stderr}")
+        raise subprocess.CalledProcessError (proc.returncode, command, output = stdout, stderr = stderr)
+    return stdout, stderr
+
+def record_tool_usage (tool, wall, rusage, returncode):
+    tool = os.path.basename (tool)
+    if rusage is not None:
+        cpu = rusage.ru_utime + rusage.ru_stime
+        # bytes on macOS, kilobytes on linux; on linux it is never smaller than the memory of the caller at fork time
+        maxrss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    else: cpu = maxrss = 0
+    logger.debug (f"{tool}: wall time {wall:.2f}s, CPU time {cpu:.2f}s, peak memory {maxrss/1e6:.1f} MB (exit code {returncode})")
+    if executor_settings["usage_file"] is None: return
+    try: # one short line in append mode is atomic, thus safe with several workers
+        with open (executor_settings["usage_file"], "a") as f:
+            f.write (f"{tool}\t{wall:.4f}\t{cpu:.4f}\t{maxrss}\t{returncode}\n")
+    except OSError: pass
+
+def summarise_tool_usage (remove_file = True):
+    ''' logs number of calls, total wall and CPU time, and peak memory per program '''
+    fname = executor_settings["usage_file"]
+    executor_settings["usage_file"] = None
+    os.environ.pop ("PHYLOBARCODE_TOOL_USAGE_FILE", None)
+    if fname is None or not os.path.isfile (fname): return None # no external program was called
+    stats = collections.OrderedDict()
+    with open (fname) as f:
+        for line in f:
+            tool, wall, cpu, maxrss, returncode = line.rstrip("\n").split("\t")
+            s = stats.setdefault (tool, [0, 0., 0., 0, 0])
+            s[0] += 1; s[1] += float(wall); s[2] += float(cpu); s[3] = max(s[3], int(maxrss))
+            if returncode != "0": s[4] += 1
+    if remove_file:
+        try: os.remove (fname)
+        except OSError: logger.warning (f"Could not remove file {fname} with the time and memory used by external programs")
+    else: logger.info (f"Time and memory used by external programs are in file {fname}")
+    for tool, (n, wall, cpu, maxrss, n_failed) in sorted (stats.items(), key = lambda x: -x[1][1]):
+        failed = f", {n_failed} failed" if n_failed else ""
+        logger.info (f"External program {tool}: {n} calls{failed}, wall time {wall:.1f}s, CPU time {cpu:.1f}s, peak memory {maxrss/1e6:.1f} MB")
+    return stats
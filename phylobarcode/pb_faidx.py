@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+from phylobarcode.pb_common import *  ## imports os, gzip etc.
+from Bio import Seq
+import struct, zlib, bisect
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# random access to fasta files through samtools-compatible sidecar indexes: "<file>.fai" with the position of each
+# sequence in the uncompressed stream, and "<file>.gzi" with the block offsets if the file is BGZF-compressed.
+# Files compressed with regular gzip (or xz, bz2) can be indexed but are read sequentially up to the region
+
+bgzf_max_block_input = 65280 # same as htslib: deflated block plus header must fit in 64kb
+bgzf_eof_block = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def is_bgzf (filename):
+    with open (filename, "rb") as f:
+        head = f.read(16)
+    return len(head) == 16 and head[:4] == b"\x1f\x8b\x08\x04" and head[12:14] == b"BC"
+
+def bgzf_block_offsets (filename):
+    ''' returns list of (compressed, uncompressed) offsets of each BGZF block, reading only block headers and sizes '''
+    offsets = []
+    coffset = uoffset = 0
+    with open (filename, "rb") as f:
+        while True:
+            head = f.read(18)
+            if len(head) < 18: break
+            bsize = struct.unpack("<H", head[16:18])[0] + 1 # BSIZE is total block size minus one
+            f.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", f.read(4))[0] # uncompressed size of this block
+            if isize: offsets.append ((coffset, uoffset)) # last block (EOF marker) is empty
+            coffset += bsize
+            uoffset += isize
+    return offsets
+
+def bgzf_compress_file (infile, outfile, level = 6):
+    ''' (re)compress any fasta file into BGZF format, which is still a valid gzip file '''
+    with open_anyformat (infile, "rb") as f_in, open (outfile, "wb") as f_out:
+        while True:
+            data = f_in.read(bgzf_max_block_input)
+            if not data: break
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # raw deflate, header is written by us
+            cdata = compressor.compress(data) + compressor.flush()
+            bsize = 18 + len(cdata) + 8
+            f_out.write(struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize - 1))
+            f_out.write(cdata)
+            f_out.write(struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+        f_out.write(bgzf_eof_block)
+
+def faidx_entries (filename):
+    ''' scan the (uncompressed) fasta stream once and return list of [name, length, offset, linebases, linewidth] '''
+    entries = []
+    offset = 0
+    current = None
+    last_line = False # if a shorter line was found, it must be the last of the sequence
+    with open_anyformat (filename, "rb") as handle:
+        for line in handle:
+            if line.startswith(b">"):
+                if current is not None: entries.append(current)
+                name = line[1:].split(None, 1)[0].decode("utf-8", errors="replace") if line[1:].strip() else ""
+                current = [name, 0, offset + len(line), 0, 0]
+                last_line = False
+            elif current is not None:
+                nbases = len(line.rstrip(b"\r\n"))
+                at_eof = len(line) == nbases # only the last line of the file may lack the newline
+                if nbases and (last_line or nbases > current[3] > 0 or 
+                        (current[3] and not at_eof and len(line) - nbases != current[4] - current[3])):
+                    raise ValueError(f"sequence {current[0]} in file {filename} does not have lines of same length")
+                if nbases == 0: last_line = True # empty lines are allowed only at the end of the sequence
+                elif current[3] == 0: current[3], current[4] = nbases, len(line) # first line of sequence
+                elif nbases < current[3]: last_line = True
+                current[1] += nbases
+            offset += len(line)
+    if current is not None: entries.append(current)
+    return entries
+
+def build_fasta_index (filename, bgzip = False):
+    ''' creates ".fai" (and ".gzi" if BGZF) indexes; if bgzip=True, gzipped files are recompressed in place as BGZF '''
+    if filename.endswith(".gz") and not is_bgzf (filename):
+        if bgzip:
+            tmpfile = filename + '.tmp.%012x' % random.randrange(16**12)
+            bgzf_compress_file (filename, tmpfile)
+            os.replace (tmpfile, filename)
+        else:
+            logger.debug (f"{filename} is not BGZF compressed, its index will not be used for random access")
+    try:
+        entries = faidx_entries (filename)
+    except ValueError as e:
+        logger.warning (f"Could not index {filename}: {e}")
+        return None
+    with open (filename + ".fai", "w") as f:
+        for e in entries: f.write ("\t".join([str(x) for x in e]) + "\n")
+    if filename.endswith(".gz") and is_bgzf (filename):
+        offsets = bgzf_block_offsets (filename)[1:] # htslib omits first block (0,0)
+        with open (filename + ".gzi", "wb") as f:
+            f.write(struct.pack("<Q", len(offsets)))
+            for c, u in offsets: f.write(struct.pack("<QQ", c, u))
+    elif os.path.isfile (filename + ".gzi"): # stale, from a previous BGZF version of the file
+        os.remove (filename + ".gzi")
+    return len(entries)
+
+def build_fasta_index_list (fasta_file_list, bgzip = False):
+    return [[os.path.basename(f), build_fasta_index (f, bgzip = bgzip)] for f in fasta_file_list]
+
+def has_fasta_index (filename):
+    return os.path.isfile (filename + ".fai") and os.path.getmtime (filename + ".fai") >= os.path.getmtime (filename)
+
+def has_random_access (filename):
+    '''
+    true if file is uncompressed, or BGZF with an up-to-date ".gzi" index. Other compressed files would be decompressed
+    from the beginning for each region, thus it's faster to read the whole sequence once
+    '''
+    if not filename.endswith ((".gz", ".xz", ".bz2", ".zst")): return True
+    gzi = filename + ".gzi"
+    return filename.endswith (".gz") and os.path.isfile (gzi) and os.path.getmtime (gzi) >= os.path.getmtime (filename)
+
+class IndexedFasta:
+    ''' random access to sequences of an indexed fasta file; regions are zero-based, end exclusive '''
+    def __init__ (self, filename):
+        self.filename = filename
+        self.index = {}
+        with open (filename + ".fai", "r") as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+        self.blocks = None # list of uncompressed offsets and list of compressed offsets
+        if has_random_access (filename) and os.path.isfile (filename + ".gzi"): # o.w. gzi is stale
+            with open (filename + ".gzi", "rb") as f:
+                n = struct.unpack("<Q", f.read(8))[0]
+                pairs = [(0, 0)] + [struct.unpack("<QQ", f.read(16)) for _ in range(n)]
+            self.blocks = ([u for c, u in pairs], [c for c, u in pairs])
+
+    def __contains__ (self, seqid): return seqid in self.index
+
+    def __getitem__ (self, seqid): return IndexedSequence (self, seqid)
+
+    def length (self, seqid): return self.index[seqid][0]
+
+    def _read_bytes (self, offset, n_bytes):
+        if self.blocks is not None: # BGZF: jump to block containing offset
+            i = bisect.bisect_right (self.blocks[0], offset) - 1
+            with open (self.filename, "rb") as f:
+                f.seek (self.blocks[1][i])
+                with gzip.GzipFile (fileobj=f) as g:
+                    g.read (offset - self.blocks[0][i])
+                    return g.read (n_bytes)
+        with open_anyformat (self.filename, "rb") as f: # plain files seek directly; compressed ones decompress until offset
+            f.seek (offset)
+            return f.read (n_bytes)
+
+    def fetch (self, seqid, start = 0, end = None, clean_sequence = True):
+        length, offset, linebases, linewidth = self.index[seqid]
+        if end is None or end > length: end = length
+        if start < 0: start = 0
+        if start >= end: return ""
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last  = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases
+        sequence = self._read_bytes (first, last - first + 1).translate(None, b" \t\r\n")
+        if clean_sequence: sequence = sequence.upper().replace(b".", b"N")
+        return sequence.decode("ascii", errors="replace")
+
+class IndexedSequence:
+    ''' behaves like a Seq object for len() and slicing, but only reads the requested region from disk '''
+    def __init__ (self, indexed_fasta, seqid):
+        self.fasta = indexed_fasta
+        self.seqid = seqid
+
+    def __len__ (self): return self.fasta.length (self.seqid)
+
+    def __getitem__ (self, key):
+        if not isinstance (key, slice) or key.step not in [None, 1]:
+            raise TypeError ("IndexedSequence only accepts contiguous slices")
+        start, end, _ = key.indices (len(self))
+        return Seq.Seq (self.fasta.fetch (self.seqid, start, end))
+
+def genome_sequence_from_fasta (filename, seqid):
+    '''
+    uses the fasta index if present and the file allows random access (reading only the regions requested), o.w. reads
+    the whole sequence (decompressing the file once)
+    '''
+    if has_fasta_index (filename) and has_random_access (filename):
+        fasta = IndexedFasta (filename)
+        if seqid in fasta: return fasta[seqid]
+    return read_fasta_sequence_by_id (filename, seqid)
+
+class GenomePrefetcher:
+    '''
+    iterates over genome sequences in the given order while background threads already load (read and decompress)
+    the next ones, s.t. disk or network reads overlap with the work on the current genome. `loader(key)` returns the
+    sequence of each key. At most `depth` genomes are loaded ahead, and no new load starts while sequences loaded but
+    not yet consumed use more than `memory_budget` bytes (thus memory is bounded by budget plus `depth` genomes).
+    '''
+    def __init__ (self, keys, loader, depth = 4, nthreads = 2, memory_budget = 1 << 29):
+        import threading
+        self.keys = list(keys)
+        self.loader = loader
+        self.depth = max(0, depth)
+        self.nthreads = max(1, min(nthreads, self.depth))
+        self.memory_budget = memory_budget
+        self.buffered = 0 # bytes loaded and not yet consumed
+        self.lock = threading.Lock()
+
+    def _load (self, key):
+        sequence = self.loader (key)
+        size = 0 if isinstance (sequence, IndexedSequence) or sequence is None else len(sequence) # indexed are lazy
+        with self.lock: self.buffered += size
+        return sequence, size
+
+    def __iter__ (self):
+        if self.depth == 0: # no prefetching
+            for key in self.keys: yield key, self.loader (key)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        pending = collections.deque()
+        next_key = 0
+        executor = ThreadPoolExecutor (max_workers = self.nthreads, thread_name_prefix = "prefetch")
+        try:
+            while next_key < len(self.keys) or pending:
+                while next_key < len(self.keys) and len(pending) <= self.depth and (self.buffered < self.memory_budget or not pending):
+                    pending.append ((self.keys[next_key], executor.submit (self._load, self.keys[next_key])))
+                    next_key += 1
+                key, future = pending.popleft()
+                sequence, size = future.result() # re-raises any error from loader
+                yield key, sequence
+                with self.lock: self.buffered -= size
+        finally: # also if caller stops early
+            for _, future in pending: future.cancel()
+            executor.shutdown (wait = True)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+from phylobarcode.pb_common import *  ## imports os, pathlib etc.
+from phylobarcode import pb_seqkernel
+from Bio import Seq
+import numpy as np, functools
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# compact genome store shared by all workers through memory mapping: bases are packed in 2 bits (A=0, C=1, G=2, T=3),
+# with sequences starting at a byte boundary, and non-ACGT runs kept in a sparse mask. Directory contents are:
+#   bases.2bit   packed bases of all sequences, one after the other
+#   index.tsv    fasta_file, seqid, length, byte offset in bases.2bit, and first/last rows in mask arrays
+#   mask.npy     (start, end) of each run of same non-ACGT character, zero-based and relative to sequence
+#   mask_chars.npy  character of each run (usually "N")
+
+store_code = np.zeros(256, dtype=np.uint8) # A,C,G,T have codes 0,1,2,3; all others get zero but are masked
+store_valid = np.zeros(256, dtype=bool)
+for i, nuc in enumerate(b"ACGT"):
+    store_code[nuc] = i
+    store_valid[nuc] = True
+store_letters = np.frombuffer(b"ACGT", dtype=np.uint8)
+store_complement = pb_seqkernel.complement_table # also complements masked (IUPAC) characters
+
+def pack_sequence (sequence):
+    ''' returns packed bases (uint8 with 4 bases per byte), mask runs, and mask characters from sequence string'''
+    seq = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+    codes = store_code[seq]
+    pad = (-len(codes)) % 4
+    if pad: codes = np.concatenate([codes, np.zeros(pad, dtype=np.uint8)])
+    codes = codes.reshape(-1, 4)
+    packed = (codes[:,0] << 6) | (codes[:,1] << 4) | (codes[:,2] << 2) | codes[:,3]
+    # runs of same non-ACGT character
+    masked = np.flatnonzero(~store_valid[seq])
+    if len(masked) == 0:
+        return packed.astype(np.uint8), np.zeros((0,2), dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    breaks = np.flatnonzero((np.diff(masked) != 1) | (seq[masked[1:]] != seq[masked[:-1]])) + 1
+    starts = masked[np.concatenate([[0], breaks])]
+    ends = masked[np.concatenate([breaks - 1, [len(masked) - 1]])] + 1
+    return packed.astype(np.uint8), np.stack([starts, ends], axis=1).astype(np.int64), seq[starts]
+
+def pack_fasta_file_list (fasta_file_list):
+    ''' returns list of [fasta_file, seqid, packed, mask, mask_chars] for all sequences in files '''
+    packed = []
+    for fas in fasta_file_list:
+        for description, sequence in fasta_iterator (fas): # uppercase and "." replaced by "N" as in read_fasta_as_list
+            seqid = description.split(None, 1)[0] if description else ""
+            packed.append ([os.path.basename(fas), seqid, len(sequence), *pack_sequence (sequence)])
+    return packed
+
+def write_genome_store (storedir, packed_chunks):
+    ''' packed_chunks is an iterable of lists returned by pack_fasta_file_list(), s.t. we can use Pool.imap() '''
+    pathlib.Path(storedir).mkdir(parents=True, exist_ok=True)
+    offset = n_mask = 0
+    masks, mask_chars = [], []
+    seen = set()
+    with open (os.path.join(storedir, "bases.2bit"), "wb") as f_bases, open (os.path.join(storedir, "index.tsv"), "w") as f_idx:
+        f_idx.write ("fasta_file\tseqid\tlength\toffset\tmask_start\tmask_end\n")
+        for chunk in packed_chunks:
+            for fasta_file, seqid, length, bases, mask, chars in chunk:
+                if seqid in seen:
+                    logger.warning (f"Sequence {seqid} from {fasta_file} was already stored from another file; skipping")
+                    continue
+                seen.add (seqid)
+                f_bases.write (bases.tobytes())
+                f_idx.write (f"{fasta_file}\t{seqid}\t{length}\t{offset}\t{n_mask}\t{n_mask + len(mask)}\n")
+                offset += len(bases)
+                n_mask += len(mask)
+                masks.append (mask)
+                mask_chars.append (chars)
+    np.save (os.path.join(storedir, "mask.npy"), np.concatenate(masks) if masks else np.zeros((0,2), dtype=np.int64))
+    np.save (os.path.join(storedir, "mask_chars.npy"), np.concatenate(mask_chars) if mask_chars else np.zeros(0, dtype=np.uint8))
+    return len(seen), offset
+
+class GenomeStore:
+    ''' read-only, memory-mapped access to a genome store created by `pack_fasta` '''
+    def __init__ (self, storedir):
+        self.storedir = storedir
+        self.index = {}
+        with open (os.path.join(storedir, "index.tsv"), "r") as f:
+            next(f) # header
+            for line in f:
+                fasta_file, seqid, length, offset, m0, m1 = line.rstrip("\n").split("\t")
+                self.index[seqid] = (int(length), int(offset), int(m0), int(m1))
+        bases_file = os.path.join(storedir, "bases.2bit")
+        if os.path.getsize (bases_file): self.bases = np.memmap (bases_file, dtype=np.uint8, mode="r")
+        else: self.bases = np.zeros(0, dtype=np.uint8)
+        self.mask = np.load (os.path.join(storedir, "mask.npy"), mmap_mode="r")
+        self.mask_chars = np.load (os.path.join(storedir, "mask_chars.npy"), mmap_mode="r")
+
+    def __contains__ (self, seqid): return seqid in self.index
+
+    def __getitem__ (self, seqid): return StoredSequence (self, seqid)
+
+    def length (self, seqid): return self.index[seqid][0]
+
+    def _region_codes (self, offset, start, end):
+        packed = self.bases[offset + start // 4 : offset + (end + 3) // 4] # view, no copy of the memory map
+        codes = np.empty(4 * len(packed), dtype=np.uint8)
+        for i, shift in enumerate([6, 4, 2, 0]): codes[i::4] = (packed >> shift) & 3
+        return codes[start % 4 : start % 4 + end - start]
+
+    def fetch (self, seqid, start = 0, end = None, reverse_complement = False):
+        ''' returns sequence string from zero-based region [start, end); end beyond length wraps around the genome '''
+        length, offset, m0, m1 = self.index[seqid]
+        if end is None: end = length
+        start = max(start, 0)
+        end = min(end, start + length) # circular genome: at most one full turn
+        if start >= length or start >= end: return ""
+        pieces = [(start, min(end, length))] # if end > length we slice across the origin, without copying the genome
+        if end > length: pieces.append ((0, end - length))
+        letters = np.concatenate([store_letters[self._region_codes (offset, s, e)] for s, e in pieces])
+        pos = 0
+        for s, e in pieces: # apply mask of non-ACGT characters overlapping the region
+            runs = self.mask[m0:m1]
+            first = np.searchsorted (runs[:,1], s, side="right") if len(runs) else 0
+            for (r_s, r_e), char in zip(runs[first:], self.mask_chars[m0+first:m1]):
+                if r_s >= e: break
+                letters[pos + max(r_s, s) - s : pos + min(r_e, e) - s] = char
+            pos += e - s
+        if reverse_complement: letters = store_complement[letters[::-1]]
+        return letters.tobytes().decode("ascii")
+
+def open_genome_store (storedir):
+    ''' GenomeStore reused by all calls in this process (e.g. all batches of a pool worker); reopened if rebuilt '''
+    return cached_genome_store (os.path.abspath (storedir), os.stat (os.path.join(storedir, "index.tsv")).st_mtime_ns)
+
+@functools.lru_cache(maxsize=4)
+def cached_genome_store (storedir, mtime): return GenomeStore (storedir) # mtime is only part of the key
+
+class StoredSequence:
+    ''' behaves like a Seq object for len() and slicing, decoding only the requested region from the store '''
+    def __init__ (self, store, seqid):
+        self.store = store
+        self.seqid = seqid
+
+    def __len__ (self): return self.store.length (self.seqid)
+
+    def __getitem__ (self, key):
+        if not isinstance (key, slice) or key.step not in [None, 1]:
+            raise TypeError ("StoredSequence only accepts contiguous slices")
+        start, end, _ = key.indices (len(self))
+        return Seq.Seq (self.store.fetch (self.seqid, start, end))
+
+    def circular_slice (self, start, end, reverse_complement = False):
+        ''' zero-based, end exclusive; end can go beyond genome length '''
+        return Seq.Seq (self.store.fetch (self.seqid, start, end, reverse_complement = reverse_complement))
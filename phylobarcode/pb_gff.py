@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+from phylobarcode.pb_common import *  ## imports os, open_anyformat etc.
+from urllib.parse import unquote
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# streaming GFF3 readers, scanning each (possibly compressed) file once instead of building a gffutils sqlite database.
+# Attributes are parsed as in gffutils: each value is a list (split at commas) with URL escapes like "%2C" decoded.
+# Malformed lines raise ValueError, s.t. callers can fall back to gffutils.
+
+def gff3_attributes (column, keys = None):
+    ''' 
+    dict of lists from the 9th column of a GFF3 line, e.g. "ID=id0;Dbxref=taxon:562;strain=K-12"; if `keys` is given
+    then only these attributes are decoded and returned
+    '''
+    attributes = {}
+    for field in column.strip().split(";"):
+        if not field: continue
+        key, equal, value = field.partition("=")
+        if not equal: raise ValueError (f"attribute without value: {field}")
+        key = key.strip()
+        if keys is None or key in keys: attributes[key] = [unquote(v) for v in value.split(",")]
+    return attributes
+
+def gff_feature_columns (line):
+    ''' splits a GFF3 feature line into its 9 columns, with integer start and end (one-based, as in the file) '''
+    fields = line.rstrip("\r\n").split("\t")
+    if len(fields) != 9: raise ValueError (f"GFF3 line with {len(fields)} columns instead of 9: {line[:64]}")
+    fields[3], fields[4] = int(fields[3]), int(fields[4])
+    return fields
+
+def gff_region_elements (gff_file):
+    '''
+    returns list of (seqid, start, attributes) for the `region` features of a GFF3 file, sorted by start as in
+    gffutils. If sequences are declared in "##sequence-region" directives (like in NCBI files) then the file is read
+    only until a region was found for each of them (usually the first lines)
+    '''
+    declared = set()
+    found = set()
+    regions = []
+    with open_anyformat (gff_file, "r") as handle:
+        for line in handle:
+            if line.startswith("#"):
+                if line.startswith("##sequence-region"):
+                    fields = line.split()
+                    if len(fields) > 1: declared.add (fields[1])
+                elif line.startswith("##FASTA"): break # sequences may follow the features
+                continue
+            if "\tregion\t" not in line: continue # avoids splitting most lines (genes, CDS etc.)
+            fields = gff_feature_columns (line)
+            if fields[2] != "region": continue
+            regions.append ((fields[0], fields[3], gff3_attributes (fields[8])))
+            found.add (fields[0])
+            if declared and declared <= found: break
+    regions.sort (key = lambda x: x[1]) # stable sort
+    return regions
+
+def gff_region_elements_gffutils (gff_file, database_file):
+    ''' same as gff_region_elements() but using gffutils (slower, but more tolerant with malformed files) '''
+    import gffutils
+    db = gffutils.create_db (gff_file, database_file, merge_strategy='create_unique', keep_order=True, force=True) # force to overwrite existing db
+    return [(ft.seqid, ft.start, dict(ft.attributes)) for ft in db.features_of_type('region', order_by='start')]
+
+def gff_cds_features (gff_file, keys = ("ID", "gene", "product")):
+    '''
+    returns list of [seqid, start, end, strand, attributes] for each CDS in a GFF3 file (one-based coordinates), with
+    only the attributes in `keys`. As gffutils with merge_strategy="merge", lines with same ID and same columns (e.g.
+    repeated lines) become one feature, at its first position and with unique attribute values. But values are kept in
+    file order, while gffutils uses a set (s.t. e.g. the first product would change between runs)
+    '''
+    return gff_regions_and_cds_features (gff_file, keys)[1]
+
+def gff_regions_and_cds_features (gff_file, keys = ("ID", "gene", "product")):
+    '''
+    single pass over a GFF3 file, returning both the region elements (as gff_region_elements()) and the CDS features 
+    (as gff_cds_features()). The whole file is read, since the CDS lines come after the regions
+    '''
+    regions = []
+    features = []
+    merged = {} # (ID and columns) -> position in features
+    keys = set(keys) | {"ID"}
+    with open_anyformat (gff_file, "r") as handle:
+        for line in handle:
+            if line.startswith("#"):
+                if line.startswith("##FASTA"): break # sequences may follow the features
+                continue
+            if "\tCDS\t" in line: # avoids splitting all other lines
+                fields = gff_feature_columns (line)
+                if fields[2] != "CDS": continue
+                attributes = gff3_attributes (fields[8], keys = keys)
+                if "ID" in attributes:
+                    key = (attributes["ID"][0], *fields[:8])
+                    if key in merged:
+                        old = features[merged[key]][4]
+                        features[merged[key]][4] = {k: list(dict.fromkeys (old.get(k, []) + attributes.get(k, []))) for k in {**old, **attributes}}
+                        continue
+                    merged[key] = len(features)
+                features.append ([fields[0], fields[3], fields[4], fields[6], attributes])
+            elif "\tregion\t" in line:
+                fields = gff_feature_columns (line)
+                if fields[2] == "region": regions.append ((fields[0], fields[3], gff3_attributes (fields[8])))
+    regions.sort (key = lambda x: x[1]) # stable sort
+    return regions, features
+
+def gff_cds_features_gffutils (gff_file, database_file):
+    ''' same as gff_cds_features() but using gffutils (slower, but more tolerant with malformed files) '''
+    import gffutils
+    db = gffutils.create_db(gff_file, dbfn=database_file, force=True, keep_order=False, merge_strategy="merge", sort_attribute_values=False)
+    return [[ft.seqid, ft.start, ft.end, ft.strand, dict(ft.attributes)] for ft in db.features_of_type('CDS')]
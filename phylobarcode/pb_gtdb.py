@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import os, logging, tarfile, tempfile, xxhash
+from phylobarcode import pb_cache, pb_manifest
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# GTDB metadata (e.g. bac120_metadata_r207.tar.gz, with hundreds of thousands of rows and more than 100 columns) is read
+# directly from the released tarball (or from the extracted, possibly compressed, tsv file), parsing only the columns
+# we need. Columns with repeated values (taxonomy, representative genomes) are stored as categoricals, and the table is
+# cached as a pickle file (in the same cache as the external programs) under the digest of the metadata file.
+
+gtdb_columns = ['accession', 'gtdb_genome_representative', 'gtdb_taxonomy', 'ssu_query_id', 'ncbi_assembly_name',
+        'ncbi_genbank_assembly_accession', 'ncbi_strain_identifiers', 'ncbi_taxid', 'ncbi_taxonomy'] #  'ncbi_taxonomy_unfiltered' is not used
+categorical_columns = ['gtdb_genome_representative', 'gtdb_taxonomy', 'ncbi_taxid', 'ncbi_taxonomy']
+cache_format_version = 1 # change if the cached table changes
+
+def read_gtdb_metadata_file (gtdb_file, columns = None):
+    ''' dataframe with the (string) columns of the GTDB metadata, from the tsv file or from the first tsv in a tarball '''
+    import pandas as pd
+    if columns is None: columns = gtdb_columns
+    if not tarfile.is_tarfile (gtdb_file):
+        return pd.read_csv (gtdb_file, sep="\t", usecols=columns, dtype=str)[columns]
+    with tarfile.open (gtdb_file, "r:*") as tar: # members are read in order, and decompressed while parsed
+        for member in tar:
+            if member.isfile() and member.name.endswith (".tsv"):
+                logger.info (f"Reading GTDB metadata from {member.name} within {gtdb_file}")
+                return pd.read_csv (tar.extractfile (member), sep="\t", usecols=columns, dtype=str)[columns]
+    raise ValueError (f"No tsv file found in {gtdb_file}")
+
+def gtdb_cache_key (gtdb_file, columns):
+    if not pb_cache.cache_settings["enabled"]: return None
+    h = xxhash.xxh3_128()
+    h.update (f"{cache_format_version}\n{columns}\n{pb_manifest.file_digest (gtdb_file)}\n".encode())
+    return f"gtdb-{h.hexdigest()}"
+
+def read_gtdb_metadata (gtdb_file, columns = None):
+    ''' same as read_gtdb_metadata_file() but with categorical columns, and using the cache if possible '''
+    import pandas as pd
+    if columns is None: columns = gtdb_columns
+    key = gtdb_cache_key (gtdb_file, columns)
+    with tempfile.TemporaryDirectory () as tmpdir:
+        pickle_file = os.path.join (tmpdir, "gtdb.pkl")
+        if pb_cache.cache_fetch (key, {"gtdb.pkl": pickle_file}):
+            return pd.read_pickle (pickle_file)
+        df = read_gtdb_metadata_file (gtdb_file, columns)
+        for col in categorical_columns:
+            if col in df.columns: df[col] = df[col].astype ("category")
+        if key is not None:
+            df.to_pickle (pickle_file)
+            pb_cache.cache_store (key, {"gtdb.pkl": pickle_file})
+    return df
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json?
+from phylobarcode import pb_seqkernel
 import copy
 
 logger = logging.getLogger("phylobarcode_global_logger")
@@ -9,13 +10,14 @@ class single_kmer:
     seq = None 
     k = None
     size = 0
-    def __init__(self, seq=None, k=None):
+    def __init__(self, seq=None, k=None, kmers=None):
         if isinstance(seq, str): 
             self.seq = str(seq)
             self.kmers = set()
             if k is None: self.k = 4
             else:         self.k = k
-            self.set_kmers()
+            if kmers is None: self.set_kmers()
+            else: self.kmers = kmers # precalculated by single_kmer_list()
             self.size = len(self.kmers)
         elif isinstance(seq, single_kmer):
             self.seq = copy.deepcopy(seq.seq)
@@ -24,10 +26,7 @@ class single_kmer:
             self.size = seq.size
 
     def set_kmers (self):
-        kmer_list = []
-        for i in range(len(self.seq)-self.k + 1):
-            kmer_list.append ( xxhash.xxh64_intdigest(self.seq[i:i+self.k]) )
-        self.kmers = set (kmer_list)
+        self.kmers = pb_seqkernel.kmer_sets ([self.seq], self.k)[0] # 2-bit codes, or xxhash if not ACGT
         return
 
     def get_kmers (self): return self.kmers
@@ -50,12 +49,18 @@ class single_kmer:
         minsize = min(self.get_size(), other.get_size())
         return intrsc/unin, intrsc/minsize
 
+def single_kmer_list (sequences, k):
+    ''' list of single_kmer objects, where k-mers of all strings are calculated in a single batch '''
+    strings = [seq for seq in sequences if isinstance(seq, str)]
+    kmer_sets = iter(pb_seqkernel.kmer_sets (strings, k))
+    return [single_kmer(seq, k=k, kmers=next(kmer_sets)) if isinstance(seq, str) else seq for seq in sequences]
+
 def cluster_single_kmers (sequences, length=None, threshold=0.5, use_centroid=True, jaccard=True):
     if not isinstance (sequences, list): sequences = [sequences]
     if length is None:
         if isinstance (sequences[0], single_kmer):length = sequences[0].get_k() 
         else: length = 5 
-    kmers = [single_kmer(seq, k=length) if isinstance(seq, str) else seq for seq in sequences]
+    kmers = single_kmer_list (sequences, length)
     if jaccard is True: element = 0 ## which element from `similarity` to use
     else:               element = 1
     clusters = []
@@ -116,7 +121,7 @@ def cluster_single_kmers_parallel (sequences, length=None, threshold=None, jacca
 #    centroid_chunks = [res[2] for res in results]
 #    cluster_chunks = [[[ind[j] for j in i] for i in res[1]] for ind,res in zip(original_indices, results)]
 
-    kmers = [single_kmer(seq, k=length) if isinstance(seq, str) else seq for seq in sequences]
+    kmers = single_kmer_list (sequences, length)
     n_kmers = len(kmers)
     cluster_chunks = [ [[j] for j in range(i, n_kmers, 2 * nthreads)] for i in range(2 * nthreads)]
     centroid_chunks = [ [kmers[i[0]] for i in chunk] for chunk in cluster_chunks]
@@ -1,6 +1,7 @@
 import os, logging, argparse, sys, pathlib, multiprocessing, datetime, itertools, pathlib, random
 from phylobarcode.__version__ import __version__
 from phylobarcode.pb_common import *
+from phylobarcode import pb_cache, pb_executor
 
 stream_log = logging.StreamHandler()
 #log_format = logging.Formatter(fmt='phylobarcode___main %(asctime)s [%(levelname)s] %(message)s', datefmt="%Y-%m-%d%H:%M") # now it's shared 
@@ -41,12 +42,40 @@ def generate_prefix_for_task (args, taskname):
     else:
         args.prefix = os.path.join(defaults["current_dir"], f"pb.{defaults['timestamp']}_{taskname}")
 
+def rank_count (text):
+    ''' argparse type for "rank:N", e.g. "genus:5" '''
+    ranks = ["phylum", "class", "order", "family", "genus", "species"]
+    rank, _, count = text.partition(":")
+    if rank not in ranks or not count.isdigit() or int(count) < 1:
+        raise argparse.ArgumentTypeError (f"'{text}' is not of the form rank:N, with N > 0 and rank one of {ranks}")
+    return (rank, int(count))
+
+def stratified_sampler (args):
+    ''' genome sampler from the `--sample_max` and `--sample_min` options, or None if not used '''
+    if args.sample_max is None and args.sample_min is None: return None
+    from phylobarcode import pb_taxonomy
+    return pb_taxonomy.StratifiedSampler (max_per = args.sample_max, min_per = args.sample_min, seed = args.sample_seed)
+
 def run_merge_fasta_gff (args):
     from phylobarcode import task_fasta_gff
     generate_prefix_for_task (args, "fastagff")
     if not args.nthreads: args.nthreads = defaults["nthreads"]
+    jsonfiles = {"riboproteins": defaults["json_riboproteins"], "ribogenes": defaults["json_ribogenes"], "extragenes": defaults["json_extragenes"]}
     task_fasta_gff.merge_fasta_gff (fastadir=args.fasta, gffdir=args.gff, fasta_tsvfile = args.tsv_fasta, 
-            gff_tsvfile = args.tsv_gff, scratch=args.scratch, gtdb = args.gtdb, output=args.prefix, nthreads = args.nthreads)
+            gff_tsvfile = args.tsv_gff, scratch=args.scratch, gtdb = args.gtdb, output=args.prefix, 
+            coordinates = args.coordinates, jsonfiles = jsonfiles, dedup = args.dedup, max_n = args.max_n, 
+            min_length = args.min_length, unique = args.unique, nthreads = args.nthreads)
+
+def run_index_fasta (args):
+    from phylobarcode import task_fasta_gff
+    if not args.nthreads: args.nthreads = defaults["nthreads"]
+    task_fasta_gff.index_fasta_files (fastadir=args.fasta, bgzip = args.bgzip, nthreads = args.nthreads)
+
+def run_pack_fasta (args):
+    from phylobarcode import task_fasta_gff
+    generate_prefix_for_task (args, "store")
+    if not args.nthreads: args.nthreads = defaults["nthreads"]
+    task_fasta_gff.pack_fasta_files (fastadir=args.fasta, storedir = args.prefix, nthreads = args.nthreads)
 
 def run_extract_coordinates_from_gff (args):
     from phylobarcode import task_extract_riboprot_gff
@@ -64,6 +93,7 @@ def run_extract_operons_from_fasta (args):
     task_extract_riboprot_fasta.extract_operons_from_fasta (coord_tsvfile = args.coords, merge_tsvfile = args.tsv, 
             fastadir=args.fasta, output=args.prefix, intergenic_space = args.intergenic, short_operon = args.short,
             most_common_mosaics = args.most_common, border = args.border, riboprot_subset = args.subset,
+            genome_store = args.store, prefetch = args.prefetch, sampler = stratified_sampler (args), 
             nthreads=args.nthreads, scratch=args.scratch)
 
 def run_extract_genes_from_fasta (args):
@@ -72,7 +102,7 @@ def run_extract_genes_from_fasta (args):
     if not args.nthreads: args.nthreads = defaults["nthreads"]
     task_extract_riboprot_fasta.extract_genes_from_fasta (coord_tsvfile = args.coords, merge_tsvfile = args.tsv,
             fastadir=args.fasta, output=args.prefix, scratch=args.scratch, keep_paralogs = args.paralogs, 
-            nthreads=args.nthreads)
+            genome_store = args.store, prefetch = args.prefetch, sampler = stratified_sampler (args), nthreads=args.nthreads)
 
 def run_cluster_align_genes (args):
     from phylobarcode import task_align
@@ -87,7 +117,7 @@ def run_estimate_compare_trees (args):
     if not args.nthreads: args.nthreads = defaults["nthreads"]
     task_align.estimate_compare_trees (alnfiles=args.fasta, output=args.prefix, nthreads=args.nthreads, 
             tsvfile = args.taxon, gtdb_tree = args.tree, prev_tsv = args.stats, rapidnj = args.rapidnj, 
-            scratch=args.scratch)
+            matrix_free = args.matrix_free, scratch=args.scratch)
 
 def run_find_primers (args):
     from phylobarcode import task_find_primers
@@ -95,12 +125,12 @@ def run_find_primers (args):
     if args.nthreads and args.nthreads < 2:
         logger.info("Single-threaded mode requested by user")
         task_find_primers.find_primers (fastafile=args.fasta, primer_opt_size=args.length, border=args.border, 
-                num_return=args.n_primers, output=args.prefix)
+                num_return=args.n_primers, taxon=args.taxon, output=args.prefix, sampler=stratified_sampler (args))
         return
     if defaults["nthreads"] < 2:
         logger.warning("Multiprocessing not available, falling back to single-threaded mode")
         task_find_primers.find_primers (fastafile=args.fasta, primer_opt_size=args.length, border=args.border, 
-                num_return=args.n_primers, output=args.prefix)
+                num_return=args.n_primers, taxon=args.taxon, output=args.prefix, sampler=stratified_sampler (args))
         return
 
     if not args.nthreads: 
@@ -109,7 +139,8 @@ def run_find_primers (args):
     else:
         logger.info(f"{args.nthreads} threads were requested by user (actual pool may be smaller)")
     task_find_primers.find_primers_parallel (fastafile=args.fasta, primer_opt_size=args.length, border=args.border, 
-            num_return=args.n_primers, taxon=args.taxon, output=args.prefix, nthreads=args.nthreads)
+            num_return=args.n_primers, taxon=args.taxon, output=args.prefix, sampler=stratified_sampler (args),
+            nthreads=args.nthreads)
     return
 
 def run_cluster_flanks (args):
@@ -223,14 +254,30 @@ def main():
             help="Existing scratch directory (i.e. path must exist). Default: working directory")
     parent_group.add_argument('--prefix', metavar="string", 
             help="optional file name --- just the prefix, since suffixes (a.k.a. extensions) are added by the program")
+    parent_group.add_argument('--compression', choices=["fast", "default", "best"], 
+            help="Compression level of output files, from faster to smaller (default = 'default' or env variable PHYLOBARCODE_COMPRESSION)")
+    parent_group.add_argument('--no-cache', dest="no_cache", action="store_true", default=False,
+            help="Do not use (or store) cached results from mafft, cd-hit, FastTree, rapidnj and GTDB metadata (default=use cache at\n"
+            "~/.cache/phylobarcode or env variable PHYLOBARCODE_CACHE, limited to PHYLOBARCODE_CACHE_SIZE MB)")
+    parent_group.add_argument('--tool_timeout', metavar='seconds', type=float, 
+            help="Kill external programs (mafft, blast etc.) running longer than this (default=no limit)")
     parent_group.add_argument('--version', action='version', version=f"%(prog)s {__version__}") ## called with subcommands
 
+    sample_parser = ParserWithErrorHelp(add_help=False) # for commands working on (possibly many) genomes
+    sample_group = sample_parser.add_argument_group('Stratified subsampling of genomes (from the GTDB taxonomy of the merged table)')
+    sample_group.add_argument('--sample_max', metavar="rank:N", type=rank_count,
+            help="use at most N genomes per taxon of this rank, e.g. genus:5 (default=all genomes)")
+    sample_group.add_argument('--sample_min', metavar="rank:M", type=rank_count,
+            help="with `--sample_max`, add genomes s.t. each taxon of this rank has at least M of them (if available),\n"
+            "e.g. phylum:20; used alone, M genomes are chosen per taxon")
+    sample_group.add_argument('--sample_seed', metavar="int", type=int, default=0,
+            help="random seed for the subsampling; the same seed chooses the same genomes in all commands (default=0)")
+
     # alternative to subp= parent_parser.add_subparsers(dest='command', description=None, title="Commands")
     main_parser = ParserWithErrorHelp(description=long_description, formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
     main_parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}") ## called without  subcommands (grouped together with --help)
     subp= main_parser.add_subparsers(dest='Commands', description=None, title="Commands", required=True)
 
-    # TODO: deduplicate (using genus+sourmash)
     this_help = "Given one folder with fasta, one with GFF files of reference genomes, and a GTDB metadata file, creates a table with matches. "
     extra_help= '''\n
     The fasta and GFF files are recognised by their extensions (fasta, fna, faa, gff, gff3) with optional compression.
@@ -240,6 +287,8 @@ def main():
     tables. However the information from the GTDB metadata file is required in downstream analyses, and thus the final
     table with matches is only generated if a GTDB metadata file is provided.
     Notice that we use TSV instead of CSV because the latter is not compatible with NCBI taxonomy shenanigans (commas in names).
+    The fasta table also has the length, fraction of Ns, GC content, number of contigs in the file, and a hash of each
+    sequence, which are used by the QC filters (options `--max_n`, `--min_length`, and `--unique`) on the final table.
     '''
     up_findp = subp.add_parser('merge_fasta_gff', help=this_help, description=this_help + extra_help, parents=[parent_parser], 
             formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
@@ -248,9 +297,51 @@ def main():
     up_findp.add_argument('-g', '--gff',   metavar="<dir>", required=True, help="directory with GFF3 files (required)")
     up_findp.add_argument('-A', '--tsv_fasta', metavar="tsv", help="tsv file with fasta entries from previous run (optional)")
     up_findp.add_argument('-G', '--tsv_gff',   metavar="tsv", help="tsv file with GFF entries from previous run (optional)")
-    up_findp.add_argument('-d', '--gtdb', metavar="tsv[.xz,.gz]", help="GTDB metadata tsv file (optional but needed downstream)")
+    up_findp.add_argument('-d', '--gtdb', metavar="tsv[.xz,.gz]|tar.gz", help="GTDB metadata tsv file, or released tarball (optional but needed downstream)")
+    up_findp.add_argument('-c', '--coordinates', action="store_true", default=False,
+            help="also extract riboprotein coordinates while reading the GFF files (same as `extract_coordinates`, which \n"
+            "is then not needed)")
+    up_findp.add_argument('-D', '--dedup', metavar="float", type=float, default=None,
+            help="cluster genomes of the same GTDB species with estimated ANI (from MinHash sketches) above this value,\n"
+            "e.g. 0.995, and mark one representative per cluster in the final table (default=no deduplication)")
+    up_findp.add_argument('-N', '--max_n', metavar="float", type=float, default=None,
+            help="exclude genomes with a higher percentage of Ns, e.g. 1 for 1%% (default=no limit)")
+    up_findp.add_argument('-L', '--min_length', metavar="int", type=int, default=None,
+            help="exclude genomes shorter than this (sum of all sequences in the fasta file; default=no limit)")
+    up_findp.add_argument('-u', '--unique', action="store_true", default=False,
+            help="exclude sequences identical to another one, keeping first those from GTDB representatives (default=keep all)")
     up_findp.set_defaults(func = run_merge_fasta_gff)
 
+    this_help = "Creates random-access indexes (samtools-like .fai and .gzi) for the fasta files in a directory"
+    extra_help= '''\n
+    The operon and gene extraction commands will use these indexes (if present and newer than the fasta file) to read
+    only the regions they need, instead of decompressing and parsing the whole genome file. 
+    Uncompressed and BGZF-compressed files allow direct access to the regions; files compressed with regular gzip can be
+    recompressed in place into BGZF (option `--bgzip`), which is still a valid gzip file. Other compressed files (e.g.
+    regular gzip or xz) can be indexed, but the index is not used since each access would decompress the file from
+    the beginning (the whole sequence is read once instead).
+    '''
+    up_findp = subp.add_parser('index_fasta', help=this_help, description=this_help + extra_help, parents=[parent_parser],
+            formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
+    up_findp.add_argument('-a', '--fasta', metavar="<dir>", required=True, 
+            help="directory where fasta genomic files can be found (required)")
+    up_findp.add_argument('-b', '--bgzip', action="store_true", default=False,
+            help="recompress gzipped files into BGZF format, allowing for random access (default=only index)")
+    up_findp.set_defaults(func = run_index_fasta)
+
+    this_help = "Packs all fasta files from a directory into a compact, memory-mapped genome store"
+    extra_help= '''\n
+    The store keeps the bases in 2 bits each, plus a list of positions with other characters (like N). It is created
+    once, and can then be used by `extract_operons` and `extract_genes` (option `--store`) instead of decompressing the
+    fasta files, with all workers sharing the same memory. Sequences not found in the store are read from the fasta files.
+    The store is a directory, named after the prefix (option `--prefix`). 
+    '''
+    up_findp = subp.add_parser('pack_fasta', help=this_help, description=this_help + extra_help, parents=[parent_parser],
+            formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
+    up_findp.add_argument('-a', '--fasta', metavar="<dir>", required=True, 
+            help="directory where fasta genomic files can be found (required)")
+    up_findp.set_defaults(func = run_pack_fasta)
+
     this_help = "Given a table with matches, extracts the coordinates of all riboproteins from GFF files"
     extra_help= '''\n
     This program extracts the annotations (coordinates info) from the GFF files with a match and GTDB taxonomy. 
@@ -274,7 +365,8 @@ def main():
     You can tell to use just a subset of the riboprotein (and closeby) genes: "main", "hug", "core", "left", "leftleft", or "right".
     Any other name (e.g. "only") will exclude the non-riboprotein genes which are usually present in the operon.
     '''
-    up_findp = subp.add_parser('extract_operons', help=this_help, description=this_help + extra_help, parents=[parent_parser],
+    up_findp = subp.add_parser('extract_operons', help=this_help, description=this_help + extra_help,
+            parents=[parent_parser, sample_parser],
             formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
     up_findp.add_argument('tsv', help="tsv file with file matches between fasta and GFF3 (required)")
     up_findp.add_argument('-a', '--fasta', metavar="<dir>", required=True, 
@@ -290,6 +382,10 @@ def main():
     up_findp.add_argument('-S', '--subset', metavar="str", type=str, help="subset of riboproteins to be extracted (default: all)")
     up_findp.add_argument('-b', '--border', metavar="int", default=50, type=int,
             help="number of nucleotides to be added to the start and end of the operon (default: 50)")
+    up_findp.add_argument('-k', '--store', metavar="<dir>", 
+            help="genome store created by `pack_fasta` (default is to read the fasta files)")
+    up_findp.add_argument('-P', '--prefetch', metavar="int", default=4, type=int,
+            help="number of genome files read and decompressed in advance by each thread (default: 4; zero disables)")
     up_findp.set_defaults(func = run_extract_operons_from_fasta)
 
     this_help = "Given riboprotein coordinates and table with fasta x GFF matches, extracts individual genes"
@@ -300,7 +396,8 @@ def main():
     If paralogs are included (i.e. all gene copies from each genome) then sequence IDs will include their number.
     The coordinates of the riboproteins should have been generated by the "extract_riboprots_from_gff" command.
     '''
-    up_findp = subp.add_parser('extract_genes', help=this_help, description=this_help + extra_help, parents=[parent_parser],
+    up_findp = subp.add_parser('extract_genes', help=this_help, description=this_help + extra_help,
+            parents=[parent_parser, sample_parser],
             formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
     up_findp.add_argument('tsv', help="tsv file with file matches between fasta and GFF3 (required)")
     up_findp.add_argument('-a', '--fasta', metavar="<dir>", required=True,
@@ -309,6 +406,10 @@ def main():
             help="tsv file with riboprotein coordinates for all genomes (required)")
     up_findp.add_argument('-p', '--paralogs',  action="store_true", default = False,
             help="include all copies (paralogs) in fasta files (default=keep only one copy)")
+    up_findp.add_argument('-k', '--store', metavar="<dir>", 
+            help="genome store created by `pack_fasta` (default is to read the fasta files)")
+    up_findp.add_argument('-P', '--prefetch', metavar="int", default=4, type=int,
+            help="number of genome files read and decompressed in advance by each thread (default: 4; zero disables)")
     up_findp.set_defaults(func = run_extract_genes_from_fasta)
 
     this_help = "Given a list of gene fasta files, clusters, aligns, and calculates monophyly statistics"
@@ -343,6 +444,9 @@ def main():
             help="tsv file with taxonomy information, as output from 'merge_fasta_gff' (default is to extract taxonomy from fasta headers)")
     up_findp.add_argument('-r', '--rapidnj', default=False, action="store_true",
             help="use rapidnj instead of default FastTree")
+    up_findp.add_argument('-m', '--matrix_free', default=False, action="store_true",
+            help="calculate silhouette scores along the tree, without the distance matrix between all leaves\n"
+            "(memory grows linearly with number of leaves; recommended for very large trees)")
     up_findp.set_defaults(func = run_estimate_compare_trees)
 
 
@@ -350,9 +454,11 @@ def main():
     extra_help= '''\n
     Runs `primer3_core` on each sequence in the alignment file, generating two tables, of left (l) and right (r) primers. Can use multiple threads.
     If file with taxonomic information is provided (from `merge_fasta_gff`), it will be used to calculate
-    representativity of primers (called "taxon_diversity")
+    representativity of primers (called "taxon_diversity"). This file is also needed for the stratified subsampling
+    of genomes, in which case only sequences from the chosen genomes are used.
     '''
-    up_findp = subp.add_parser('find_primers', help=this_help, description=this_help + extra_help, parents=[parent_parser], 
+    up_findp = subp.add_parser('find_primers', help=this_help, description=this_help + extra_help,
+            parents=[parent_parser, sample_parser], 
             formatter_class=argparse.RawTextHelpFormatter, epilog=epilogue)
     up_findp.add_argument('fasta', help="unaligned sequences")
     up_findp.add_argument('-l', '--length', metavar='int', type=int, 
@@ -509,8 +615,17 @@ def main():
         if args.nthreads > defaults["nthreads"]:
             logger.warning(f"Requested {args.nthreads} threads, but only {defaults['nthreads']} are available. Using {defaults['nthreads']} instead.")
             args.nthreads = defaults["nthreads"]
+    # xz and zstd outputs are compressed in parallel by the main process
+    set_compression (profile = args.compression, threads = args.nthreads if args.nthreads else defaults["nthreads"])
+    if args.no_cache: pb_cache.set_cache (enabled = False)
+    pb_executor.set_tool_timeout (args.tool_timeout)
+    # time and memory used by external programs, in the existing scratch area (the file is created only if needed)
+    pb_executor.start_tool_usage_log (os.path.dirname (args.scratch))
 
-    args.func(args) # calls task 
+    try:
+        args.func(args) # calls task 
+    finally:
+        pb_executor.summarise_tool_usage ()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import os, logging, xxhash
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# manifest of the input files used to build a table (name, size, modification time and xxh128 digest of contents),
+# stored next to the table s.t. a later run re-processes only new or modified files and reuses the rows of the others.
+# The digest is only computed again when the size is the same but the time is not (e.g. a file downloaded again but
+# identical is still unchanged).
+
+manifest_columns = ["file", "size", "mtime", "xxh128"]
+
+def manifest_path (tsvfile):
+    ''' manifest file for a table, e.g. "pb_gff.tsv.xz" -> "pb_gff.manifest.tsv" '''
+    base = tsvfile
+    for suffix in [".xz", ".gz", ".bz2", ".tsv"]:
+        if base.endswith (suffix): base = base[:-len(suffix)]
+    return base + ".manifest.tsv"
+
+def file_digest (path, block_size = 1 << 20):
+    h = xxhash.xxh3_128()
+    with open (path, "rb") as handle:
+        for block in iter (lambda: handle.read (block_size), b""):
+            h.update (block)
+    return h.hexdigest()
+
+def file_fingerprint (path):
+    stat = os.stat (path)
+    return {"file": os.path.basename (path), "size": stat.st_size, "mtime": stat.st_mtime_ns, "xxh128": file_digest (path)}
+
+def fingerprint_file_list (files):
+    return [file_fingerprint (f) for f in files]
+
+def fingerprint_files (files, nthreads = 1):
+    ''' dict of file name -> fingerprint, reading the files in parallel if nthreads > 1 '''
+    from phylobarcode import pb_pool
+    results = pb_pool.map_by_size (fingerprint_file_list, files, nthreads, description = "files to fingerprint")
+    return {x["file"]: x for sublist in results for x in sublist}
+
+def read_manifest (manifest_file):
+    ''' dict of file name -> fingerprint, or None if there is no manifest '''
+    if not os.path.isfile (manifest_file): return None
+    manifest = {}
+    with open (manifest_file, "r") as handle:
+        header = handle.readline().rstrip("\n").split("\t")
+        if header != manifest_columns:
+            logger.warning (f"Manifest file {manifest_file} has unexpected columns {header}, ignoring it"); return None
+        for line in handle:
+            name, size, mtime, digest = line.rstrip("\n").split("\t")
+            manifest[name] = {"file": name, "size": int(size), "mtime": int(mtime), "xxh128": digest}
+    return manifest
+
+def write_manifest (manifest_file, fingerprints):
+    ''' fingerprints is a dict of file name -> fingerprint (as from fingerprint_files()) '''
+    with open (manifest_file, "w") as handle:
+        handle.write ("\t".join (manifest_columns) + "\n")
+        for name in sorted (fingerprints):
+            handle.write ("\t".join ([str(fingerprints[name][k]) for k in manifest_columns]) + "\n")
+    logger.info (f"Saved manifest of {len(fingerprints)} input files to {manifest_file}")
+
+def compare_with_manifest (files, manifest):
+    '''
+    returns list of new or modified files (paths) and the dict of fingerprints of the unchanged ones. Files in the
+    manifest but not in `files` (i.e. removed) are in neither
+    '''
+    changed, unchanged = [], {}
+    for f in files:
+        name = os.path.basename (f)
+        old = manifest.get (name)
+        stat = os.stat (f)
+        if old is None or old["size"] != stat.st_size:
+            changed.append (f)
+        elif old["mtime"] == stat.st_mtime_ns:
+            unchanged[name] = old
+        elif file_digest (f) == old["xxh128"]: # same contents, new time
+            unchanged[name] = dict(old, mtime = stat.st_mtime_ns)
+        else:
+            changed.append (f)
+    return changed, unchanged
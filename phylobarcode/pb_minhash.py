@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import os, logging, math
+import numpy as np
+from phylobarcode import pb_seqkernel
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# bottom-k MinHash sketches of genomes (as in Mash): the `sketch_size` smallest hashes of the canonical k-mers of a
+# sequence. The Jaccard index between two genomes is estimated from the smallest hashes of the union of their sketches,
+# and converted into an ANI-like similarity (1 - Mash distance). Genomes are clustered greedily: each one joins the first
+# representative above the threshold, or becomes a new representative.
+
+default_kmer = 21
+default_sketch_size = 1000
+empty_sketch = np.zeros (0, dtype=np.uint64)
+
+def mix64 (x):
+    ''' splitmix64 finalizer, s.t. hashes of similar k-mers are uncorrelated (uint64 arithmetic wraps around) '''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def bottom_k (hashes, sketch_size):
+    ''' sorted array with the sketch_size smallest distinct values '''
+    if len(hashes) > 4 * sketch_size: # avoid sorting all hashes, unless many are repeated
+        smallest = np.unique (np.partition (hashes, 4 * sketch_size)[:4 * sketch_size])
+        if len(smallest) >= sketch_size: return smallest[:sketch_size]
+    return np.unique (hashes)[:sketch_size]
+
+def sketch_sequence (sequence, kmer = default_kmer, sketch_size = default_sketch_size):
+    ''' bottom-k sketch of canonical k-mers (k-mers with non-ACGT bases are skipped) '''
+    buffer = pb_seqkernel.upper_table[pb_seqkernel.as_uint8 (sequence)]
+    forward, valid = pb_seqkernel.kmer_codes (buffer, kmer)
+    if not valid.any(): return empty_sketch
+    reverse, _ = pb_seqkernel.kmer_codes (pb_seqkernel.complement_table[buffer][::-1], kmer)
+    canonical = np.minimum (forward, reverse[::-1])[valid] # reverse complement of k-mer i is at the end of `reverse`
+    return bottom_k (mix64 (canonical), sketch_size)
+
+def merge_sketches (sketches, sketch_size = default_sketch_size):
+    ''' sketch of the union of sequences (e.g. all chromosomes of a genome) '''
+    sketches = [s for s in sketches if len(s)]
+    if not sketches: return empty_sketch
+    return bottom_k (np.concatenate (sketches), sketch_size)
+
+def jaccard (a, b, sketch_size = default_sketch_size):
+    ''' estimated Jaccard index, from the shared hashes among the smallest of the union '''
+    union = np.union1d (a, b)[:sketch_size]
+    if not len(union): return 0.
+    a, b = a[a <= union[-1]], b[b <= union[-1]]
+    return np.intersect1d (a, b, assume_unique = True).size / len(union)
+
+def ani (a, b, kmer = default_kmer, sketch_size = default_sketch_size):
+    ''' 1 - Mash distance, where distance = -log(2J/(1+J))/k '''
+    j = jaccard (a, b, sketch_size)
+    if j <= 0: return 0.
+    return 1. + math.log (2. * j / (1. + j)) / kmer
+
+def greedy_clusters (names, sketches, threshold, kmer = default_kmer, sketch_size = default_sketch_size):
+    '''
+    dict of name -> representative name. Names are processed in the given order (thus preferred representatives
+    should come first); those without a sketch are their own representative
+    '''
+    representatives = [] # (name, sketch)
+    cluster = {}
+    for name, sketch in zip (names, sketches):
+        cluster[name] = name
+        if not len(sketch): continue
+        for rep, rep_sketch in representatives:
+            if ani (sketch, rep_sketch, kmer, sketch_size) >= threshold:
+                cluster[name] = rep
+                break
+        else:
+            representatives.append ((name, sketch))
+    return cluster
+
+def sketch_path (tsvfile):
+    ''' file with sketches for a table, e.g. "pb_fasta.tsv.xz" -> "pb_fasta.sketches.npz" '''
+    base = tsvfile
+    for suffix in [".xz", ".gz", ".bz2", ".tsv"]:
+        if base.endswith (suffix): base = base[:-len(suffix)]
+    return base + ".sketches.npz"
+
+def save_sketches (fname, sketches, kmer = default_kmer, sketch_size = default_sketch_size):
+    ''' sketches is a dict of seqid -> sketch, stored as one concatenated array with offsets '''
+    seqids = list(sketches.keys())
+    lengths = np.array ([len(sketches[s]) for s in seqids], dtype=np.int64)
+    offsets = np.zeros (len(seqids) + 1, dtype=np.int64)
+    np.cumsum (lengths, out=offsets[1:])
+    hashes = np.concatenate ([sketches[s] for s in seqids]) if seqids else empty_sketch
+    np.savez_compressed (fname, seqids = np.array (seqids, dtype=str), offsets = offsets, hashes = hashes,
+            params = np.array ([kmer, sketch_size], dtype=np.int64))
+    logger.info (f"Saved MinHash sketches of {len(seqids)} sequences to {fname}")
+
+def read_sketches (fname, kmer = default_kmer, sketch_size = default_sketch_size):
+    ''' dict of seqid -> sketch, or None if file is missing or has other parameters '''
+    if not os.path.isfile (fname): return None
+    with np.load (fname) as npz:
+        if npz["params"].tolist() != [kmer, sketch_size]:
+            logger.warning (f"Sketches in {fname} used other parameters (k, sketch size) = {npz['params'].tolist()}, ignoring them")
+            return None
+        seqids, offsets, hashes = npz["seqids"].tolist(), npz["offsets"], npz["hashes"]
+    return {s: hashes[offsets[i]:offsets[i+1]] for i, s in enumerate(seqids)}
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import os, logging, time, functools
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# dynamic scheduling of per-file work over a pool of processes: items (files or genomes) are sorted by size, largest
+# first, and grouped into batches of similar total size, which are handed to workers as they become free (with a
+# fixed chunk per worker, the run waits for the worker with the largest files). Results are returned as they finish,
+# with the index of their batch s.t. callers can restore the order. Each worker reports its busy time, and the load
+# balance is logged at the end.
+
+def file_sizes (files):
+    ''' size in bytes of each file (zero if missing) '''
+    sizes = []
+    for f in files:
+        try: sizes.append (os.path.getsize (f))
+        except OSError: sizes.append (0)
+    return sizes
+
+def size_batches (items, sizes, nthreads, batches_per_thread = 8):
+    ''' lists of items, largest first, with about total_size / (nthreads * batches_per_thread) in each list '''
+    if not sum(sizes): sizes = [1] * len(items) # same number of items per batch
+    order = sorted (range(len(items)), key = lambda i: -sizes[i]) # stable, thus same batches for same input
+    target = sum(sizes) / max(1, nthreads * batches_per_thread)
+    batches, batch, batch_size = [], [], 0
+    for i in order:
+        batch.append (items[i])
+        batch_size += sizes[i]
+        if batch_size >= target:
+            batches.append (batch)
+            batch, batch_size = [], 0
+    if batch: batches.append (batch)
+    return batches
+
+def timed_call (function, indexed_task):
+    index, task = indexed_task
+    start = time.perf_counter()
+    result = function (task)
+    return index, os.getpid(), time.perf_counter() - start, result
+
+def pool_imap (function, tasks, nthreads = 1, sizes = None, description = "tasks"):
+    '''
+    generator of (index, function(tasks[index])) in order of completion, using up to nthreads processes. Tasks should
+    be sorted by decreasing cost (e.g. from size_batches()), s.t. small tasks fill the gaps at the end. Logs the
+    progress and the busy time of each worker. With one thread (or task) the tasks are run in this process, in order.
+    '''
+    if nthreads < 2 or len(tasks) < 2:
+        for i, task in enumerate(tasks): yield i, function (task)
+        return
+    if sizes is None: sizes = [1] * len(tasks)
+    from multiprocessing import Pool
+    busy = {} # pid -> [seconds, tasks, size]
+    n_tasks = len(tasks)
+    with Pool (min(nthreads, n_tasks)) as p:
+        for n_done, (i, pid, elapsed, result) in enumerate (p.imap_unordered (functools.partial (timed_call, function), enumerate(tasks)), start=1):
+            stats = busy.setdefault (pid, [0., 0, 0])
+            stats[0] += elapsed; stats[1] += 1; stats[2] += sizes[i]
+            if n_done % max(1, n_tasks//10) == 0 and n_done < n_tasks:
+                logger.info (f"{round((n_done*100)/n_tasks,1)}% of {description} done")
+            yield i, result
+    log_load_balance (busy, description)
+
+def pool_map (function, tasks, nthreads = 1, sizes = None, description = "tasks"):
+    ''' list of results from pool_imap(), in order of tasks '''
+    results = sorted (pool_imap (function, tasks, nthreads, sizes, description), key = lambda x: x[0])
+    return [x[1] for x in results]
+
+def log_load_balance (busy, description):
+    ''' busy is a dict of worker -> [seconds, tasks, size] '''
+    times = [x[0] for x in busy.values()]
+    mean_time = sum(times) / len(times)
+    logger.info (f"Load balance over {len(busy)} workers for {description}: busy between {min(times):.1f}s and "
+            f"{max(times):.1f}s (efficiency {100 * mean_time / max(max(times), 1e-9):.0f}%)")
+    for pid, (seconds, n_tasks, size) in sorted (busy.items()):
+        logger.debug (f"worker {pid}: {n_tasks} tasks, {size} bytes, {seconds:.2f}s")
+
+def imap_by_size (function, items, nthreads = 1, sizes = None, description = "files"):
+    '''
+    generator of (index, batch, function(batch)) for batches (lists) of items, in order of completion (sorting by index
+    gives a reproducible order). Sizes default to the file sizes, if items are paths. With one thread the function is
+    called once, on all items in original order.
+    '''
+    if not items: return
+    if nthreads < 2:
+        yield 0, items, function (items)
+        return
+    if sizes is None: sizes = file_sizes (items)
+    batches = size_batches (items, sizes, nthreads)
+    size_of = dict(zip(items, sizes))
+    batch_sizes = [sum([size_of[x] for x in b]) for b in batches]
+    for i, result in pool_imap (function, batches, nthreads, sizes = batch_sizes, description = description):
+        yield i, batches[i], result
+
+def map_by_size (function, items, nthreads = 1, sizes = None, description = "files"):
+    ''' list of results from imap_by_size(), in order of batches (largest files first) '''
+    results = sorted (imap_by_size (function, items, nthreads, sizes, description), key = lambda x: x[0])
+    return [x[2] for x in results]
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import numpy as np, xxhash
+
+# batched sequence kernels working on uint8 views of the sequences (one byte per base), replacing python loops over
+# characters or substrings. Many sequences are concatenated into a single buffer, with their offsets, s.t. each
+# operation is a handful of numpy calls irrespective of the number of sequences.
+
+upper_table = np.arange(256, dtype=np.uint8)
+upper_table[ord("a"):ord("z")+1] -= 32
+complement_table = np.arange(256, dtype=np.uint8) # IUPAC complement, preserving case
+for x, y in zip(b"ACGTURYKMBVDHSWN", b"TGCAAYRMKVBHDSWN"):
+    complement_table[x] = y
+    complement_table[x + 32] = y + 32
+nmask_table = np.full(256, ord("N"), dtype=np.uint8) # everything not ACGT (after uppercase) becomes N
+for x in b"ACGT": nmask_table[x] = nmask_table[x + 32] = x
+complement_bytes = complement_table.tobytes() # for bytes.translate(), faster than a numpy lookup for a single pass
+upper_bytes = upper_table.tobytes()
+nmask_bytes = nmask_table.tobytes()
+code2bit_table = np.full(256, 255, dtype=np.uint8) # A=0, C=1, G=2, T=3, invalid = 255 (case sensitive)
+for i, x in enumerate(b"ACGT"): code2bit_table[x] = i
+
+def as_uint8 (sequence):
+    ''' zero-copy view of bytes, or view of encoded str (or Seq) '''
+    if isinstance (sequence, np.ndarray): return sequence
+    if isinstance (sequence, (bytes, bytearray, memoryview)): return np.frombuffer (sequence, dtype=np.uint8)
+    return np.frombuffer (str(sequence).encode("ascii", errors="replace"), dtype=np.uint8)
+
+def as_string (array):
+    return array.tobytes().decode("ascii")
+
+def concatenate_sequences (sequences, separator = ""):
+    ''' returns single uint8 buffer and offsets s.t. sequence i is buffer[offsets[i]:offsets[i+1] - len(separator)] '''
+    sequences = [s if isinstance(s, str) else (s.decode("ascii") if isinstance(s, bytes) else str(s)) for s in sequences]
+    lengths = np.fromiter ((len(s) for s in sequences), dtype=np.int64, count=len(sequences)) + len(separator)
+    offsets = np.zeros (len(sequences) + 1, dtype=np.int64)
+    np.cumsum (lengths, out=offsets[1:])
+    # str.join() and a single encode() are much faster than converting each sequence to an array
+    buffer = (separator.join(sequences) + (separator if sequences else "")).encode("ascii", errors="replace")
+    return np.frombuffer (buffer, dtype=np.uint8), offsets
+
+def upper (sequence): return as_string (upper_table[as_uint8(sequence)])
+
+def mask_non_acgt (sequence): return as_string (nmask_table[as_uint8(sequence)])
+
+def reverse_complement (sequence): return as_uint8(sequence).tobytes().translate(complement_bytes)[::-1].decode("ascii")
+
+def reverse_complement_list (sequences):
+    ''' reverse complement of many sequences at once: reversing the concatenation also reverses the order of sequences '''
+    if not sequences: return []
+    buffer, offsets = concatenate_sequences (sequences)
+    rc = buffer.tobytes().translate(complement_bytes)[::-1].decode("ascii")
+    ends = (offsets[-1] - offsets).tolist() # sequence i is now at rc[ends[i+1]:ends[i]]
+    return [rc[ends[i+1]:ends[i]] for i in range(len(sequences))]
+
+def character_mask (buffer, characters, ignore_case = True):
+    ''' boolean array marking positions with any of the characters; comparisons are faster than table lookups '''
+    upper_buffer = buffer & np.uint8(0xDF) if ignore_case else buffer # clears lowercase bit, s.t. "a" becomes "A"
+    mask = np.zeros (len(buffer), dtype=bool)
+    for c in characters.encode("ascii"): 
+        if ignore_case and chr(c).isalpha(): mask |= (upper_buffer == (c & 0xDF))
+        else: mask |= (buffer == c) # e.g. gaps
+    return mask
+
+def count_characters (sequences, characters, ignore_case = True, complement = False):
+    ''' number of occurrences of any of the characters in each sequence (or of all other chars, if complement=True) '''
+    buffer, offsets = concatenate_sequences (sequences)
+    mask = character_mask (buffer, characters, ignore_case)
+    if complement: mask = ~mask
+    positions = np.flatnonzero (mask) # sorted, and usually sparse (e.g. N's)
+    return np.diff (np.searchsorted (positions, offsets))
+
+def missing_counts (sequences):
+    ''' number of N, n, or gaps in each sequence '''
+    return count_characters (sequences, "N-", ignore_case = True)
+
+def acgt_counts (sequences):
+    ''' number of A, C, G, T (any case) in each sequence '''
+    lengths = np.fromiter ((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    return lengths - count_characters (sequences, "ACGT", ignore_case = True, complement = True)
+
+def kmer_codes (buffer, k):
+    '''
+    rolling 2-bit code of each k-mer (k <= 31) starting at each position of the uint8 buffer, and boolean array telling
+    if the k-mer has only ACGT. Both have length len(buffer) - k + 1.
+    '''
+    if k > 31: raise ValueError ("k-mers longer than 31 bases do not fit into 64 bits")
+    n_kmers = len(buffer) - k + 1
+    if n_kmers < 1: return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    codes = code2bit_table[buffer]
+    invalid = np.zeros (len(buffer) + 1, dtype=np.int64)
+    np.cumsum (codes == 255, out=invalid[1:])
+    valid = (invalid[k:] - invalid[:n_kmers]) == 0 # no invalid base inside window
+    bits = (codes & 3).astype(np.uint64)
+    kmers = np.zeros (n_kmers, dtype=np.uint64)
+    for j in range(k): # k vectorised passes instead of one python iteration per k-mer
+        kmers = (kmers << np.uint64(2)) | bits[j:j + n_kmers]
+    return kmers, valid
+
+def kmer_sets (sequences, k):
+    '''
+    set of k-mer hashes for each sequence: 2-bit codes for k-mers with ACGT only, and xxhash (with high bit set, thus
+    distinct from any 2-bit code) for those with other characters
+    '''
+    buffer, offsets = concatenate_sequences (sequences, separator = "\n") # k-mers with separator are not used
+    kmers, valid = kmer_codes (buffer, k)
+    separators = np.zeros (len(buffer) + 1, dtype=np.int64)
+    np.cumsum (buffer == ord("\n"), out=separators[1:])
+    codes = kmers.tolist()
+    # rare: k-mers with N, lowercase, or IUPAC, but not those spanning two sequences
+    for j in np.flatnonzero (~valid & (separators[k:] == separators[:len(valid)])).tolist():
+        codes[j] = xxhash.xxh64_intdigest (buffer[j:j + k].tobytes()) | (1 << 63)
+    offsets = offsets.tolist() # last k-mer of sequence i starts at offsets[i+1] - 1 - k (due to separator)
+    # sequences shorter than k have no k-mers (o.w. a negative slice would take k-mers from the following sequences)
+    return [set(codes[offsets[i]:max(offsets[i], offsets[i+1] - k)]) for i in range(len(offsets) - 1)]
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+import os, logging, heapq, collections, xxhash
+import numpy as np, pandas as pd
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# taxonomy of the genomes from the merged table (from `merge_fasta_gff`), indexed once by seqid and shared by the
+# tasks. GTDB taxonomy strings are split once per distinct string (not per genome), and each rank (or other column) is
+# stored as integer codes into its distinct names, s.t. the labels of many seqids are found with a single indexing.
+
+ranks = ["phylum", "class", "order", "family", "genus", "species"] # position in GTDB string, after d__Bacteria
+
+def rank_name (taxonomy, position):
+    ''' e.g. "Priestia megaterium" for position 6 of "d__Bacteria;...;s__Priestia megaterium"; NaN if absent '''
+    if not isinstance (taxonomy, str): return np.nan
+    levels = taxonomy.split(";")
+    if len(levels) <= position: return np.nan
+    name = levels[position].split("__")
+    return name[1] if len(name) > 1 else np.nan
+
+def split_gtdb_taxonomy (taxonomy):
+    ''' dict of rank -> array of names (NaN if absent), for a list of GTDB taxonomy strings (NaN allowed) '''
+    codes, uniques = pd.factorize (np.asarray (taxonomy, dtype=object)) # NaN have code -1
+    names = {}
+    for position, rank in enumerate (ranks, start=1):
+        rank_names = np.array ([rank_name (x, position) for x in uniques] + [np.nan], dtype=object)
+        names[rank] = rank_names[codes] # code -1 is the last element
+    return names
+
+class TaxonomyIndex:
+    '''
+    seqid -> row map of the merged table, with the GTDB ranks (phylum ... species) and other columns (e.g. gff_taxonid
+    or gtdb_genome_representative) as integer codes. Seqids absent from the table (or absent values) are returned
+    as `missing`. If a seqid appears in more than one row, the first one is used.
+    '''
+    def __init__ (self, df, columns = None):
+        if columns is None: columns = [c for c in ["gff_taxonid", "gtdb_genome_representative"] if c in df.columns]
+        self.seqids = np.asarray (df["seqid"], dtype=object)
+        n = len(self.seqids)
+        self.row = dict (zip (self.seqids[::-1], range (n-1, -1, -1))) # reversed s.t. first row wins
+        values = split_gtdb_taxonomy (df["gtdb_taxonomy"]) if "gtdb_taxonomy" in df.columns else {}
+        for col in columns: values[col] = np.asarray (df[col], dtype=object)
+        self.codes, self.names = {}, {}
+        for col, v in values.items():
+            codes, names = pd.factorize (v)
+            self.codes[col] = codes.astype (np.int32)
+            self.names[col] = np.asarray (names, dtype=object)
+
+    @classmethod
+    def from_file (cls, tsvfile, columns = None):
+        ''' index from the merged table; only the columns needed are read '''
+        if columns is None: columns = ["gff_taxonid", "gtdb_genome_representative"]
+        keep = set(["seqid", "gtdb_taxonomy"] + columns)
+        df = pd.read_csv (tsvfile, compression="infer", sep="\t", dtype=str, usecols = lambda c: c in keep)
+        return cls (df, [c for c in columns if c in df.columns])
+
+    def __len__ (self): return len(self.seqids)
+
+    def __contains__ (self, seqid): return seqid in self.row
+
+    @property
+    def columns (self): return list(self.codes.keys())
+
+    def rows (self, seqids):
+        ''' array with the row of each seqid, -1 if absent '''
+        return np.array ([self.row.get (s, -1) for s in seqids], dtype=np.int64)
+
+    def labels (self, column, seqids, missing = "unknown"):
+        ''' array with the `column` (e.g. "genus") of each seqid '''
+        rows = self.rows (seqids)
+        names = np.append (self.names[column], np.array ([missing], dtype=object)) # code -1 -> missing
+        if not len(self): return names[np.full (len(rows), -1)]
+        codes = np.where (rows < 0, -1, self.codes[column][rows])
+        return names[codes]
+
+    def label (self, column, seqid, missing = "unknown"):
+        row = self.row.get (seqid)
+        if row is None: return missing
+        code = self.codes[column][row]
+        return missing if code < 0 else self.names[column][code]
+
+    def groups (self, column):
+        ''' dict of name -> list of (distinct) seqids, e.g. genomes with the same GTDB representative '''
+        groups = {}
+        for code, seqid in zip (self.codes[column], self.seqids):
+            if code >= 0: groups.setdefault (self.names[column][code], {})[seqid] = None
+        return {k: list(v) for k,v in groups.items()} # dict keeps order of first appearance
+
+    def dataframe (self, columns = None, missing = np.nan):
+        ''' table with seqid and the columns (by default all, ranks last), one row per row of the merged table '''
+        if columns is None: columns = [c for c in self.columns if c not in ranks] + [c for c in ranks if c in self.codes]
+        df = pd.DataFrame ({"seqid": self.seqids})
+        for col in columns:
+            names = np.append (self.names[col], np.array ([missing], dtype=object))
+            df[col] = names[self.codes[col]]
+        return df
+
+def read_taxonomy_index (taxon, columns = None):
+    ''' TaxonomyIndex from the merged table, or None if file not given or not found '''
+    if taxon is None: return None
+    if not os.path.isfile (taxon):
+        logger.error (f"Taxonomic information file {taxon} not found")
+        return None
+    index = TaxonomyIndex.from_file (taxon, columns)
+    logger.info (f"Read {len(index)} entries with taxonomic information from file {taxon}")
+    return index
+
+# stratified subsampling of genomes: each genome (GTDB accession, or seqid if absent) gets a pseudo-random priority
+# from the seed, and the genomes with the smallest priorities within each group (e.g. genus) are kept. Since priorities
+# do not depend on the order of the table, the same genomes are chosen in every run (and by every command), and the
+# merged table is streamed in chunks keeping only the current best genomes of each group.
+
+class StratifiedSampler:
+    '''
+    at most `max_per[1]` genomes per rank `max_per[0]` (e.g. ("genus", 5)), topped up to at least `min_per[1]`
+    genomes per rank `min_per[0]` (e.g. ("phylum", 20)) when available. Without `max_per`, exactly `min_per[1]` genomes
+    (or all) are chosen from each group. Genomes without the rank form a single "unknown" group.
+    '''
+    def __init__ (self, max_per = None, min_per = None, seed = 0, chunksize = 100000):
+        for rank_count in [max_per, min_per]:
+            if rank_count is not None and (rank_count[0] not in ranks or rank_count[1] < 1):
+                raise ValueError (f"Invalid rank or number of genomes {rank_count}; rank must be one of {ranks}")
+        if max_per is None and min_per is None:
+            raise ValueError ("At least one of max_per and min_per must be given")
+        self.max_per, self.min_per, self.seed, self.chunksize = max_per, min_per, seed, chunksize
+
+    def __repr__ (self):
+        limits = [f"{a} {r[1]} per {r[0]}" for a, r in [("at most", self.max_per), ("at least", self.min_per)] if r]
+        return f"{' and '.join(limits)} (seed {self.seed})"
+
+    def priority (self, genome):
+        return xxhash.xxh64_intdigest (f"{self.seed}\t{genome}".encode())
+
+    def chunks (self, tsvfile):
+        ''' merged table in chunks, with a `genome` column '''
+        keep = set(["seqid", "gtdb_accession", "gtdb_taxonomy"])
+        for df in pd.read_csv (tsvfile, compression="infer", sep="\t", dtype=str, usecols = lambda c: c in keep,
+                chunksize = self.chunksize):
+            genome = df["gtdb_accession"] if "gtdb_accession" in df.columns else df["seqid"]
+            yield df.assign (genome = genome.fillna (df["seqid"]))
+
+    def best_genomes (self, tsvfile):
+        '''
+        dict of (rank, count) -> dict of group -> max-heap of (-priority, genome, min_per group) with the `count` best
+        genomes of each group, and the number of genomes
+        '''
+        limits = [r for r in [self.max_per, self.min_per] if r is not None]
+        heaps = {r: {} for r in limits}
+        seen = set()
+        for df in self.chunks (tsvfile):
+            df = df.drop_duplicates (subset = "genome")
+            df = df[~df["genome"].isin (seen)]
+            seen.update (df["genome"])
+            taxonomy = split_gtdb_taxonomy (df["gtdb_taxonomy"]) if "gtdb_taxonomy" in df.columns else {}
+            groups = {r: [g if isinstance (g, str) else "unknown" for g in taxonomy.get (r[0], [np.nan] * len(df))] for r in limits}
+            min_groups = groups[self.min_per] if self.min_per else [None] * len(df)
+            for i, genome in enumerate (df["genome"]):
+                entry = (-self.priority (genome), genome, min_groups[i])
+                for r in limits:
+                    heap = heaps[r].setdefault (groups[r][i], [])
+                    if len(heap) < r[1]: heapq.heappush (heap, entry)
+                    elif entry > heap[0]: heapq.heapreplace (heap, entry) # smaller priority than the worst kept
+        return heaps, len(seen)
+
+    def sample_genomes (self, tsvfile):
+        ''' set of chosen genomes (GTDB accessions, or seqids if absent) '''
+        heaps, n_genomes = self.best_genomes (tsvfile)
+        chosen = {} # genome -> min_per group
+        if self.max_per is not None:
+            chosen = {genome: group for heap in heaps[self.max_per].values() for _, genome, group in heap}
+        if self.min_per is not None: # top up groups with too few genomes, by priority
+            n_chosen = collections.Counter (chosen.values())
+            for group, heap in heaps[self.min_per].items():
+                best = [genome for _, genome, _ in sorted (heap, reverse = True) if genome not in chosen]
+                for genome in best[:max(self.min_per[1] - n_chosen[group], 0)]:
+                    chosen[genome] = group
+        logger.info (f"Sampled {len(chosen)} out of {n_genomes} genomes, {self}")
+        return set(chosen)
+
+    def sample (self, tsvfile):
+        ''' set of seqids (all sequences of each chosen genome) from the merged table '''
+        chosen = self.sample_genomes (tsvfile)
+        seqids = set()
+        for df in self.chunks (tsvfile):
+            seqids.update (df.loc[df["genome"].isin (chosen), "seqid"])
+        return seqids
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import numpy as np, logging, tempfile
+
+logger = logging.getLogger("phylobarcode_global_logger")
+
+# array representation of a tree (nodes in preorder, s.t. parents come before children) for all-pairs distances:
+# one traversal gives the distance from the root and the depth (number of edges) of every node, and the lowest common
+# ancestor (LCA) of many pairs at once is found with an Euler tour and a sparse table of range minima. Then
+# dist(i,j) = root_dist[i] + root_dist[j] - 2 * root_dist[lca(i,j)], and the same with depths for the number of edges.
+# For silhouette scores only the mean distance from each leaf to each class is needed, which can be computed without any
+# matrix: a postorder pass sums distances to the leaves of each class below each node, and a preorder pass reroots
+# these sums s.t. they include all leaves (O(n.C) time, with classes processed in chunks to keep memory linear in n);
+# thus the LCA index (O(n log n) memory) is only built when distances are first requested.
+
+class ArrayTree:
+    def __init__ (self, parent, edge_length, labels):
+        '''
+        parent: index of the parent of each node in preorder (root has -1); edge_length: length of the edge above each
+        node (None is zero); labels: leaf labels (None for internal nodes or leaves to be ignored)
+        '''
+        n_nodes = len(parent)
+        self.parent = np.asarray (parent, dtype=np.int64)
+        self.labels = list(labels)
+        edge_length = np.array ([x if x is not None else 0. for x in edge_length], dtype=np.float64)
+        self.edge_length = edge_length
+        self.root_dist = np.zeros (n_nodes, dtype=np.float64)
+        self.depth = np.zeros (n_nodes, dtype=np.int64)
+        children = [[] for _ in range(n_nodes)]
+        for i, p in enumerate(parent): # single preorder pass
+            if p < 0: continue
+            self.root_dist[i] = self.root_dist[p] + edge_length[i]
+            self.depth[i] = self.depth[p] + 1
+            children[p].append(i)
+        self.leaves = np.array ([i for i in range(n_nodes) if not children[i] and self.labels[i] is not None], dtype=np.int64)
+        self.leaf_labels = [self.labels[i] for i in self.leaves]
+        # nodes grouped by depth (and by parent within each level), for level-wise passes
+        order = np.lexsort ((self.parent, self.depth))
+        bounds = np.searchsorted (self.depth[order], np.arange(self.depth.max() + 2))
+        self.levels = [order[bounds[d]:bounds[d+1]] for d in range(len(bounds) - 1)]
+        self.level_parents = [] # (distinct parents, start of their children in level) for np.add.reduceat()
+        for nodes in self.levels:
+            starts = np.flatnonzero (np.diff (self.parent[nodes], prepend=-2))
+            self.level_parents.append ((self.parent[nodes[starts]], starts))
+        self.first_visit = self.log2 = self.sparse = None # LCA index, built by the first call to lca()
+
+    @classmethod
+    def from_treeswift (cls, tree):
+        index = {}
+        parent, edge_length, labels = [], [], []
+        for node in tree.traverse_preorder():
+            index[node] = len(parent)
+            parent.append (index[node.parent] if node.parent is not None else -1)
+            edge_length.append (node.edge_length if node.parent is not None else 0.)
+            labels.append (node.label if node.is_leaf() and node.label else None)
+        return cls (parent, edge_length, labels)
+
+    @classmethod
+    def from_dendropy (cls, tree):
+        index = {}
+        parent, edge_length, labels = [], [], []
+        for node in tree.preorder_node_iter():
+            index[node] = len(parent)
+            parent.append (index[node.parent_node] if node.parent_node is not None else -1)
+            edge_length.append (node.edge_length if node.parent_node is not None else 0.)
+            labels.append (node.taxon.label if node.is_leaf() and node.taxon is not None else None)
+        return cls (parent, edge_length, labels)
+
+    @classmethod
+    def from_newick (cls, newick):
+        import treeswift
+        return cls.from_treeswift (treeswift.read_tree_newick (newick))
+
+    @classmethod
+    def from_any (cls, tree):
+        ''' from newick string, treeswift or dendropy tree, removing quotes from leaf labels '''
+        import treeswift
+        if isinstance (tree, cls): return tree
+        if isinstance (tree, str): tree = treeswift.read_tree_newick (tree)
+        elif not isinstance (tree, treeswift.Tree): tree = treeswift.read_tree_dendropy (tree) # dendropy
+        for node in tree.traverse_leaves(): 
+            if node.label is not None: node.label = node.label.replace("'", "")
+        return cls.from_treeswift (tree)
+
+    def build_lca_index (self):
+        ''' Euler tour (2n-1 visits) and sparse table with the shallowest node in each window of 2^k visits '''
+        n_nodes = len(self.parent)
+        children = [[] for _ in range(n_nodes)]
+        for i, p in enumerate(self.parent.tolist()): # in preorder, as in __init__
+            if p >= 0: children[p].append(i)
+        euler = []
+        self.first_visit = np.zeros (n_nodes, dtype=np.int64)
+        stack = [(0, 0)] # (node, index of next child)
+        while stack: # iterative DFS, since recursion would fail on deep (caterpillar) trees
+            node, c = stack.pop()
+            if c == 0: self.first_visit[node] = len(euler)
+            euler.append (node)
+            if c < len(children[node]):
+                stack.append ((node, c + 1))
+                stack.append ((children[node][c], 0))
+        euler = np.array (euler, dtype=np.int64)
+        n_euler = len(euler)
+        self.log2 = np.zeros (n_euler + 1, dtype=np.int64) # floor(log2(x)) for window sizes
+        self.log2[2:] = np.floor (np.log2 (np.arange(2, n_euler + 1))).astype(np.int64)
+        n_levels = int(self.log2[n_euler]) + 1
+        self.sparse = np.zeros ((n_levels, n_euler), dtype=np.int32) # node ids; only sparse[k, :n_euler - 2^k + 1] used
+        self.sparse[0] = euler
+        for k in range(1, n_levels):
+            half = 1 << (k-1)
+            a = self.sparse[k-1, :n_euler - 2 * half + 1]
+            b = self.sparse[k-1, half:n_euler - half + 1]
+            self.sparse[k, :len(a)] = np.where (self.depth[a] <= self.depth[b], a, b)
+
+    def lca (self, u, v):
+        ''' lowest common ancestor of each pair of nodes (arrays of node indices, broadcast against each other) '''
+        if self.sparse is None: self.build_lca_index() # not needed by silhouette_samples()
+        fu, fv = self.first_visit[u], self.first_visit[v]
+        lo = np.minimum (fu, fv)
+        hi = np.maximum (fu, fv)
+        k = self.log2[hi - lo + 1]
+        a = self.sparse[k, lo]
+        b = self.sparse[k, hi - (1 << k) + 1]
+        return np.where (self.depth[a] <= self.depth[b], a, b)
+
+    def distance_matrices (self, leaves = None, patristic = True, edge_count = False, dtype = np.float32,
+            memmap_dir = None, block_size = 1 << 22):
+        '''
+        all-pairs distances between leaves (node indices, default all labelled leaves), as a list with the patristic
+        and/or the edge count matrices. Rows are computed in blocks of about block_size cells. If memmap_dir is given,
+        matrices are memory-mapped temporary files there (deleted once the arrays are released).
+        '''
+        if leaves is None: leaves = self.leaves
+        leaves = np.asarray (leaves, dtype=np.int64)
+        n = len(leaves)
+        kinds = [x for x, wanted in [(self.root_dist, patristic), (self.depth, edge_count)] if wanted]
+        if memmap_dir is None: matrices = [np.empty ((n, n), dtype=dtype) for _ in kinds]
+        else: matrices = [np.memmap (tempfile.TemporaryFile (dir=memmap_dir), dtype=dtype, mode="w+", shape=(n, n)) for _ in kinds]
+        rows = max(1, block_size // max(n, 1))
+        for start in range(0, n, rows):
+            u = leaves[start:start + rows, None]
+            anc = self.lca (u, leaves[None, :])
+            for mat, values in zip(matrices, kinds):
+                mat[start:start + rows] = values[u] + values[leaves][None, :] - 2 * values[anc]
+        return matrices
+
+    def distance_matrix (self, leaves = None, edge_count = False, dtype = np.float32, memmap_dir = None):
+        ''' patristic distances between leaves, or number of edges if edge_count=True '''
+        return self.distance_matrices (leaves, patristic = not edge_count, edge_count = edge_count,
+                dtype = dtype, memmap_dir = memmap_dir)[0]
+
+    def class_distance_sums (self, classes, n_classes, first = 0, last = None):
+        '''
+        sum of distances from each leaf to all leaves of each class (columns first...last-1), where classes[i] is the
+        class index of self.leaves[i]. Returns (sums, counts) with the leaf x class sums and the leaves per class
+        '''
+        if last is None: last = n_classes
+        n_nodes = len(self.parent)
+        in_chunk = (classes >= first) & (classes < last)
+        count = np.zeros ((n_nodes, last - first), dtype=np.float64)
+        count[self.leaves[in_chunk], classes[in_chunk] - first] = 1
+        below = np.zeros ((n_nodes, last - first), dtype=np.float64) # distances to leaves in subtree
+        for nodes, (parents, starts) in zip(self.levels[:0:-1], self.level_parents[:0:-1]): # postorder, level-wise
+            below[parents] += np.add.reduceat (below[nodes] + self.edge_length[nodes, None] * count[nodes], starts, axis=0)
+            count[parents] += np.add.reduceat (count[nodes], starts, axis=0)
+        total = count[0] # number of leaves of each class (root has all)
+        for nodes in self.levels[1:]: # preorder: moving down an edge, the subtree gets closer and all others farther
+            below[nodes] = below[self.parent[nodes]] + self.edge_length[nodes, None] * (total[None, :] - 2 * count[nodes])
+        return below[self.leaves], total
+
+    def silhouette_samples (self, class_labels, max_cells = 1 << 22):
+        '''
+        silhouette score of each leaf (same as sklearn.metrics.silhouette_samples on the patristic distance matrix),
+        given the class label of each of self.leaves, without building the distance matrix
+        '''
+        names, classes = np.unique (np.asarray (class_labels, dtype=object).astype(str), return_inverse=True)
+        classes = classes.ravel()
+        n_classes = len(names)
+        n_leaves = len(classes)
+        if not 2 <= n_classes <= n_leaves - 1:
+            raise ValueError (f"Number of labels is {n_classes}. Valid values are 2 to n_samples - 1 (inclusive)")
+        own = np.zeros (n_leaves, dtype=np.float64) # a(i): mean distance to other leaves of same class
+        other = np.full (n_leaves, np.inf, dtype=np.float64) # b(i): smallest mean distance to another class
+        chunk = max(1, max_cells // len(self.parent))
+        rows = np.arange (n_leaves)
+        for first in range(0, n_classes, chunk):
+            last = min(first + chunk, n_classes)
+            sums, total = self.class_distance_sums (classes, n_classes, first, last)
+            in_chunk = (classes >= first) & (classes < last)
+            cols = classes[in_chunk] - first
+            with np.errstate (divide="ignore", invalid="ignore"):
+                own[in_chunk] = sums[rows[in_chunk], cols] / (total[cols] - 1) # nan for singletons
+                means = sums / total[None, :]
+            means[rows[in_chunk], cols] = np.inf
+            np.minimum (other, means.min(axis=1), out=other)
+        # rerooted sums carry rounding errors of order eps * n_leaves * (largest distance), and thus leaves at distance
+        # zero from their class and from the closest other class could have a(i),b(i) ~ 1e-16 and a nonzero score
+        tolerance = 4 * np.finfo(np.float64).eps * n_leaves * self.root_dist.max()
+        own[own < tolerance] = 0.
+        other[other < tolerance] = 0.
+        with np.errstate (divide="ignore", invalid="ignore"):
+            scores = np.nan_to_num ((other - own) / np.maximum (own, other)) # 0/0 is zero, as in sklearn
+        scores[np.bincount (classes, minlength=n_classes)[classes] == 1] = 0 # singletons
+        return scores
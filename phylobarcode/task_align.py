@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json? imports itertools, pathlib
-import pandas as pd, numpy as np
-import io, multiprocessing, shutil, gffutils, json, collections
-from Bio.Blast import NCBIXML
+import pandas as pd, numpy as np, dendropy, treeswift
+from phylobarcode.pb_taxonomy import TaxonomyIndex
+import io, multiprocessing, shutil, json, collections
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 logger = logging.getLogger("phylobarcode_global_logger")
@@ -27,15 +27,14 @@ def cluster_align_gene_files (genefiles = None, output = None, nthreads = 1, thr
         scratch_created = True
 
     if tsvfile is not None:
-        taxon_df = pd.read_csv(tsvfile, sep='\t', header=0)
-        taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, replace="unknown")
+        taxonomy = TaxonomyIndex.from_file (tsvfile)
     else:
-        taxon_df = None
+        taxonomy = None
 
     shortname = remove_prefix_suffix (genefiles)
     tbl = []
     for short, long in zip(shortname, genefiles):
-        tbl_row = cluster_align_each_gene (short, long, output, scratch, taxon_df, threshold, nthreads)
+        tbl_row = cluster_align_each_gene (short, long, output, scratch, taxonomy, threshold, nthreads)
         if tbl_row is not None: tbl.append(tbl_row)
 
     if scratch_created:
@@ -46,19 +45,20 @@ def cluster_align_gene_files (genefiles = None, output = None, nthreads = 1, thr
     df.to_csv(f"{ofilename}", sep='\t', index=False)
     logger.info(f"statistics save to {ofilename}")
 
-def get_seqinfo_from_sequence_header (xid, xdescription, taxon_df = None):
-    seqid = xid.split("|")[0] # remove gene name e.g. ">NZ_CP028136.1|S31"
-    if taxon_df is not None:
-        tx = taxon_df.loc[taxon_df['seqid'] == seqid].iloc[0]
-        seqinfo = {
-                "seqid": seqid, 
-                "species": tx['species'], 
-                "genus": tx['genus'],
-                "family": tx['family'], 
-                "order": tx['order']}
-    else:
+def get_seqinfo_from_sequence_header (xid, xdescription, taxonomy = None):
+    return get_seqinfo_from_sequence_headers ([xid], [xdescription], taxonomy)[xid]
+
+def get_seqinfo_from_sequence_headers (xids, xdescriptions, taxonomy = None):
+    ''' dict of sequence name -> seqinfo, with taxonomy of all sequences found at once if TaxonomyIndex is given '''
+    seqids = [x.split("|")[0] for x in xids] # remove gene name e.g. ">NZ_CP028136.1|S31"
+    if taxonomy is not None:
+        tx = {rank: taxonomy.labels (rank, seqids) for rank in ["species", "genus", "family", "order"]}
+        return {x: {"seqid": seqid, "species": tx["species"][i], "genus": tx["genus"][i], "family": tx["family"][i], 
+            "order": tx["order"][i]} for i, (x, seqid) in enumerate (zip (xids, seqids))}
+    seqinfo = {}
+    for x, seqid, xdescription in zip (xids, seqids, xdescriptions):
         tx = xdescription.split(" ", 1)[1].split("|")[1:5] # |order|family|genus|species|
-        seqinfo = {
+        seqinfo[x] = {
                 "seqid": seqid,
                 "species": tx[3],
                 "genus": tx[2],
@@ -66,14 +66,13 @@ def get_seqinfo_from_sequence_header (xid, xdescription, taxon_df = None):
                 "order": tx[0]}
     return seqinfo
 
-def cluster_align_each_gene (shortname, genefile, outfile, scratch, taxon_df, threshold, nthreads):
+def cluster_align_each_gene (shortname, genefile, outfile, scratch, taxonomy, threshold, nthreads):
     fas = read_fasta_as_list (genefile)
     if len(fas) < 4:
         logger.warning (f"{genefile} has fewer than 4 sequences, skipping")
         return None
     logger.info(f"Read {shortname} gene (file {genefile}) with {len(fas)} sequences")
-    seqinfo = {}
-    for x in fas: seqinfo[x.id] = get_seqinfo_from_sequence_header (x.id, x.description, taxon_df)
+    seqinfo = get_seqinfo_from_sequence_headers ([x.id for x in fas], [x.description for x in fas], taxonomy)
 
     stats = {"gene": shortname, 
             "n_sequences": len(fas),
@@ -85,8 +84,13 @@ def cluster_align_each_gene (shortname, genefile, outfile, scratch, taxon_df, th
     logger.info(f"Found {stats['n_species']} species in {shortname} gene")
     cdfile = f"{scratch}/{shortname}.cdhit"
     alnfile = f"{outfile}.{shortname}.aln"
+    # identical sequences would be clustered together anyway, thus cd-hit sees only distinct ones
+    uniq_fas, members = collapse_identical_sequences (fas)
+    stats["n_distinct_sequences"] = len(uniq_fas)
+    logger.info(f"Found {len(uniq_fas)} distinct sequences in {shortname} gene")
     # cdhit_cluster_seqs() will recreate (uncompressed) fasta file since infile may be compressed
-    rep_seqs, clusters = cdhit_cluster_seqs (sequences = fas, outfile=cdfile, nthreads=nthreads, id = threshold)
+    rep_seqs, clusters = cdhit_cluster_seqs (sequences = uniq_fas, outfile=cdfile, nthreads=nthreads, id = threshold)
+    clusters = expand_collapsed_clusters (clusters, members)
     logger.info(f"CD-HIT clustered {shortname} gene into {len(clusters)} clusters")
     n_species = [len(set([seqinfo[x]["species"] for x in cl])) for cl in clusters if len(cl) > 1]
     max_species = max(n_species)
@@ -124,7 +128,7 @@ def cluster_align_each_gene (shortname, genefile, outfile, scratch, taxon_df, th
 ### tree and silhouette 
 
 def estimate_compare_trees (alnfiles = None, output = None, scratch = None, tsvfile = None, 
-        gtdb_tree = None, prev_tsv = None, rapidnj = None, nthreads = 1):
+        gtdb_tree = None, prev_tsv = None, rapidnj = None, matrix_free = None, nthreads = 1):
     hash_name = '%012x' % random.randrange(16**12)
     if alnfiles is None:
         logger.error("No alignment files specified")
@@ -137,18 +141,18 @@ def estimate_compare_trees (alnfiles = None, output = None, scratch = None, tsvf
         logger.warning(f"No output file (prefix) provided, using {output}")
     if rapidnj is None: rapidnj = False
     if rapidnj is not False: rapidnj = True
+    if matrix_free is None: matrix_free = False
     if not os.path.exists(scratch):
         pathlib.Path(scratch).mkdir(parents=True, exist_ok=True)
         scratch_created = True
     if tsvfile is not None:
         logger.info(f"Reading taxonomic information from {tsvfile}")
-        taxon_df = pd.read_csv(tsvfile, sep='\t', header=0)
-        taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, replace="unknown")
+        taxonomy = TaxonomyIndex.from_file (tsvfile)
     else:
-        taxon_df = None
-    if gtdb_tree is not None and taxon_df is not None:
+        taxonomy = None
+    if gtdb_tree is not None and taxonomy is not None:
         logger.info(f"Reading GTDB tree from {gtdb_tree}")
-        ref_tree = read_translate_gtdb_tree_dendropy (gtdb_tree, taxon_df)
+        ref_tree = read_translate_gtdb_tree_dendropy (gtdb_tree, taxonomy)
         ref_tree.write_tree_newick (f"gtdb.tree") ## treeswift 
         #ref_tree.write(path=f"gtdb.tree", schema="newick") ## dendropy
     else:
@@ -158,7 +162,7 @@ def estimate_compare_trees (alnfiles = None, output = None, scratch = None, tsvf
     shortname = remove_prefix_suffix (alnfiles)
     tbl = []
     for short, long in zip(shortname, alnfiles):
-        tbl_row = generate_tree (short, long, output, scratch, ref_tree, taxon_df, rapidnj, nthreads)
+        tbl_row = generate_tree (short, long, output, scratch, ref_tree, taxonomy, rapidnj, matrix_free, nthreads)
         tbl.append(tbl_row)
 
     if scratch_created:
@@ -174,9 +178,10 @@ def estimate_compare_trees (alnfiles = None, output = None, scratch = None, tsvf
     df.to_csv(f"{ofilename}", sep='\t', index=False)
     logger.info(f"statistics save to {ofilename}")
 
-def read_translate_gtdb_tree_dendropy (treefile, taxon_df): # both have to be present (i.e. not None)
+def read_translate_gtdb_tree_dendropy (treefile, taxonomy): # both have to be present (i.e. not None)
     tree = dendropy.Tree.get_from_path(treefile, schema="newick", preserve_underscores=True)
-    uniq_taxa = taxon_df["gtdb_genome_representative"].unique() # taxon_df["gtdb_accession"]
+    representatives = taxonomy.groups ("gtdb_genome_representative") # representative -> seqids, built once
+    uniq_taxa = list(representatives.keys()) # taxon_df["gtdb_accession"]
     logger.info(f"Read tree with {len(tree.taxon_namespace)} leaves; will now remove internal node annotations")
     for node in tree.postorder_node_iter():
         node.label = None # gtdb has internal node annotations (which in dendropy are distinct from node.taxon.label)
@@ -189,7 +194,7 @@ def read_translate_gtdb_tree_dendropy (treefile, taxon_df): # both have to be pr
     leaf_map = swtree.label_to_node(selection="leaves") ## cannot use traverse_leaves() since new leaves confuse the iterator
     for lab, node in leaf_map.items():
         if lab == "": continue ## treeswift sometimes thinks an internal node is a leaf
-        newlabel = list(set(taxon_df[taxon_df["gtdb_genome_representative"] == lab]["seqid"].tolist()))
+        newlabel = representatives.get (lab, [])
         if len(newlabel) == 1:
             node.label = newlabel[0]
         else:
@@ -201,20 +206,26 @@ def read_translate_gtdb_tree_dendropy (treefile, taxon_df): # both have to be pr
     #return dendropy.Tree.get_from_string(swtree.newick(), schema="newick", preserve_underscores=True)
     return swtree
 
-def generate_tree (shortname, alnfile, output, scratch, reference_tree, taxon_df, rapidnj, nthreads):
+def generate_tree (shortname, alnfile, output, scratch, reference_tree, taxonomy, rapidnj, matrix_free, nthreads):
     treefile = f"{output}.{shortname}.tre"
     seqinfo = read_fasta_headers_as_list (alnfile)
     seqinfo = [x.split(" ", 1) for x in seqinfo] #  split id and description
-    seqinfo = {x[0]:get_seqinfo_from_sequence_header (x[0], x[1], taxon_df) for x in seqinfo}
+    seqinfo = get_seqinfo_from_sequence_headers ([x[0] for x in seqinfo], [x[1] for x in seqinfo], taxonomy)
     logger.info(f"Read seqinfo from {len(seqinfo)} sequences in {shortname} alignment")
 
-    def stats_silhouette (treestring, class_dict):
+    ranks = ["species", "genus", "family", "order"]
+    def stats_silhouette (treestring, class_table): # quantiles of scores, for all ranks from same distances
         try:
-            labdic = silhouette_score_from_newick_swift (treestring, class_dict)
-            vals = [x for x in labdic.values()]
-            return [np.quantile(vals, 0.01), np.quantile(vals, 0.05), np.quantile(vals, 0.5)]
-        except:
-            return [None, None, None]
+            scores = silhouette_score_from_newick_ranks (treestring, class_table, ranks, matrix_free = matrix_free)
+        except Exception as e: # e.g. tree leaf missing from table
+            logger.warning (f"Could not calculate silhouette scores for {shortname}: {e}")
+            scores = {}
+        sstats = {}
+        for rank in ranks:
+            vals = list(scores[rank].values()) if scores.get(rank) else None
+            for q, qname in [(0.01, "1pct"), (0.05, "5pct"), (0.5, "median")]:
+                sstats[f"{rank}_{qname}"] = np.quantile(vals, q) if vals else None
+        return sstats
     
     if not os.path.exists(treefile):
         logger.info(f"Generating tree for {shortname}")
@@ -271,19 +282,10 @@ def generate_tree (shortname, alnfile, output, scratch, reference_tree, taxon_df
             }}
         logger.info(f"Reference tree has {len(commontaxa)} leaves in common with gene tree, saved to {outreffile}")
 
-    ## calc silhouette using treestrings (use dict for both genetree and reftree)
-    class_dict_sp = {y["seqid"]:y["species"] for y in seqinfo.values()}
-    class_dict_genus = {y["seqid"]:y["genus"] for y in seqinfo.values()}
-    sp_stats = stats_silhouette (gtre_str, class_dict_sp)
-    ge_stats = stats_silhouette (gtre_str, class_dict_genus)
-    stats = {**stats, **{
-        "gene_sscore_species_1pct": sp_stats[0],
-        "gene_sscore_species_5pct": sp_stats[1],
-        "gene_sscore_species_median": sp_stats[2],
-        "gene_sscore_genus_1pct": ge_stats[0],
-        "gene_sscore_genus_5pct": ge_stats[1],
-        "gene_sscore_genus_median": ge_stats[2],
-        }}
+    ## calc silhouette using treestrings (use same table for both genetree and reftree)
+    class_table = {y["seqid"]:y for y in seqinfo.values()}
+    sstats = stats_silhouette (gtre_str, class_table)
+    stats = {**stats, **{f"gene_sscore_{k}":v for k,v in sstats.items()}}
     logger.info(f"Silhouette scores for {shortname} calculated")
 
     if reference_tree is not None: # gdendro and tdendro are dendropy trees, used in Euclidean distance
@@ -294,16 +296,8 @@ def generate_tree (shortname, alnfile, output, scratch, reference_tree, taxon_df
             if x.edge_length is not None:
                 x.edge_length /= stats["gene_phylodiversity"]
         stats["blen_distance"] =  dendropy.calculate.treecompare.euclidean_distance(rdendro, gdendro)
-        sp_stats = stats_silhouette (rtre_str, class_dict_sp)
-        ge_stats = stats_silhouette (rtre_str, class_dict_genus)
-        stats = {**stats, **{
-            "ref_sscore_species_1pct": sp_stats[0],
-            "ref_sscore_species_5pct": sp_stats[1],
-            "ref_sscore_species_median": sp_stats[2],
-            "ref_sscore_genus_1pct": ge_stats[0],
-            "ref_sscore_genus_5pct": ge_stats[1],
-            "ref_sscore_genus_median": ge_stats[2],
-            }}
+        sstats = stats_silhouette (rtre_str, class_table)
+        stats = {**stats, **{f"ref_sscore_{k}":v for k,v in sstats.items()}}
 
     return stats
 
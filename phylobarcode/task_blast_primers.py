@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json?
 import pandas as pd, numpy as np
+from phylobarcode.pb_taxonomy import TaxonomyIndex, ranks
 import itertools, io, multiprocessing
-from Bio.Blast import NCBIXML
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 
@@ -33,11 +33,9 @@ def blast_primers_from_tsv (tsv=None, output=None, database = None, evalue=1, ta
     primers_l = df_l["primer"].tolist()
     logger.info(f"Read {len(primers_l)} primers from file {tsv}")
     if taxon:
-        taxon_df = pd.read_csv (taxon, compression="infer", sep="\t", dtype='unicode')
+        taxon_df = TaxonomyIndex.from_file (taxon, columns = ["gff_taxonid"]).dataframe (["gff_taxonid"] + ranks)
         # use taxonid from gff file and NOT from GTDB taxonomy (since we may have fewer); however gtdb_taxonomy has e.g.
         # d__Bacteria;p__Firmicutes;c__Bacilli;o__Bacillales;f__Bacillaceae_H;g__Priestia;s__Priestia megaterium
-        taxon_df = taxon_df[["seqid","gff_taxonid", "gtdb_taxonomy"]]
-        taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, drop_gtdb_column = True) # True = drop original column
         taxon_df = taxon_df.rename(columns={"seqid":"sseqid", "gff_taxonid":"taxonid"})
         logger.info(f"Read {len(taxon_df)} entries with taxonomic information from file {taxon}")
     else:
@@ -100,11 +98,9 @@ def blast_primers_from_tsvORIGINAL (tsv=None, output=None, database = None, eval
     primers_r = df_r["primer"].tolist()
     logger.info(f"Read {len(primers_r)} primers from file {tsv[1]}; Running blast now")
     if taxon:
-        taxon_df = pd.read_csv (taxon, compression="infer", sep="\t", dtype='unicode')
+        taxon_df = TaxonomyIndex.from_file (taxon, columns = ["gff_taxonid"]).dataframe (["gff_taxonid"] + ranks)
         # use taxonid from gff file and NOT from GTDB taxonomy (since we may have fewer); however gtdb_taxonomy has e.g.
         # d__Bacteria;p__Firmicutes;c__Bacilli;o__Bacillales;f__Bacillaceae_H;g__Priestia;s__Priestia megaterium
-        taxon_df = taxon_df[["seqid","gff_taxonid", "gtdb_taxonomy"]]
-        taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, drop_gtdb_column = True) # True = drop original column
         taxon_df = taxon_df.rename(columns={"seqid":"sseqid", "gff_taxonid":"taxonid"})
         logger.info(f"Read {len(taxon_df)} entries with taxonomic information from file {taxon}")
     else:
@@ -184,16 +180,16 @@ def query_primers_blastn_on_database (primer_list, database=None, evalue = 1, ta
                 or '.nsq');");
         return 
     ## output is format 6 plus aligned query plus aligned subject
-    cline = f"blastn -query - -db {database} -evalue {evalue} -task \"{task}\" -word_size 7 -out - \
-              -outfmt \"6 std qseq sseq\"  -max_target_seqs {max_target_seqs} -num_threads {ncpus}"
-    child = subprocess.Popen(cline, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                            universal_newlines=True, shell=(sys.platform!="win32"))
-    records = [SeqRecord(Seq.Seq(seq), id=seq) for seq in primer_list] ## head is primer itself (like "> ACGTGT") 
-    SeqIO.write(records, child.stdin, "fasta")
-    child.stdin.close()
-    # print(child.stdout.read()) ## can be used only once since child is closed
+    cline = ["blastn", "-query", "-", "-db", database, "-evalue", evalue, "-task", task, "-word_size", 7, "-out", "-",
+              "-outfmt", "6 std qseq sseq", "-max_target_seqs", max_target_seqs, "-num_threads", ncpus]
+    records = (f">{seq}\n{seq}\n" for seq in primer_list) ## head is primer itself (like "> ACGTGT") 
+    try:
+        output, stderr = run_tool (cline, input = records)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error running blastn: {e}\n{e.stderr}")
+        return None
     try:
-        df = pd.read_table (io.StringIO(child.stdout.read()), header=None)
+        df = pd.read_table (io.StringIO(output), header=None)
     except pd.errors.EmptyDataError:
         logger.error("No data returned from blast; If you are sure the database location and name are correct (I guess"
                 "they are not!), then try increasing evalue and not using `accurate` task")
@@ -209,11 +205,11 @@ def calculate_stats_and_write_files (blast, output, df, taxon_df=None):
     blast["len_match_diff"] = blast["qseqid"].str.len() - blast["length"]
 
     ofname = output + ".raw.tsv.xz"
-    blast.to_csv (ofname, sep="\t", index=False)
+    save_dataframe_as_tsv (blast, ofname)
     logger.info(f"Wrote {len(blast)} raw BLAST hits to file {ofname}")
     df0 = stats_merge_blast_and_primers (blast, df)
     ofname = output + ".stats.tsv.xz"
-    df0.to_csv (ofname, sep="\t", index=False)
+    save_dataframe_as_tsv (df0, ofname)
     logger.info(f"Wrote stats about {len(df0)} primers to file {ofname}")
     return blast, df0
 
@@ -387,6 +383,7 @@ def query_string_blastn_on_database (seqstring, database=None, evalue = 1, task=
     task = "blastn-short" (more precise) or task = "blastn" 
     this is the original function using biopython NCBIXML (you need to see refseq_riboprotein.py for how to parse output)
     """
+    from Bio.Blast import NCBIXML
     if database is None:
         database = database_fallback
         logger.error(f"I need a database (full path with prefix of DB in blast format; usually filename without '.nal' \
@@ -2,9 +2,8 @@
 from phylobarcode.pb_common import *  ## better to have it in json?
 from phylobarcode.pb_kmer import *   ## map_clusters_to_indices() 
 import pandas as pd, numpy as np
-import itertools, pathlib, shutil, gzip, parasail
-from Bio import pairwise2
-from sklearn import cluster
+import itertools, pathlib, shutil, gzip
+# parasail and sklearn are imported by the functions that need them, s.t. subsample_primers does not load them
 
 ## TODO: subsample with both quantile (to purge really bad samples) and then get best N samples. Thus it would be
 # intersection but with high subsample percenteage
@@ -96,7 +95,7 @@ def cluster_primers_from_tsv (tsv = None, output = None, subsample=100, threshol
     df = merge_vsearch_profiles (df, identity = threshold, nthreads = nthreads)
     df = reorder_dataframe_by_clusters (df)
     logger.info (f"Found {len(df['cluster'].unique())} clusters of vsearch profiles, writing to file {output}.tsv.xz")
-    df.to_csv (f"{output}.tsv.xz", sep="\t", index=False)
+    save_dataframe_as_tsv (df, f"{output}.tsv.xz")
     return
 
 def subsample_primers_from_tsv (tsv = None, output = None, subsample=100, n_elements=None):
@@ -114,7 +113,7 @@ def subsample_primers_from_tsv (tsv = None, output = None, subsample=100, n_elem
     
     df = subsample_primers (df, subsample=subsample, n_elements=n_elements)
     logger.info (f"Writing {len(df)} primers to file {output}.tsv.xz")
-    df.to_csv (f"{output}.tsv.xz", sep="\t", index=False)
+    save_dataframe_as_tsv (df, f"{output}.tsv.xz")
     return
 
 def reorder_dataframe_by_clusters (df):
@@ -303,9 +302,8 @@ def vsearch_clustering_sequences (seqs, seqnames, maxdiffs=8, maxgaps=10, identi
             f.write(str(f">{seqname}\n{seq}\n").encode())
 
     # run vsearch and store centroids into unzipped tmpfile
-    runstr = f"vsearch --cluster_fast {fastafile} --minseqlength 8 --maxdiffs {maxdiffs} --maxgaps {maxgaps} " + \
-             f"--id {identity} --threads {nthreads} --uc {ucfile} --consout {consfile} --profile {profile}"
-    proc_run = subprocess.check_output(runstr, shell=(sys.platform!="win32"), universal_newlines=True)
+    run_tool (["vsearch", "--cluster_fast", fastafile, "--minseqlength", 8, "--maxdiffs", maxdiffs, "--maxgaps", maxgaps,
+             "--id", identity, "--threads", nthreads, "--uc", ucfile, "--consout", consfile, "--profile", profile])
     # https://manpages.debian.org/stretch/vsearch/vsearch.1 : no headers, and first column is a hits (H), centroid (S), or cluster (C) info
     vclus = pd.read_csv(ucfile, sep="\t", names=["rectype","v_cluster","seqname"], usecols=[0,1,8]) 
     vclus = vclus[vclus["rectype"].isin(["S","H"])] # keep only centroids and non-centroids (Hits), excluding summary "C"
@@ -339,6 +337,7 @@ def pairwise_identity_matches (s1, s2, mode = "cdhit"):
     '''
     identity based on number of matches (https://manpages.debian.org/stretch/vsearch/vsearch.1)
     '''
+    import parasail
     sim = parasail.sg_stats_striped_16(s1, s2, 14, 1, parasail.pam10)
     if mode == "cdhit":  x = sim.matches / min(sim.len_query, sim.len_ref) # CD-HIT similarity (always larger than others)
     elif mode == "edit": x = sim.matches / sim.length # edit distance (larger than MBL but lower than CD-HIT)
@@ -423,8 +422,7 @@ def find_centroids_from_file_vsearch (fastafile=None, output=None, identity=0.95
     if nthreads < 1: nthreads = 1
     tmpfile = os.path.join(scratch, "tmp." + '%012x' % random.randrange(16**12) + ".fasta")
     # run vsearch and store centroids into unzipped tmpfile
-    runstr = f"vsearch --cluster_fast {fastafile} --id {identity} --centroids {tmpfile} --threads {nthreads}"
-    proc_run = subprocess.check_output(runstr, shell=(sys.platform!="win32"), universal_newlines=True)
+    run_tool (["vsearch", "--cluster_fast", fastafile, "--id", identity, "--centroids", tmpfile, "--threads", nthreads])
     # gzip tmpfile into output file
     with open(tmpfile, 'rb') as f_in, gzip.open(output, 'wb') as f_out: f_out.writelines(f_in)
     # delete tmp file
@@ -432,6 +430,7 @@ def find_centroids_from_file_vsearch (fastafile=None, output=None, identity=0.95
 
 # affinity propagation returns representatives, using similiarity matrix as input; birch needs features
 def find_representatives_from_sequences_optics (sequences=None, names=None, output=None, min_samples=2, nthreads=1):
+    from sklearn import cluster
     if sequences is None:
         logger.error("No sequences provided to OPTICS")
         return
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json? imports itertools, pathlib
+from phylobarcode.pb_faidx import genome_sequence_from_fasta, GenomePrefetcher
+from phylobarcode.pb_genomestore import open_genome_store, StoredSequence
+from phylobarcode import pb_pool, pb_seqkernel
 import pandas as pd, numpy as np
-import io, multiprocessing, shutil, gffutils, json, collections
-from Bio.Blast import NCBIXML
+import io, multiprocessing, shutil, json, collections
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 
@@ -27,7 +29,7 @@ genesets["right"]    += genesets["core"]
 
 def extract_operons_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir=None, output=None, 
         intergenic_space = 1000, short_operon = 1000, most_common_mosaics = 50, border = 50, riboprot_subset = None, 
-        nthreads=1, scratch=None):
+        genome_store = None, prefetch = 4, sampler = None, nthreads=1, scratch=None):
     hash_name = '%012x' % random.randrange(16**12) 
     if coord_tsvfile is None:
         logger.error ("No TSV file with riboprot coordinates from GFF3 files given, exiting"); sys.exit(1)
@@ -64,6 +66,8 @@ def extract_operons_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir
     if merge_df.empty:
         logger.error (f"Merged file {merge_tsvfile} with fasta x GFF3 info is empty, exiting"); sys.exit(1)
     merge_df = split_gtdb_taxonomy_from_dataframe (merge_df)
+    if sampler is not None: # stratified subsample of genomes (pb_taxonomy.StratifiedSampler)
+        coord_df = coord_df[coord_df["seqid"].isin (sampler.sample (merge_tsvfile))]
 
     if isinstance (riboprot_subset, str) and riboprot_subset in genesets:
         coord_df = coord_df[coord_df["product"].isin(genesets[riboprot_subset])]
@@ -81,23 +85,25 @@ def extract_operons_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir
     if (nthreads > 1): ## multiple threads
         logger.info (f"Extracting operons from {len(genome_list)} genomes using {nthreads} threads")
         logger.info (f"Thread is named after first file in pool (i.e. name is arbitrary and does not relate to file itself)")
-        from multiprocessing import Pool
         from functools import partial
-        genome_chunks = [genome_list[i::nthreads] for i in range(nthreads)]
+        sizes = genome_file_sizes (genome_list, merge_df, fastadir)
+        genome_chunks = pb_pool.size_batches (genome_list, sizes, nthreads) # several batches per thread, largest first
         g_pool = []
         for g in genome_chunks:
             cdf = coord_df[coord_df["seqid"].isin(g)]
             mdf = merge_df[merge_df["seqid"].isin(g)]
             fname = f"{scratch}/coord.{g[0]}.gz"
             g_pool.append ([cdf, mdf, fname])
-        with Pool(len(genome_chunks)) as p:
-            results = p.map( partial(
-                        extract_and_save_operons, 
-                        fastadir=fastadir, 
-                        intergenic_space=intergenic_space, 
-                        short_operon=short_operon,
-                        border=border),
-                    g_pool)
+        results = pb_pool.pool_map (partial(
+                    extract_and_save_operons, 
+                    fastadir=fastadir, 
+                    genome_store=genome_store,
+                    prefetch=prefetch,
+                    intergenic_space=intergenic_space, 
+                    short_operon=short_operon,
+                    border=border,
+                    verbose=False),
+                g_pool, nthreads, description = "batches of genomes")
         #results = [elem for x in results for elem in x] # flatten list of lists [[1,2],[3,4]] -> [1,2,3,4]
         mosdict = results[0]
         for r in results[1:]:
@@ -109,8 +115,8 @@ def extract_operons_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir
         logger.info (f"Extracting operons from {len(genome_list)} genomes using one thread")
         logger.info (f"Thread is named arbitrarily")
         g_pool = [[coord_df, merge_df, f"{scratch}/coord.fa.gz"]] # list of lists to be compatible with multithreaded
-        mosdict = extract_and_save_operons (g_pool[0], fastadir=fastadir, intergenic_space=intergenic_space,
-            short_operon=short_operon, border=border)
+        mosdict = extract_and_save_operons (g_pool[0], fastadir=fastadir, genome_store=genome_store, prefetch=prefetch,
+            intergenic_space=intergenic_space, short_operon=short_operon, border=border)
     
     # mosdict has a list of mosaics for each phylum; we'll create a Counter per phylum
     moscounter = {k:collections.Counter(v) for k,v in mosdict.items()}
@@ -136,10 +142,10 @@ def save_mosaics_as_fasta (operon_seqs, output, mosaics):
     for i, m in enumerate(mosaics):
         ofile = f"{output}.seq-{m}.fasta.xz"
         counter = 0
-        with open_anyformat (ofile, "w") as f:
+        with BackgroundWriter (ofile) as f: # compression runs in parallel with the loop
             for rec in operon_seqs:
                 if rec.description.split()[1] == m: # header has format "> genomeID mosaic description"
-                    f.write (str(f">{rec.description}\n{rec.seq}\n").encode())
+                    f.write (f">{rec.description}\n{rec.seq}\n")
                     counter += 1
         if i < 5:
             logger.info (f"Succesfully saved {counter} operons to {ofile}")
@@ -165,11 +171,13 @@ def save_mosaic_frequency (moscounter, pooled, output):
                 f.write (str(f"\t{moscounter[p][m]}").encode())
             f.write (str(f"\n").encode())
 
-def extract_and_save_operons (pool_info, fastadir, intergenic_space=1000, short_operon=1000, border=50):
+def extract_and_save_operons (pool_info, fastadir, intergenic_space=1000, short_operon=1000, border=50, genome_store=None,
+        prefetch=4, verbose=True):
     coord_df, merge_df, fname = pool_info
+    if genome_store is not None: genome_store = open_genome_store (genome_store) # memory-mapped, opened once per worker
     merge_df["phylum"] = merge_df["phylum"].fillna("unknown")
     genome_list = coord_df["seqid"].unique().tolist()
-    fw = open_anyformat (fname, "w")
+    fw = BackgroundWriter (fname) # writes and compresses on a separate thread while we extract operons
 
     def operon_from_coords (genome_sequence, coord_df):
         coord_df = coord_df.sort_values(by=["start"], ascending=True)
@@ -221,40 +229,54 @@ def extract_and_save_operons (pool_info, fastadir, intergenic_space=1000, short_
 
     def dict_of_operons (minioperons, genome_sequence, extra_space=0):
         operons = {}
-        if extra_space > 0: genome_sequence = genome_sequence + genome_sequence[:extra_space]
-        # minioperon is a list of [[gene1, ..., geneN], [start, end], strand]
+        # minioperon is a list of [[gene1, ..., geneN], [start, end], strand]; end may go beyond genome length (by at
+        # most extra_space), in which case we add the beginning of the genome instead of copying the whole genome
+        genome_length = len(genome_sequence)
+        def circular_slice (start, end, reverse_complement): # end is inclusive
+            if isinstance (genome_sequence, StoredSequence): # store handles origin and reverse complement on views
+                return genome_sequence.circular_slice (start, end + 1, reverse_complement)
+            if end < genome_length: seq = genome_sequence[start:end+1]
+            else: seq = genome_sequence[start:] + genome_sequence[:end + 1 - genome_length]
+            return pb_seqkernel.reverse_complement (seq) if reverse_complement else seq
         for m in minioperons:
             if (m[2] == "-"):
-                seq = genome_sequence[m[1][0]:m[1][1]+1].reverse_complement()
+                seq = circular_slice (m[1][0], m[1][1], True)
                 name = "".join (m[0][::-1]) # merge all gene names, like "L1L2L3"
             else:
-                seq = genome_sequence[m[1][0]:m[1][1]+1]
+                seq = circular_slice (m[1][0], m[1][1], False)
                 name = "".join (m[0]) # merge all gene names, like "L1L2L3"
             operons[name] = seq
         return operons
 
     # save all operon mosaics into same fasta file; return dict with list of mosaics per phylum
     mosaics = {}
-    n_genomes = len(genome_list)
-    for i, g in enumerate(genome_list):
-        cdf = coord_df[coord_df["seqid"] == g]
-        mdf = merge_df[merge_df["seqid"] == g]
-        # replace na values for "unknown"
-        if len(cdf) < 2 or len(mdf) < 1: continue # some genomes, specially multi-chromosomal, have one gene 
+    genome_tables = {}
+    coord_groups, merge_groups = genome_groups (coord_df), genome_groups (merge_df) # o.w. one scan per genome
+    for g in genome_list:
+        cdf = coord_groups[g]
+        mdf = merge_groups.get (g)
+        if len(cdf) < 2 or mdf is None: continue # some genomes, specially multi-chromosomal, have one gene 
         # e.g. Burkholderia multivorans strain P1Bm2011b has 3 chromosomes
-
-        if i and i % (n_genomes//10) == 0: 
+        genome_tables[g] = (cdf, mdf)
+    n_genomes = len(genome_tables)
+
+    def load_genome (g):
+        # one fasta file can have multiple genomes; Seq-like object s.t. we can slice it (as strings); if
+        # fasta file is indexed (command `index_fasta`) or packed (`pack_fasta`) then only sliced regions are read
+        if genome_store is not None and g in genome_store: return genome_store[g]
+        return genome_sequence_from_fasta (os.path.join (fastadir, genome_tables[g][1]["fasta_file"].iloc[0]), g)
+
+    # next genomes are read and decompressed in background while operons are extracted from current one
+    for i, (g, genome_sequence) in enumerate(GenomePrefetcher (genome_tables.keys(), load_genome, depth = prefetch)):
+        cdf, mdf = genome_tables[g]
+        if verbose and i and i % max(1, n_genomes//10) == 0: # o.w. progress is logged by pb_pool
             logger.info (f"{round((i*100)/n_genomes,1)}% of files processed, {len(mosaics)} mosaics found so far from thread {fname[-32:]}")
-
-        genome_sequence = read_fasta_as_list (os.path.join (fastadir, mdf["fasta_file"].iloc[0]))
-        genome_sequence = [x for x in genome_sequence if x.id == g] # one fasta file can have multiple genomes, each
-        genome_sequence = genome_sequence[0].seq # biopython SeqRecord object s.t. we can reverse_complement() if needed
         operons = operon_from_coords (genome_sequence, cdf)
 
         phylum = mdf["phylum"].iloc[0] # phylum name or "unknown"
         for opr,seq in operons.items():
             name = f">{g} {opr} " + mdf["fasta_description"].iloc[0]
-            fw.write (str(f"{name}\n{seq}\n").encode())
+            fw.write (f"{name}\n{seq}\n")
             if phylum in mosaics:
                 mosaics[phylum].append (opr)
             else:
@@ -265,7 +287,8 @@ def extract_and_save_operons (pool_info, fastadir, intergenic_space=1000, short_
 ### task 2 : extract individual genes from genomes
 
 def extract_genes_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir=None, output=None, 
-                              scratch = None, keep_paralogs = False, nthreads = 1): 
+                              scratch = None, keep_paralogs = False, genome_store = None, prefetch = 4, sampler = None,
+                              nthreads = 1): 
     hash_name = '%012x' % random.randrange(16**12) 
     if coord_tsvfile  is None:
         logger.error ("No coordinates file provided"); sys.exit(1)
@@ -288,6 +311,8 @@ def extract_genes_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir=N
     if merge_df.empty:
         logger.error (f"Merged file {merge_tsvfile} with fasta x GFF3 info is empty, exiting"); sys.exit(1)
     merge_df = split_gtdb_taxonomy_from_dataframe (merge_df, replace="unknown")
+    if sampler is not None: # stratified subsample of genomes (pb_taxonomy.StratifiedSampler)
+        coord_df = coord_df[coord_df["seqid"].isin (sampler.sample (merge_tsvfile))]
 
     if nthreads > 1 and not os.path.exists(scratch): ## if single threaded we don't use scratch
         pathlib.Path(scratch).mkdir(parents=True, exist_ok=True) # create scratch subdirectory
@@ -298,25 +323,26 @@ def extract_genes_from_fasta (coord_tsvfile=None, merge_tsvfile=None, fastadir=N
     genome_list = coord_df["seqid"].unique().tolist()
     if nthreads > 1:
         logger.info (f"Extracting genes from {len(genome_list)} genomes using {nthreads} threads. Thread names are arbitrary")
-        from multiprocessing import Pool
         from functools import partial
-        genome_chunks = [genome_list[i::nthreads] for i in range(nthreads)]
+        sizes = genome_file_sizes (genome_list, merge_df, fastadir)
+        genome_chunks = pb_pool.size_batches (genome_list, sizes, nthreads) # several batches per thread, largest first
         g_pool = []
         for g in genome_chunks:
             cdf = coord_df[coord_df["seqid"].isin(g)]
             mdf = merge_df[merge_df["seqid"].isin(g)]
             dirname = f"{scratch}/{g[0]}/" # files will be "{scratch}/{genomeID}/{gn}.fasta"
-            pathlib.Path(dirname).mkdir(parents=True, exist_ok=True) # create one subdir per thread
+            pathlib.Path(dirname).mkdir(parents=True, exist_ok=True) # create one subdir per batch
             g_pool.append ([cdf, mdf, dirname])
-        with Pool(len(genome_chunks)) as p:
-            results = p.map(partial(extract_genes_from_fasta_per_thread, fastadir=fastadir, 
-                                    keep_paralogs = keep_paralogs), g_pool)
+        results = pb_pool.pool_map (partial(extract_genes_from_fasta_per_thread, fastadir=fastadir, keep_paralogs = keep_paralogs, 
+                                    genome_store = genome_store, prefetch = prefetch, verbose = False), 
+                                    g_pool, nthreads, description = "batches of genomes")
         results = list(set([element for sublist in results for element in sublist])) # flatten list of lists
         accumulate_gene_fasta_files (g_pool, results, output) ## merge fasta files from subdirs and delete them
 
     else:
         g_pool = [coord_df, merge_df, f"{output}."] ## files will be "{output}.{gn}.fa"
-        results = [extract_genes_from_fasta_per_thread (g_pool, fastadir=fastadir, keep_paralogs = keep_paralogs)]
+        results = [extract_genes_from_fasta_per_thread (g_pool, fastadir=fastadir, keep_paralogs = keep_paralogs, 
+                                                        genome_store = genome_store, prefetch = prefetch)]
 
     if scratch_created:
         shutil.rmtree(pathlib.Path(scratch)) # delete scratch subdirectory
@@ -334,29 +360,47 @@ def accumulate_gene_fasta_files (g_pool, gene_names, output):
     #for d in dirnames:
     #    shutil.rmtree(pathlib.Path(d))
 
-def extract_genes_from_fasta_per_thread (g_pool, fastadir, keep_paralogs=False):
+def genome_file_sizes (genome_list, merge_df, fastadir):
+    ''' size of the fasta file of each genome (zero if missing), to balance the work between threads '''
+    fasta_files = dict(zip(merge_df["seqid"], merge_df["fasta_file"]))
+    return pb_pool.file_sizes ([os.path.join (fastadir, fasta_files[g]) if g in fasta_files else "" for g in genome_list])
+
+def genome_groups (df):
+    ''' dict of seqid -> rows of df with this seqid (in original order) '''
+    return dict (tuple (df.groupby ("seqid", sort = False)))
+
+def extract_genes_from_fasta_per_thread (g_pool, fastadir, keep_paralogs=False, genome_store=None, prefetch=4, verbose=True):
     coord_df, merge_df, dirname = g_pool
+    if genome_store is not None: genome_store = open_genome_store (genome_store) # memory-mapped, opened once per worker
     genome_list = coord_df["seqid"].unique().tolist()
-    n_genomes = len(genome_list)
+    genome_tables = {}
+    coord_groups, merge_groups = genome_groups (coord_df), genome_groups (merge_df) # o.w. one scan per genome
+    for g in genome_list:
+        cdf = coord_groups[g]
+        mdf = merge_groups.get (g)
+        if len(cdf) < 2 or mdf is None: continue # some genomes, specially multi-chromosomal, have one gene 
+        genome_tables[g] = (cdf, mdf.iloc[0]) # only one row per genome
+    n_genomes = len(genome_tables)
+
+    def load_genome (g):
+        # one fasta file can have multiple genomes; Seq-like object s.t. we can slice it (as strings); if
+        # fasta file is indexed (command `index_fasta`) or packed (`pack_fasta`) then only sliced regions are read
+        if genome_store is not None and g in genome_store: return genome_store[g]
+        return genome_sequence_from_fasta (os.path.join (fastadir, genome_tables[g][1]["fasta_file"]), g)
+
     fnames_open = {}
-    for i, g in enumerate(genome_list):
-        cdf = coord_df[coord_df["seqid"] == g]
-        mdf = merge_df[merge_df["seqid"] == g]
-        if len(cdf) < 2 or len(mdf) < 1: continue # some genomes, specially multi-chromosomal, have one gene 
-        mdf = mdf.iloc[0] # only one row per genome
-        if i and i % int(n_genomes/10) == 0: 
+    # next genomes are read and decompressed in background while genes are extracted from current one
+    for i, (g, genome_sequence) in enumerate(GenomePrefetcher (genome_tables.keys(), load_genome, depth = prefetch)):
+        cdf, mdf = genome_tables[g]
+        if verbose and i and i % max(1, n_genomes//10) == 0: # o.w. progress is logged by pb_pool
             logger.info (f"{round((i*100)/n_genomes,0)}% of files ({n_genomes}) processed")
 
-        genome_sequence = read_fasta_as_list (os.path.join (fastadir, mdf["fasta_file"]))
-        genome_sequence = [x for x in genome_sequence if x.id == g] # one fasta file can have multiple genomes, each
-        genome_sequence = genome_sequence[0].seq # biopython SeqRecord object s.t. we can reverse_complement() if needed
-
         genes = {}
-        for x in cdf.itertuples(): ## assumes zero-based coordinates
-            if x.strand == "-":
-                gene_sequence = genome_sequence[int(x.start):int(x.end)+1].reverse_complement()
-            else:
-                gene_sequence = genome_sequence[int(x.start):int(x.end)+1]
+        rows = list(cdf.itertuples()) ## assumes zero-based coordinates
+        slices = [str(genome_sequence[int(x.start):int(x.end)+1]) for x in rows]
+        minus = [j for j, x in enumerate(rows) if x.strand == "-"] # reverse complemented in a single batch
+        for j, rc in zip (minus, pb_seqkernel.reverse_complement_list ([slices[j] for j in minus])): slices[j] = rc
+        for x, gene_sequence in zip (rows, slices):
             product = str(x.product).replace("_", "")
             if keep_paralogs: seqid = f"{x.seqid}|{product}|{x.start}" # name will include location number to distinguish paralogs
             else: seqid = f"{x.seqid}|{product}" # name will include location number to distinguish paralogs
@@ -373,10 +417,9 @@ def extract_genes_from_fasta_per_thread (g_pool, fastadir, keep_paralogs=False):
                 f = fnames_open[gn["gene"]]
             else:
                 fname = f"{dirname}{gn['gene']}.fasta"
-                f = open_anyformat (fname, "w")
+                f = open (fname, "w") # uncompressed scratch file, one per gene: buffered writes are enough (no thread)
                 fnames_open[gn["gene"]] = f
-            f.write (str(f">{seqname}\n{gn['seq']}\n").encode())
-            f.flush()
+            f.write (f">{seqname}\n{gn['seq']}\n")
 
     for f in fnames_open.values(): f.close()
     return list(fnames_open.keys())
@@ -400,7 +443,7 @@ def extract_genes_from_fasta_per_thread_old (g_pool, fastadiri, keep_paralogs=Tr
 
         for x in cdf.itertuples(): ## assumes zero-based coordinates
             if x.strand == "-":
-                gene_sequence = genome_sequence[int(x.start):int(x.end)+1].reverse_complement()
+                gene_sequence = pb_seqkernel.reverse_complement (genome_sequence[int(x.start):int(x.end)+1])
             else:
                 gene_sequence = genome_sequence[int(x.start):int(x.end)+1]
             if keep_paralogs: x.seqid = f"{x.seqid}|{x.start}" # name will include location number to distinguish paralogs
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json? imports itertools, pathlib
 import pandas as pd, numpy as np
-import io, multiprocessing, shutil, gffutils, json, collections
-from Bio.Blast import NCBIXML
+from phylobarcode.pb_gff import gff_cds_features, gff_cds_features_gffutils
+from phylobarcode import pb_manifest, pb_pool, pb_batch
+import io, multiprocessing, shutil, json, collections
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 
@@ -24,11 +25,7 @@ def extract_coordinates_from_gff (tsvfile=None, gffdir=None, output=None, jsonfi
         output = f"coordinates.{hash_name}"
         logger.warning (f"No output file specified, using {output} as prefix")
     if jsonfiles is None: 
-        jsonfiles = {
-                "riboproteins": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/riboproteins_names.json"),
-                "ribogenes": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/ribogenes_names.json"),
-                "extragenes": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/extragenes_names.json")
-                }
+        jsonfiles = default_json_files ()
 
     if scratch is None: ## this should not happen if function called from main script; use current directory 
         scratch = f"scratch.{hash_name}"
@@ -36,20 +33,40 @@ def extract_coordinates_from_gff (tsvfile=None, gffdir=None, output=None, jsonfi
     df = pd.read_csv (tsvfile, sep="\t", dtype=str)
     # currently we work only with genomes included in GTDB (i.e. QC passed)
     df.dropna(subset=["gtdb_accession"], inplace=True) # same as df = df[~df["gtdb_accession"].isnull()]
+    if "dedup_representative" in df.columns: # table from `merge_fasta_gff --dedup`
+        n_genomes = df["gtdb_accession"].nunique()
+        df = df[df["gtdb_accession"] == df["dedup_representative"]]
+        logger.info (f"Using only {df['gtdb_accession'].nunique()} representatives of near-identical genomes, out of {n_genomes}")
     n_files = len(df["gff_file"].unique())
     logger.info (f"Found {len(df)} genomes from {n_files} GFF3 files and GTDB taxonomic info from file {tsvfile}")
 
     jmap = read_json_files (jsonfiles)
 
+    unchanged = {} # fingerprints of GFF3 files with coordinates in coord_tsvfile, for the new manifest
     if coord_tsvfile is not None:
         coord_df = pd.read_csv (coord_tsvfile, sep="\t", dtype=str)
+        manifest = pb_manifest.read_manifest (pb_manifest.manifest_path (coord_tsvfile))
+        n_stale = 0
+        if manifest is None:
+            existing_seqids = coord_df["seqid"].unique()
+            existing_gff_files = df.loc[df["seqid"].isin(existing_seqids), "gff_file"].unique() # files with already extracted coordinates
+            df = df[~df["gff_file"].isin(existing_gff_files)]
+            logger.info (f"It is assumed that coordinates from all genomes (seqid) from each file in coordinate table"
+                    f"{coord_tsvfile} have been extracted.\n If this is not the case, please run the command again without"
+                    f"the --coord_tsvfile option (if, for instance, a GFF3 or a fasta file was updated).")
+            existing_gff_files = [os.path.join (gffdir, gf) for gf in existing_gff_files]
+            unchanged = pb_manifest.fingerprint_files ([gf for gf in existing_gff_files if os.path.isfile (gf)], nthreads)
+        else: # reuse only rows from files not modified since coord_tsvfile was created
+            gff_paths = [os.path.join (gffdir, gf) for gf in df["gff_file"].unique() if os.path.isfile (os.path.join (gffdir, gf))]
+            changed, unchanged = pb_manifest.compare_with_manifest (gff_paths, manifest)
+            n_stale = len(coord_df)
+            coord_df = coord_df[coord_df["seqid"].isin(df.loc[df["gff_file"].isin(unchanged.keys()), "seqid"])]
+            n_stale -= len(coord_df)
+            df = df[~df["gff_file"].isin(unchanged.keys())]
+            logger.info (f"Manifest of {coord_tsvfile}: {len(unchanged)} GFF3 files unchanged and {len(changed)} new or "
+                    f"modified; {n_stale} rows from modified or removed files (or genomes) will be dropped")
         existing_seqids = coord_df["seqid"].unique()
-        existing_gff_files = df.loc[df["seqid"].isin(existing_seqids), "gff_file"].unique() # files with already extracted coordinates
-        df = df[~df["gff_file"].isin(existing_gff_files)]
-        logger.info (f"It is assumed that coordinates from all genomes (seqid) from each file in coordinate table"
-                f"{coord_tsvfile} have been extracted.\n If this is not the case, please run the command again without"
-                f"the --coord_tsvfile option (if, for instance, a GFF3 or a fasta file was updated).")
-        if len(df) == 0:
+        if len(df) == 0 and n_stale == 0:
             logger.info(f"File {coord_tsvfile} has info about all {len(existing_seqids)} genomes")
             return 
         else:
@@ -67,38 +84,41 @@ def extract_coordinates_from_gff (tsvfile=None, gffdir=None, output=None, jsonfi
     if n_files < 1: 
         logger.error ("No GFF3 files available, exiting"); sys.exit(1)
 
-    if (nthreads > 1): # main() already checked that modules are available (o.w. nthreads=1)
+    if not gfiles: # only stale rows were removed from coord_tsvfile
+        results = []
+    elif (nthreads > 1): # main() already checked that modules are available (o.w. nthreads=1)
         logger.info (f"Extracting ribosomal proteins from {len(gfiles)} GFF3 files using up to {nthreads} threads")
         logger.info (f"Threads are named after first file in pool (i.e. names are arbitrary and do not relate to file itself)")
-        from multiprocessing import Pool
         from functools import partial
-        n_files = len (gfiles) # see below for alternative oneliner using slice
-        if nthreads > n_files: nthreads = n_files
-        chunk_size = n_files // nthreads + 1 
-        gfile_chunks = [gfiles[i:i+chunk_size] for i in range(0, n_files, chunk_size)]
-        with Pool (len(gfile_chunks)) as p:
-            results = p.map (partial(
-                get_features_from_gff, gff_dir=gffdir, scratch_dir=scratch, jmap=jmap), 
-                gfile_chunks)
-        tbl = [row for chunk in results if chunk is not None for row in chunk] # [[[1,2],[4,5]], [[7,8],[10,11]]] -> [[1,2],[4,5],[7,8],[10,11]]
+        results = pb_pool.map_by_size (partial(get_features_from_gff, gff_dir=gffdir, scratch_dir=scratch, jmap=jmap, verbose=False), 
+                gfiles, nthreads, sizes = pb_pool.file_sizes ([os.path.join (gffdir, gf) for gf in gfiles]), description = "GFF3 files")
 
     else: ## one thread
         logger.info (f"Extracting ribosomal proteins from {len(gfiles)} GFF3 files using a single thread")
         logger.info (f"Thread is named after first file in pool (i.e. name is arbitrary and does not relate to file itself)")
-        tbl = get_features_from_gff (gff_file = gf, gff_dir = gffdir, scratch_dir = scratch, jmap = jmap)
+        results = [get_features_from_gff (gff_file_list = gfiles, gff_dir = gffdir, scratch_dir = scratch, jmap = jmap)]
 
-    logger.info (f"Extracted information about {len(tbl)} ribosomal proteins")
+    df = coordinates_dataframe (results) # one table per batch of files
+    logger.info (f"Extracted information about {len(df)} ribosomal proteins")
     
-    tbl = list(map(list, zip(*tbl))) # transpose s.t. each row is a feature
-    tbl = {k:v for k,v in zip (["seqid","start", "end", "strand", "product"], tbl)}
-    df = pd.DataFrame.from_dict (tbl, orient="columns")
+    if coord_tsvfile is not None: # rows from unchanged files
+        df = pd.concat([df, coord_df], ignore_index=True)
     tsvfile = f"{output}.tsv.xz"
-    df.to_csv (tsvfile, sep="\t", index=False)
+    save_dataframe_as_tsv (df, tsvfile)
     logger.info (f"Saved information about ribosomal proteins to {tsvfile}")
+    fingerprints = pb_manifest.fingerprint_files ([os.path.join (gffdir, gf) for gf in gfiles], nthreads)
+    pb_manifest.write_manifest (pb_manifest.manifest_path (tsvfile), {**unchanged, **fingerprints})
 
     # delete scratch subdirectory and all its contents
     shutil.rmtree(pathlib.Path(scratch)) # delete scratch subdirectory
 
+def default_json_files ():
+    return {
+            "riboproteins": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/riboproteins_names.json"),
+            "ribogenes": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/ribogenes_names.json"),
+            "extragenes": os.path.join( os.path.dirname(os.path.abspath(__file__)), "data/extragenes_names.json")
+            }
+
 def read_json_files (jsonfiles):
     """ Read json files with mappings from GFF gene and product names to standardised names; return a dictionary with 3 dicts"""
     logger.info (f"Reading json files with mappings from GFF gene and product names to standardised names")
@@ -120,31 +140,68 @@ def read_json_files (jsonfiles):
                 logger.info (f"Loaded {k} from {jsonfiles[k]}")
     return jmap
 
-def get_features_from_gff (gff_file_list, gff_dir, scratch_dir, jmap):
+class GeneNameMatcher:
+    '''
+    standardised name of a CDS from its `gene` and `product` attributes, using the json maps (ribosomal genes like rpsJ,
+    extra genes, and "ribosomal protein" products); None if not a gene of interest. Results are memoised, since the same
+    names are seen in most GFF3 files
+    '''
+    def __init__ (self, jmap):
+        self.ribogenes = jmap["ribogenes"] or {}
+        self.extragenes = {k: v + "_" for k,v in (jmap["extragenes"] or {}).items()} # underscores mark non-riboprotein genes
+        self.riboproteins = jmap["riboproteins"] or {}
+        self.ribosomal_protein = re.compile ("ribosomal protein", re.IGNORECASE)
+        self.product_cache = {}
+
+    def product_name (self, products):
+        products = tuple(products)
+        if products not in self.product_cache:
+            name = None
+            if any ([self.ribosomal_protein.search (x) for x in products]):
+                prod = str.upper(products[0])
+                prod = prod[prod.find('RIBOSOMAL PROTEIN')+17:].lstrip() # remove "ribosomal protein" from beginning; find() returns -1 if not found or idx of first match
+                name = self.riboproteins.get (prod) # to inspect all possible names, store all `prod`
+            self.product_cache[products] = name
+        return self.product_cache[products]
+
+    def name (self, attributes):
+        gene = attributes["gene"][0] if "gene" in attributes else None
+        if gene and gene in self.ribogenes: return self.ribogenes[gene] # ribosomal genes have names like rpsJ, rplK, etc.
+        if gene and gene in self.extragenes: return self.extragenes[gene] # not RIBOSOMAL PROTEIN, but still close to operons
+        return self.product_name (attributes.get("product", []))
+
+coordinate_columns = ["seqid","start", "end", "strand", "product"]
+
+def coordinates_batch ():
+    ''' empty table of coordinates, filled by add_coordinates() '''
+    return pb_batch.ColumnBatch (coordinate_columns, integer_columns = ["start", "end"])
+
+def add_coordinates (batch, features, matcher):
+    ''' appends [seqid, start, end, strand, name] of CDS features (from pb_gff) with a standardised name, zero-based '''
+    for seqid, start, end, strand, attributes in features:
+        name = matcher.name (attributes)
+        if name is not None: # GFF3 uses 1-based coordinates, we want zero based
+            batch.append (seqid, start - 1, end - 1, strand, name) # gff_file doesnt know which seq from fasta file, seqid does
+
+def coordinates_dataframe (dataframes):
+    ''' table of coordinates, as saved by extract_coordinates, from the tables returned by the workers '''
+    return pb_batch.concat_batches (dataframes, coordinate_columns)
+
+def get_features_from_gff (gff_file_list, gff_dir, scratch_dir, jmap, verbose = True):
     database = os.path.join (scratch_dir, os.path.basename(gff_file_list[0]) + ".db") ## unique name for the database, below scratch dir
-    a = []
+    matcher = GeneNameMatcher (jmap) # shared by all files of this thread
+    a = coordinates_batch ()
     n_files = len (gff_file_list)
     for i, gf in enumerate(gff_file_list):
-        if i and i % (n_files//10) == 0: 
+        if verbose and i and i % max(1, n_files//10) == 0: # o.w. progress is logged by pb_pool
             logger.info (f"{round((i*100)/n_files,1)}% of files processed, {len(a)} riboprotein genes found so far from thread {gff_file_list[0]}")
         gff_file = os.path.join (gff_dir, gf) ## full path to GFF3 file
-        db = gffutils.create_db(gff_file, dbfn=database, force=True, keep_order=False, merge_strategy="merge", sort_attribute_values=False)
-        for i in db.features_of_type('CDS'):
-            gene = i.attributes["gene"][0] if "gene" in i.attributes else None
-            i.start = int(i.start - 1) # gffutils uses 1-based coordinates, we want zero based
-            i.end = int(i.end -1) # zero based
-            if jmap["ribogenes"] and gene and gene in jmap["ribogenes"].keys(): # ribosomal genes have names like rpsJ, rplK, etc.
-                gene = jmap["ribogenes"][gene]
-                a.append ([i.seqid, i.start, i.end, i.strand, gene]) # gff_file doesnt know which seq from fasta file, seqid does
-            elif jmap["extragenes"] and gene and gene in jmap["extragenes"].keys(): ## not RIBOSOMAL PROTEIN, but still close to operons
-                gene = jmap["extragenes"][gene] + "_" # underscores marks non-riboprotein genes
-                a.append ([i.seqid, i.start, i.end, i.strand, gene])
-            elif any ("ribosomal protein" in str.lower(x) for x in i.attributes["product"]):
-                prod = str.upper(i.attributes["product"][0])
-                prod = prod[prod.find('RIBOSOMAL PROTEIN')+17:].lstrip() # remove "ribosomal protein" from beginning; find() returns -1 if not found or idx of first match
-                if jmap["riboproteins"] and prod in jmap["riboproteins"].keys():  # to inspect all possible names, remove this if statement and store all `prod`
-                    prod = jmap["riboproteins"][prod] # replace with standard name
-                    a.append ([i.seqid, i.start, i.end, i.strand, prod])
+        try: # single pass over CDS lines, without database
+            features = gff_cds_features (gff_file)
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning (f"Could not read CDS from {gff_file} directly ({e}); using gffutils instead")
+            features = gff_cds_features_gffutils (gff_file, database)
+        add_coordinates (a, features, matcher)
 
     #pathlib.Path(database).unlink() # delete database file (delete whole tree later)
-    return a
+    return a.dataframe ()
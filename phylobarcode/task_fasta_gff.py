@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json? imports itertools, pathlib
+from phylobarcode.pb_gff import gff_region_elements, gff_region_elements_gffutils, gff_regions_and_cds_features, gff_cds_features_gffutils
+from phylobarcode import pb_manifest, pb_pool, pb_gtdb, pb_minhash, pb_seqkernel, pb_batch
 import pandas as pd, numpy as np
-import io, multiprocessing, shutil, gffutils
-from Bio.Blast import NCBIXML
+import io, multiprocessing, shutil, xxhash
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 
@@ -20,9 +21,14 @@ logger = logging.getLogger("phylobarcode_global_logger")
 # 1. if plasmid has riboprot genes, we exclude them from merged fasta+GFF but not from coordinates file (e.g. plasmid
 #    NZ_CP007068.1 belonging to Rhizobium leguminosarum bv. trifolii CB782 - GCF_000520875.1.fna.gz)
 #    -> currently we are fine since plasmids do not have several riboprot genes 
-# 2. deduplicate (sourmash or genus information)
 
-def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfile = None, gtdb = None, scratch=None, output=None, nthreads = 1):
+# columns of the fasta table; QC stats are calculated while reading the headers, since the files are decompressed anyway
+fasta_columns = ["fasta_file", "seqid", "fasta_description", "fasta_length", "fasta_contigs", "fasta_n_fraction",
+        "fasta_gc", "fasta_digest"]
+gff_columns = ["gff_file", "seqid", "gff_description", "gff_taxonid"] # chromosomes only
+
+def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfile = None, gtdb = None, scratch=None, output=None, 
+        coordinates = False, jsonfiles = None, dedup = None, max_n = None, min_length = None, unique = False, nthreads = 1):
     hash_name = '%012x' % random.randrange(16**12)  # use same file random file name for all files (notice that main script should have taken care of these)
     if fastadir is None: 
         logger.error("No fasta directory provided"); return
@@ -37,6 +43,10 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
         logger.warning (f"No output file specified, using {prefix} as prefix")
     if scratch is None: ## this should not happen if function called from main script; use current directory 
         scratch = f"scratch.{hash_name}"
+    if dedup is not None and not (0 < dedup <= 1):
+        logger.error(f"Deduplication threshold (ANI) must be between 0 and 1, not {dedup}"); return
+    if max_n is not None and not (0 <= max_n <= 100):
+        logger.error(f"Maximum percentage of Ns must be between 0 and 100, not {max_n}"); return
     # create scratch directory (usually it's a subdirectory of the user-given scratch directory)
     pathlib.Path(scratch).mkdir(parents=True, exist_ok=True) # python 3.5+ create dir if it doesn't exist
 
@@ -48,36 +58,49 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
         return
 
     # get sequence names as dataframe
-    fasta_files, fasta_tsv = update_tsv_from_filenames (fasta_files, fasta_tsvfile, "fasta_file")
+    fasta_files, fasta_tsv, fasta_unchanged = update_tsv_from_filenames (fasta_files, fasta_tsvfile, "fasta_file", nthreads)
+    sketches = {} # seqid -> MinHash sketch, if dedup
     if len(fasta_files):
-        logger.info(f"{len(fasta_files)} fasta files in {fastadir} not described in {fasta_tsvfile}")
+        logger.info(f"{len(fasta_files)} fasta files in {fastadir} not described in {fasta_tsvfile} (or modified)")
+        if dedup is not None:
+            logger.info(f"Sequences are also read, to calculate their MinHash sketches for deduplication")
         if (nthreads > 1):
             logger.info(f"Using up to {nthreads} threads to read fasta headers")
-            chunks = generate_thread_chunks (fasta_files, nthreads) # list of filename lists, one per thread
-            from multiprocessing import Pool
-            from functools import partial
-            with Pool(len(chunks)) as p:
-                results = p.map(partial(split_headers_in_fasta), chunks)
-            a = [row for sublist in results if sublist is not None for row in sublist] # [[[1,2]], [[7,8],[10,11]]] -> [[1,2],[7,8],[10,11]]
+            if dedup is not None:
+                results = pb_pool.map_by_size (split_headers_and_sketches_in_fasta, fasta_files, nthreads, description = "fasta files")
+                for sublist in results: sketches.update (sublist[1])
+                results = [sublist[0] for sublist in results]
+            else:
+                results = pb_pool.map_by_size (split_headers_in_fasta, fasta_files, nthreads, description = "fasta files") # largest first
+            df_fasta = pb_batch.concat_batches (results, fasta_columns) # one table per batch of files
         else:
             logger.info(f"Using a single thread to read fasta headers")
-            a = split_headers_in_fasta (fasta_files) # list of lists (samples=rows, features=columns)
+            if dedup is not None:
+                df_fasta, sketches = split_headers_and_sketches_in_fasta (fasta_files)
+            else:
+                df_fasta = split_headers_in_fasta (fasta_files) # one row is chromosome and others are plasmids usually
 
-        a = list(map(list, zip(*a))) # transpose list of lists (https://stackoverflow.com/questions/6473679/python-transpose-list-of-lists)
-        a = {"fasta_file": a[0], "seqid": a[1], "fasta_description": a[2]} # dictionary of lists (one row is chromosome and others are plasmids usually)
-        df_fasta = pd.DataFrame.from_dict(a, orient='columns')
         if fasta_tsv is not None:
             logger.info(f"FASTA: {len(fasta_tsv)} sequences already in tsv file {fasta_tsvfile}")
             logger.info(f"FASTA: {len(df_fasta)} new sequences found in directory {fastadir}")
             df_fasta = pd.concat([df_fasta, fasta_tsv], ignore_index=True)
+            for col in ["fasta_length", "fasta_contigs"]: # o.w. saved as float if older rows don't have them
+                df_fasta[col] = pd.to_numeric (df_fasta[col]).astype ("Int64")
         else:
             logger.info(f"FASTA: found {len(df_fasta)} sequences in directory {fastadir}")
         tsvfilename = f"{output}_fasta.tsv.xz"
-        df_fasta.to_csv (tsvfilename, sep="\t", index=False)
+        save_dataframe_as_tsv (df_fasta, tsvfilename)
         logger.info(f"All fasta entries wrote to {tsvfilename}")
+        save_manifest (tsvfilename, fasta_files, fasta_unchanged, nthreads)
     else:
         logger.info (f"All fasta files already found in tsv file {fasta_tsvfile}, with {len(fasta_tsv)} entries")
         df_fasta = fasta_tsv
+        tsvfilename = f"{output}_fasta.tsv.xz" # without stale rows, and with manifest for next update
+        save_dataframe_as_tsv (df_fasta, tsvfilename)
+        save_manifest (tsvfilename, [], fasta_unchanged)
+    if dedup is not None: # sketches are stored next to fasta table, s.t. unchanged files are not read again
+        sketches = update_sketches (sketches, fasta_tsv, fasta_tsvfile, fastadir, nthreads)
+        pb_minhash.save_sketches (pb_minhash.sketch_path (tsvfilename), sketches)
 
     # check if directories contain gff files first
     gff_files = list_of_files_by_extension (gffdir, ['gff', 'gff3'])
@@ -87,24 +110,38 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
         return
 
     # get GFF chromosomes (excludes plasmids), using scratch dir to store the sqlite db, as dataframe
-    gff_files, gff_tsv = update_tsv_from_filenames (gff_files, gff_tsvfile, "gff_file")
+    gff_files, gff_tsv, gff_unchanged = update_tsv_from_filenames (gff_files, gff_tsvfile, "gff_file", nthreads)
+    coords = None
+    gff_fingerprints = {} # of new or modified files, for the manifest of coordinates
+    if coordinates: # riboprotein coordinates from same pass over GFF files, o.w. read again by extract_coordinates
+        from phylobarcode.task_extract_riboprot_gff import read_json_files, default_json_files
+        jmap = read_json_files (jsonfiles if jsonfiles is not None else default_json_files())
+        coords = []
+        if gff_tsv is not None and len(gff_tsv):
+            logger.warning (f"Coordinates will not be extracted from the {len(gff_tsv['gff_file'].unique())} GFF files "
+                    f"already in {gff_tsvfile}; use `extract_coordinates` with the --coords option for them")
     if len(gff_files):
-        logger.info(f"{len(gff_files)} gff files in {gffdir} not described in {gff_tsvfile}")
+        logger.info(f"{len(gff_files)} gff files in {gffdir} not described in {gff_tsvfile} (or modified)")
         if (nthreads > 1):
             logger.info(f"Using up to {nthreads} threads to read gff headers")
-            chunks = generate_thread_chunks (gff_files, nthreads)
-            from multiprocessing import Pool
             from functools import partial
-            with Pool(len(chunks)) as p:
-                results = p.map(partial(split_region_elements_in_gff, scratchdir=scratch), chunks)
-            a = [row for sublist in results if sublist is not None for row in sublist] # [[[1,2]], [[7,8],[10,11]]] -> [[1,2],[7,8],[10,11]]
+            if coordinates:
+                results = pb_pool.map_by_size (partial(split_region_elements_and_coordinates_in_gff, scratchdir=scratch, jmap=jmap), 
+                        gff_files, nthreads, description = "GFF files")
+                coords = [sublist[1] for sublist in results]
+                results = [sublist[0] for sublist in results]
+            else:
+                results = pb_pool.map_by_size (partial(split_region_elements_in_gff, scratchdir=scratch), gff_files, nthreads, 
+                        description = "GFF files")
+            df_gff = pb_batch.concat_batches (results, gff_columns) # one table per batch of files
         else:
             logger.info(f"Using a single thread to read gff headers")
-            a = split_region_elements_in_gff (gff_files, scratchdir=scratch) # list of lists (samples=rows, features=columns)
+            if coordinates:
+                df_gff, coords = split_region_elements_and_coordinates_in_gff (gff_files, scratchdir=scratch, jmap=jmap)
+                coords = [coords]
+            else:
+                df_gff = split_region_elements_in_gff (gff_files, scratchdir=scratch) # usually one row only since chromosome
 
-        a = list(map(list, zip(*a))) # transpose list of lists so that each row is one feature
-        a = {"gff_file": a[0], "seqid": a[1], "gff_description": a[2], "gff_taxonid": a[3]} # dictionary of lists (usually one row only since chromosome)
-        df_gff = pd.DataFrame.from_dict(a, orient='columns')
         if gff_tsv is not None:
             logger.info(f"GFF: {len(gff_tsv)} sequences already in tsv file {gff_tsvfile}")
             logger.info(f"GFF: {len(df_gff)} new sequences found in directory {gffdir}")
@@ -112,11 +149,15 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
         else:
             logger.info(f"GFF: found {len(df_gff)} sequences in directory {gffdir}")
         tsvfilename = f"{output}_gff.tsv.xz"
-        df_gff.to_csv (tsvfilename, sep="\t", index=False)
+        save_dataframe_as_tsv (df_gff, tsvfilename)
         logger.info(f"All GFF entries wrote to {tsvfilename}")
+        gff_fingerprints = save_manifest (tsvfilename, gff_files, gff_unchanged, nthreads)
     else:
         logger.info (f"All GFF files already found in tsv file {gff_tsvfile}, with {len(gff_tsv)} entries")
         df_gff = gff_tsv
+        tsvfilename = f"{output}_gff.tsv.xz" # without stale rows, and with manifest for next update
+        save_dataframe_as_tsv (df_gff, tsvfilename)
+        save_manifest (tsvfilename, [], gff_unchanged)
 
     # delete scratch subdirectory and all its contents
     shutil.rmtree(pathlib.Path(scratch)) # delete scratch subdirectory
@@ -126,6 +167,7 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
     if (gtdb is None):
         logger.warning("No GTDB taxonomy file provided, the table with matching genomes will _not_ be created. Use the "
                 "generated tsv files together with the GTDB file in order to produce the final table.")
+        if coordinates: logger.warning("Coordinates are only saved for genomes in the final table, and thus were not saved.")
         return
 
     df = pd.merge(df_fasta, df_gff, on='seqid', how='inner')
@@ -136,67 +178,262 @@ def merge_fasta_gff (fastadir=None, gffdir=None, fasta_tsvfile = None, gff_tsvfi
 
     # get GTDB taxonomy as dataframe and merge with existing dataframe (gff+fasta info)
     df = read_gtdb_taxonomy_and_merge (gtdb, df)
+    df = qc_filter (df, df_fasta, max_n = max_n, min_length = min_length, unique = unique)
     full_dlen = len(df) - df["gtdb_accession"].isnull().sum() # sum=count null values
+    if dedup is not None:
+        df["dedup_representative"] = dedup_representatives (df, sketches, dedup)
 
     tsvfilename = f"{output}_merged.tsv.xz"
     logger.info(f"Found {full_dlen} samples with complete information; writing all (including incomplete) to {tsvfilename}")
     print (df.head())
-    df.to_csv (tsvfilename, sep="\t", index=False)
+    save_dataframe_as_tsv (df, tsvfilename)
+
+    if coords is not None: # same as `extract_coordinates` (which only uses genomes with GTDB info) 
+        from phylobarcode.task_extract_riboprot_gff import coordinates_dataframe
+        seqids = set(df.loc[df["gtdb_accession"].notnull(), "seqid"])
+        if dedup is not None: # only representatives, as `extract_coordinates` would do
+            seqids = set(df.loc[df["gtdb_accession"] == df["dedup_representative"], "seqid"])
+        df = coordinates_dataframe (coords)
+        df = df[df["seqid"].isin(seqids)]
+        tsvfilename = f"{output}_coordinates.tsv.xz"
+        save_dataframe_as_tsv (df, tsvfilename)
+        logger.info(f"Saved coordinates of {len(df)} ribosomal proteins from {df['seqid'].nunique()} genomes to {tsvfilename}")
+        gff_done = set(df_gff.loc[df_gff["seqid"].isin(seqids), "gff_file"]) # files with a genome in final table
+        pb_manifest.write_manifest (pb_manifest.manifest_path (tsvfilename), 
+                {k:v for k,v in gff_fingerprints.items() if k in gff_done})
 
 def list_of_files_by_extension (dirname, extension):
     files = []
     for ext in extension:
         files += glob.glob(f"{dirname}/*.{ext}") + glob.glob(f"{dirname}/*.{ext}.*")
-    return files
+    index_suffixes = (".fai", ".gzi") # sidecar files from `index_fasta` would match "*.fna.*"
+    return [f for f in files if not f.endswith(index_suffixes)]
 
-def update_tsv_from_filenames (files, tsvfile, columnname):
+def index_fasta_files (fastadir=None, bgzip=False, nthreads=1):
+    from phylobarcode import pb_faidx
+    if fastadir is None: 
+        logger.error("No fasta directory provided"); return
+    if not os.path.isdir (fastadir):
+        logger.error(f"Fasta directory provided {fastadir} does not exist or is not a proper directory"); return
+    fasta_files = list_of_files_by_extension (fastadir, ['fasta', 'fa', 'fna', 'faa', 'ffn', 'faa', 'fas'])
+    fasta_files = [f for f in fasta_files if not pb_faidx.has_fasta_index (f)] # index is older than file, or missing
+    logger.info(f"Found {len(fasta_files)} fasta files without up-to-date index in {fastadir}")
+    if len(fasta_files) < 1: return
+    if bgzip: logger.info(f"Gzipped files not in BGZF format will be recompressed in place (still readable by gzip)")
+    if (nthreads > 1):
+        logger.info(f"Using up to {nthreads} threads to index fasta files")
+        from functools import partial
+        results = pb_pool.map_by_size (partial(pb_faidx.build_fasta_index_list, bgzip=bgzip), fasta_files, nthreads, 
+                description = "fasta files")
+        results = [row for sublist in results for row in sublist]
+    else:
+        results = pb_faidx.build_fasta_index_list (fasta_files, bgzip=bgzip)
+    n_failed = len([x for x in results if x[1] is None])
+    n_seqs = sum([x[1] for x in results if x[1] is not None])
+    logger.info(f"Indexed {n_seqs} sequences from {len(results) - n_failed} files; {n_failed} files could not be indexed")
+
+def update_tsv_from_filenames (files, tsvfile, columnname, nthreads = 1):
+    '''
+    returns the files not described in tsvfile, the rows of the others, and the fingerprints of the others (for the
+    manifest of the new table). If the table has a manifest then modified files are also returned (and their rows
+    dropped, as well as rows from files no longer present), o.w. files are matched by name only
+    '''
     if tsvfile is None:
-        return files, None
+        return files, None, {}
     if not os.path.isfile (tsvfile):
-        logger.error(f"tsv file {tsvfile} does not exist or is not a proper file"); return files, None
+        logger.error(f"tsv file {tsvfile} does not exist or is not a proper file"); return files, None, {}
     df = pd.read_csv (tsvfile, sep="\t", dtype=str)
     if columnname not in df.columns:
-        logger.error(f"tsv file {tsvfile} does not have column {columnname}"); return files, None
-    new_files = df[columnname].unique()
-    new_files = [f for f in files if os.path.basename(f) not in new_files]
-    old_files = list(set(files) - set(new_files))
-    old_files = [os.path.basename(f) for f in old_files]
-    df = df[df[columnname].isin(old_files)] # keep only rows with filenames found in files
-    return new_files, df
+        logger.error(f"tsv file {tsvfile} does not have column {columnname}"); return files, None, {}
+    manifest = pb_manifest.read_manifest (pb_manifest.manifest_path (tsvfile))
+    if manifest is None:
+        logger.info(f"No manifest found for {tsvfile}, thus files with the same name are assumed to be unchanged")
+        new_files = df[columnname].unique()
+        new_files = [f for f in files if os.path.basename(f) not in new_files]
+        old_files = list(set(files) - set(new_files))
+        unchanged = pb_manifest.fingerprint_files (old_files, nthreads)
+    else:
+        new_files, unchanged = pb_manifest.compare_with_manifest (files, manifest)
+        n_modified = len([f for f in new_files if os.path.basename(f) in manifest])
+        n_removed = len(set(manifest) - set([os.path.basename(f) for f in files]))
+        logger.info(f"Manifest of {tsvfile}: {len(unchanged)} files unchanged, {n_modified} modified, "
+                f"{len(new_files) - n_modified} new, and {n_removed} no longer present")
+    df = df[df[columnname].isin(unchanged.keys())] # keep only rows with unchanged filenames found in files
+    return new_files, df, unchanged
 
-def split_headers_in_fasta (fasta_file_list):
-    a2 = []
-    for fas in fasta_file_list:
+def save_manifest (tsvfile, new_files, unchanged, nthreads = 1):
+    ''' manifest of table tsvfile, with the fingerprints of the new files and of the unchanged ones; returns the former '''
+    new_fingerprints = pb_manifest.fingerprint_files (new_files, nthreads)
+    pb_manifest.write_manifest (pb_manifest.manifest_path (tsvfile), {**unchanged, **new_fingerprints})
+    return new_fingerprints
+
+def fasta_file_rows (fas, sketch_min_length = None):
+    '''
+    rows [fasta_file, seqid, description, length, contigs, N fraction, GC content, xxh128 digest] of the sequences of a
+    fasta file, and the MinHash sketches of those longer than sketch_min_length (if not None)
+    '''
+    rows, sketches = [], {}
+    for description, sequence in fasta_iterator (fas): # sequences are uppercase
         # example header: >NZ_CP010000.1 Escherichia coli str. K-12 substr. MG1655, complete genome
         # thus we remove everything after first comma ("complete genome" in most cases)
-        a = [x.split(",")[0] for x in read_fasta_headers_as_list (fas)] # read_fasta_headers is defined in pb_common.py
-        a = [[os.path.basename(fas), x.split(" ",1)[0], x.split(" ",1)[1]] for x in a] # filename +  split on first space
-        a2.extend(a)
-    return a2
+        x = description.split(",")[0]
+        seqid = x.split(" ",1)[0]
+        rows.append ([os.path.basename(fas), seqid, x.split(" ",1)[1]] + sequence_qc (sequence)) # filename +  split on first space
+        if sketch_min_length is not None and len(sequence) >= sketch_min_length: 
+            sketches[seqid] = pb_minhash.sketch_sequence (sequence)
+    for row in rows: row.insert (4, len(rows)) # number of contigs in file
+    return rows, sketches
+
+def sequence_qc (sequence):
+    ''' [length, fraction of Ns, GC content (over ACGT), xxh128 hex digest] of an uppercase sequence '''
+    buffer = pb_seqkernel.as_uint8 (sequence)
+    counts = {c: np.count_nonzero (buffer == c) for c in b"ACGTN"} # comparisons are faster than np.bincount()
+    acgt = counts[ord("A")] + counts[ord("C")] + counts[ord("G")] + counts[ord("T")]
+    n_fraction = round (counts[ord("N")] / len(buffer), 6) if len(buffer) else 0.
+    gc = round ((counts[ord("G")] + counts[ord("C")]) / acgt, 6) if acgt else np.nan
+    return [len(buffer), n_fraction, gc, xxhash.xxh128_hexdigest (buffer)]
+
+def split_headers_in_fasta (fasta_file_list):
+    ''' table (with fasta_columns) of the sequences from the fasta files '''
+    a2 = pb_batch.ColumnBatch (fasta_columns)
+    for fas in fasta_file_list:
+        a2.extend (fasta_file_rows (fas)[0])
+    return a2.dataframe ()
+
+def split_headers_and_sketches_in_fasta (fasta_file_list, min_length = 100000):
+    ''' same as split_headers_in_fasta() but also returns dict of seqid -> MinHash sketch of sequences above min_length '''
+    a2 = pb_batch.ColumnBatch (fasta_columns)
+    sketches = {}
+    for fas in fasta_file_list: # plasmids are usually not in the merged table, thus not needed
+        rows, file_sketches = fasta_file_rows (fas, sketch_min_length = min_length)
+        a2.extend (rows)
+        sketches.update (file_sketches)
+    return a2.dataframe (), sketches
+
+def update_sketches (sketches, fasta_tsv, fasta_tsvfile, fastadir, nthreads = 1):
+    ''' 
+    adds to the new sketches those of sequences from the previous fasta table (from the sketches file next to it, or
+    reading again the fasta files) 
+    '''
+    if fasta_tsv is None or not len(fasta_tsv): return sketches
+    previous = pb_minhash.read_sketches (pb_minhash.sketch_path (fasta_tsvfile)) or {}
+    seqids = set(fasta_tsv["seqid"])
+    sketches.update ({k:v for k,v in previous.items() if k in seqids})
+    if previous: # sequences not sketched (i.e. short) in previous table are not missing
+        missing = [] 
+    else:
+        missing = fasta_tsv.loc[~fasta_tsv["seqid"].isin(sketches.keys()), "fasta_file"].unique()
+        missing = [os.path.join (fastadir, f) for f in missing if os.path.isfile (os.path.join (fastadir, f))]
+    if missing:
+        logger.info(f"No MinHash sketches found for {len(missing)} fasta files from {fasta_tsvfile}, reading them again")
+        results = pb_pool.map_by_size (split_headers_and_sketches_in_fasta, missing, nthreads, description = "fasta files")
+        for sublist in results: sketches.update ({k:v for k,v in sublist[1].items() if k in seqids})
+    return sketches
+
+def qc_filter (df, df_fasta, max_n = None, min_length = None, unique = False):
+    '''
+    rows of the merged table from genomes (i.e. fasta files) with at most max_n percent of Ns and at least min_length
+    bases in total; if unique, sequences identical to one already kept are removed, keeping first those with GTDB info
+    (and GTDB representatives). Rows without QC info (fasta table from older versions) are always kept
+    '''
+    if max_n is None and min_length is None and not unique: return df
+    qc = df_fasta.reindex (columns = fasta_columns) # missing columns are NaN
+    length = pd.to_numeric (qc["fasta_length"]).astype (float) # NaN, not NA, if missing
+    per_file = pd.DataFrame ({"length": length, "n": pd.to_numeric (qc["fasta_n_fraction"]).astype (float) * length})
+    per_file = per_file.groupby (qc["fasta_file"]).sum (min_count = 1)
+    genome_length = df["fasta_file"].map (per_file["length"])
+    n_unknown = df.loc[genome_length.isnull(), "fasta_file"].nunique()
+    if n_unknown: logger.warning (f"QC: {n_unknown} fasta files without QC info (from older table) are not filtered")
+    keep = pd.Series (True, index = df.index)
+    if min_length is not None:
+        keep &= ~(genome_length < min_length) # NaN is kept
+        logger.info (f"QC: {(~keep).sum()} sequences from genomes shorter than {min_length} bases removed")
+    if max_n is not None:
+        n_before = keep.sum()
+        keep &= ~(df["fasta_file"].map (per_file["n"]) * 100 > max_n * genome_length)
+        logger.info (f"QC: {n_before - keep.sum()} sequences from genomes with more than {max_n}% of Ns removed")
+    if unique and "fasta_digest" in df.columns:
+        order = df[keep].assign (no_gtdb = df["gtdb_accession"].isnull(), 
+                not_rep = df["gtdb_accession"] != df["gtdb_genome_representative"])
+        order = order.sort_values (["no_gtdb", "not_rep", "fasta_file", "seqid"])
+        duplicated = order["fasta_digest"].notnull() & order.duplicated (subset = "fasta_digest", keep = "first")
+        keep &= ~df.index.isin (order.index[duplicated])
+        logger.info (f"QC: {duplicated.sum()} sequences identical to another one removed")
+    return df[keep]
+
+def dedup_representatives (df, sketches, threshold):
+    '''
+    GTDB accession of the representative of each genome (row), with genomes of the same GTDB species clustered by their
+    ANI estimated from the MinHash sketches of their sequences. GTDB representatives are preferred; NaN if no GTDB info
+    '''
+    genomes = df[df["gtdb_accession"].notnull()]
+    genome_sketch = {acc: pb_minhash.merge_sketches ([sketches.get (s, pb_minhash.empty_sketch) for s in grp["seqid"]])
+            for acc, grp in genomes.groupby ("gtdb_accession", sort = False)} # all chromosomes of a genome
+    genomes = genomes[["gtdb_accession", "gtdb_genome_representative", "gtdb_taxonomy"]].drop_duplicates ("gtdb_accession")
+    genomes = genomes.assign (not_rep = genomes["gtdb_accession"] != genomes["gtdb_genome_representative"])
+    genomes = genomes.sort_values (["not_rep", "gtdb_accession"]) # GTDB representatives first
+    representative = dict (zip (genomes["gtdb_accession"], genomes["gtdb_accession"])) # e.g. if taxonomy is missing
+    for taxonomy, grp in genomes.groupby ("gtdb_taxonomy", sort = False): # same species
+        names = grp["gtdb_accession"].tolist()
+        representative.update (pb_minhash.greedy_clusters (names, [genome_sketch[x] for x in names], threshold))
+    n_reps = len(set(representative.values()))
+    n_unsketched = len([x for x in genome_sketch.values() if not len(x)])
+    logger.info(f"Deduplication: {len(representative)} genomes with GTDB info were clustered into {n_reps} groups with "
+            f"estimated ANI above {threshold} ({n_unsketched} genomes without sequences were not clustered)")
+    return df["gtdb_accession"].map (representative)
+
+def chromosome_rows (gff_file, regions):
+    ''' [filename, seqid, longname, taxonid] for the chromosome regions (i.e. skipping plasmids) of a GFF3 file '''
+    rows = []
+    for seqid, start, attributes in regions:
+        if "genome" in attributes and attributes['genome'][0] == 'chromosome': # skip plasmids
+            longname = ""
+            if ("old-name" in attributes): 
+                longname = attributes["old-name"][0] + ";"
+            if ("type-material" in attributes): 
+                longname = attributes["type-material"][0] + ";" 
+            if ("strain" in attributes):
+                longname = attributes["strain"][0] + ";"
+            rows.append ([os.path.basename(gff_file), seqid, longname, attributes["Dbxref"][0].replace("taxon:","")]) # filename + seqid + longname + Dbxref
+    return rows
 
 def split_region_elements_in_gff (gff_file_list, scratchdir):
-    database_file = os.path.join(scratchdir, os.path.basename(gff_file_list[0]) + ".db")
-    a = []
+    ''' table (with gff_columns) of the chromosomes from the GFF3 files '''
+    database_file = os.path.join(scratchdir, os.path.basename(gff_file_list[0]) + ".db") # only used by gffutils
+    a = pb_batch.ColumnBatch (gff_columns)
     for gff_file in gff_file_list:
-        db = gffutils.create_db (gff_file, database_file, merge_strategy='create_unique', keep_order=True, force=True) # force to overwrite existing db
-        for ft in db.features_of_type('region', order_by='start'):
-            if "genome" in ft.attributes and ft.attributes['genome'][0] == 'chromosome': # skip plasmids
-                longname = ""
-                if ("old-name" in ft.attributes): 
-                    longname = ft.attributes["old-name"][0] + ";" ## alternative to ft["old-name"]
-                if ("type-material" in ft.attributes): 
-                    longname = ft.attributes["type-material"][0] + ";" 
-                if ("strain" in ft.attributes):
-                    longname = ft.attributes["strain"][0] + ";"
-                a.append ([os.path.basename(gff_file), ft.seqid, longname, ft["Dbxref"][0].replace("taxon:","")]) # filename + seqid + longname + Dbxref
-    return a
+        try: # reads only the region lines at the beginning of the file, without a database
+            rows = chromosome_rows (gff_file, gff_region_elements (gff_file))
+        except (ValueError, KeyError, UnicodeDecodeError) as e:
+            logger.warning (f"Could not read regions from {gff_file} directly ({e}); using gffutils instead")
+            rows = chromosome_rows (gff_file, gff_region_elements_gffutils (gff_file, database_file))
+        a.extend (rows)
+    return a.dataframe ()
 
-def read_gtdb_taxonomy_and_merge (gtdb_file, df):
-    gtdb_columns_keep = ['accession', 'gtdb_genome_representative', 'gtdb_taxonomy', 'ssu_query_id', 'ncbi_assembly_name', 
-            'ncbi_genbank_assembly_accession', 'ncbi_strain_identifiers', 'ncbi_taxid', 'ncbi_taxonomy'] #  'ncbi_taxonomy_unfiltered' is not used
+def split_region_elements_and_coordinates_in_gff (gff_file_list, scratchdir, jmap):
+    ''' 
+    same as split_region_elements_in_gff() but also returns the riboprotein coordinates (as extract_coordinates), 
+    reading each file only once 
+    '''
+    from phylobarcode.task_extract_riboprot_gff import GeneNameMatcher, coordinates_batch, add_coordinates
+    database_file = os.path.join(scratchdir, os.path.basename(gff_file_list[0]) + ".db") # only used by gffutils
+    matcher = GeneNameMatcher (jmap)
+    a = pb_batch.ColumnBatch (gff_columns)
+    coords = coordinates_batch ()
+    for gff_file in gff_file_list:
+        try: 
+            regions, features = gff_regions_and_cds_features (gff_file)
+            rows = chromosome_rows (gff_file, regions)
+        except (ValueError, KeyError, UnicodeDecodeError) as e:
+            logger.warning (f"Could not read {gff_file} directly ({e}); using gffutils instead")
+            rows = chromosome_rows (gff_file, gff_region_elements_gffutils (gff_file, database_file))
+            features = gff_cds_features_gffutils (gff_file, database_file)
+        a.extend (rows)
+        add_coordinates (coords, features, matcher)
+    return a.dataframe (), coords.dataframe ()
 
-    df_gtdb = pd.read_csv(gtdb_file, sep="\t", dtype=str)
-    df_gtdb = df_gtdb[gtdb_columns_keep] # remove most columns
+def read_gtdb_taxonomy_and_merge (gtdb_file, df):
+    df_gtdb = pb_gtdb.read_gtdb_metadata (gtdb_file) # only the columns we need, from tarball or tsv (or from cache)
 
     gtdb_columns_rename = {'accession': 'gtdb_accession', 'ssu_query_id': 'seqid'}
     df_gtdb.rename(columns=gtdb_columns_rename, inplace=True) # rename columns to match other tables
@@ -205,10 +442,25 @@ def read_gtdb_taxonomy_and_merge (gtdb_file, df):
     df_gtdb = pd.merge(df, df_gtdb, on='fasta_file', how='left') # merge GTDB info with fasta+gff info
     return df_gtdb
 
-def generate_thread_chunks (files, nthreads):
-    n_files = len (files)
-    if nthreads > n_files: nthreads = n_files
-    chunk_size = n_files // nthreads + 1 
-    file_chunks = [files[i:i+chunk_size] for i in range(0, n_files, chunk_size)]
-    return file_chunks
-
+def pack_fasta_files (fastadir=None, storedir=None, nthreads=1):
+    from phylobarcode import pb_genomestore
+    if fastadir is None: 
+        logger.error("No fasta directory provided"); return
+    if not os.path.isdir (fastadir):
+        logger.error(f"Fasta directory provided {fastadir} does not exist or is not a proper directory"); return
+    if storedir is None:
+        storedir = 'genomestore.%012x' % random.randrange(16**12)
+        logger.warning (f"No store directory specified, using {storedir}")
+    fasta_files = list_of_files_by_extension (fastadir, ['fasta', 'fa', 'fna', 'faa', 'ffn', 'faa', 'fas'])
+    logger.info(f"Found {len(fasta_files)} fasta files in {fastadir}; will pack them into {storedir}")
+    if len(fasta_files) < 1: return
+    # small chunks s.t. the main process writes packed sequences as soon as they are ready, without holding all of them
+    chunks = [fasta_files[i:i+8] for i in range(0, len(fasta_files), 8)] 
+    if (nthreads > 1):
+        logger.info(f"Using up to {nthreads} threads to pack fasta files")
+        from multiprocessing import Pool
+        with Pool(min(nthreads, len(chunks))) as p:
+            n_seqs, n_bytes = pb_genomestore.write_genome_store (storedir, p.imap(pb_genomestore.pack_fasta_file_list, chunks))
+    else:
+        n_seqs, n_bytes = pb_genomestore.write_genome_store (storedir, map(pb_genomestore.pack_fasta_file_list, chunks))
+    logger.info(f"Packed {n_seqs} sequences into {storedir}, using {round(n_bytes/1e6,1)} MB for the bases")
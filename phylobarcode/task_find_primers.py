@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json?
 import re, numpy as np, pandas as pd
+from phylobarcode.pb_taxonomy import read_taxonomy_index
 
 # legacy code, no need to create a separate logger
 #log_format = logging.Formatter(fmt='phylobarcode_primer %(asctime)s [%(levelname)s] %(message)s', datefmt="%Y-%m-%d %H:%M")
 logger = logging.getLogger("phylobarcode_global_logger")
 
-def find_primers (fastafile = None, primer_opt_size = 20, border = 400, num_return = 100, taxon = None, output = None):
+def find_primers (fastafile = None, primer_opt_size = 20, border = 400, num_return = 100, taxon = None, output = None,
+        sampler = None):
     if primer_opt_size is None: primer_opt_size = 20
     if border is None:          border = 400
     if num_return is None:      num_return = 100
@@ -14,14 +16,14 @@ def find_primers (fastafile = None, primer_opt_size = 20, border = 400, num_retu
         output = "primers." + '%012x' % random.randrange(16**12) 
         logger.warning (f"No output file specified, writing to file {output}")
 
-    taxon_df = get_taxonomy (taxon) # may be None is taxon is None
-    fas = read_fasta_as_list (fastafile)
+    taxonomy = get_taxonomy (taxon) # may be None is taxon is None
+    fas = read_sampled_fasta (fastafile, taxon, sampler)
     ldic = {}
     rdic = {}
     for i, seqfasta in enumerate(fas):
         if i and not i%100:
             logger.info (f"Processing sequence {i}")
-        left, right = get_primers (seqfasta.seq, seqfasta.id, border = border, num_return = num_return, taxon_df = taxon_df)
+        left, right = get_primers (seqfasta.seq, seqfasta.id, border = border, num_return = num_return, taxonomy = taxonomy)
         if left is not None:
             for x in left:
                 if x[0] not in ldic: ldic[x[0]] = [x[1:]]
@@ -32,7 +34,7 @@ def find_primers (fastafile = None, primer_opt_size = 20, border = 400, num_retu
                 else:                rdic[x[0]].append(x[1:])
     save_primers_to_file (ldic, rdic, output)
 
-def get_primers (sequence, seqname, primer_opt_size = 20, border = 400, num_return=100, taxon_df = None):
+def get_primers (sequence, seqname, primer_opt_size = 20, border = 400, num_return=100, taxonomy = None):
     seqlen = len(sequence)
     primer_task = "pick_primer_list" # "pick_sequencing_primers" "generic" "pick_primer_list"
     primer_min_size = 14
@@ -65,15 +67,14 @@ def get_primers (sequence, seqname, primer_opt_size = 20, border = 400, num_retu
         f"PRIMER_NUM_RETURN={num_return}\nPRIMER_OPT_SIZE={primer_opt_size}\n"
         f"SEQUENCE_TEMPLATE={sequence}\n=\n"
         )
-    child = subprocess.Popen(" primer3_core " , stdin=subprocess.PIPE, stderr=subprocess.PIPE,
-                             stdout=subprocess.PIPE, universal_newlines=True, shell=(sys.platform!="win32"))
-    output = child.communicate(input=arguments)[0].split("\n")
+    output, _ = run_tool (["primer3_core"], input = arguments, check = False) # errors are reported in the output
+    output = output.split("\n")
 
     # seqname is used in warnings and to map to taxon; seqlen to calculate distance from border
-    return extract_primer_from_output (output, seqname, seqlen, taxon_df) 
+    return extract_primer_from_output (output, seqname, seqlen, taxonomy) 
 
 def find_primers_parallel (fastafile = None, primer_opt_size = 20, border = 400, num_return = 100, taxon = None, 
-        output = None, nthreads = 2):
+        output = None, sampler = None, nthreads = 2):
     if primer_opt_size is None: primer_opt_size = 20
     if border is None:          border = 400
     if num_return is None:      num_return = 100
@@ -83,9 +84,9 @@ def find_primers_parallel (fastafile = None, primer_opt_size = 20, border = 400,
     from multiprocessing import Pool
     from functools import partial
 
-    taxon_df = get_taxonomy (taxon) # may be None is taxon is None
+    taxonomy = get_taxonomy (taxon) # may be None is taxon is None
 
-    fas = read_fasta_as_list (fastafile)
+    fas = read_sampled_fasta (fastafile, taxon, sampler)
     if nthreads > len(fas): nthreads = len(fas)
     chunk_size = len(fas)//nthreads + 1 # no garantee that all threads will be used, specially if chumk_size is small like 2 or 3
     chunk_ids = [i for i in range(0, len(fas), chunk_size)] + [len(fas)] # from [i] to [i+1] excusive
@@ -94,7 +95,7 @@ def find_primers_parallel (fastafile = None, primer_opt_size = 20, border = 400,
 
     with Pool(nthreads) as p:
         results = p.map(partial(
-            pool_get_primers_parallel, border=border, num_return=num_return, fasta=fas, ids=chunk_ids, taxon_df = taxon_df), 
+            pool_get_primers_parallel, border=border, num_return=num_return, fasta=fas, ids=chunk_ids, taxonomy = taxonomy), 
             [i for i in range(nthreads)])
     
     ldic = {}
@@ -111,11 +112,11 @@ def find_primers_parallel (fastafile = None, primer_opt_size = 20, border = 400,
                     else:                rdic[x[0]].append(x[1:])
     save_primers_to_file (ldic, rdic, output)
 
-def pool_get_primers_parallel (thread_number, border = 400, num_return=100, fasta=None, ids=None, taxon_df = None):
+def pool_get_primers_parallel (thread_number, border = 400, num_return=100, fasta=None, ids=None, taxonomy = None):
     res = []
     for i in range(ids[thread_number], ids[thread_number+1]):
         rec = fasta[i]
-        left, right = get_primers (sequence = rec.seq, seqname = rec.id, border = border, num_return = num_return, taxon_df = taxon_df)
+        left, right = get_primers (sequence = rec.seq, seqname = rec.id, border = border, num_return = num_return, taxonomy = taxonomy)
         res.append([left, right])
     return res
 
@@ -135,29 +136,26 @@ def save_primers_to_file (ldic, rdic, output): # below, each v = dict[k] = [[pen
     llist.sort(key=lambda x: (x[1],x[2],x[3]), reverse=True)
     rlist.sort(key=lambda x: (x[1],x[2],x[3]), reverse=True)
 
-    with open_anyformat (f"{output}_l.tsv.xz", "w") as f:
-        f.write (str("primer\tgenus_diversity\ttaxon_diversity\tfrequency\tpenalty\tmin_distance\tmax_distance\n").encode())
+    with BackgroundWriter (f"{output}_l.tsv.xz") as f: # encoded and compressed in background thread
+        f.write ("primer\tgenus_diversity\ttaxon_diversity\tfrequency\tpenalty\tmin_distance\tmax_distance\n")
         for x in llist:
-            row = "\t".join([str(i) for i in x]) + "\n"
-            f.write (str(row).encode()) # encode() is needed in case output is compressed
-    with open_anyformat (f"{output}_r.tsv.xz", "w") as f:
-        f.write (str("primer\tgenus_diversity\ttaxon_diversity\tfrequency\tpenalty\tmin_distance\tmax_distance\n").encode())
+            f.write ("\t".join([str(i) for i in x]) + "\n")
+    with BackgroundWriter (f"{output}_r.tsv.xz") as f: # encoded and compressed in background thread
+        f.write ("primer\tgenus_diversity\ttaxon_diversity\tfrequency\tpenalty\tmin_distance\tmax_distance\n")
         for x in rlist:
-            row = "\t".join([str(i) for i in x]) + "\n"
-            f.write (str(row).encode()) # encode() is needed in case output is compressed
+            f.write ("\t".join([str(i) for i in x]) + "\n")
     logger.info (f"Saved primers to {output}_l.tsv.xz and {output}_r.tsv.xz")
 
-def extract_primer_from_output (output, seqname, seqlen, taxon_df = None):
+def extract_primer_from_output (output, seqname, seqlen, taxonomy = None):
     '''
     Extracts the primers from the output of primer3_core. Returns lists of left and right primers, with
     [sequence,penalty, position] per primer.
     '''
     taxonname = "unknown"
-    if taxon_df is not None and seqname in taxon_df["seqid"].values:
-        taxonname = str(taxon_df.loc[taxon_df['seqid'] == seqname, 'taxonid'].iloc[0])
     genusname = "unknown"
-    if taxon_df is not None and seqname in taxon_df["seqid"].values:
-        genusname = str(taxon_df.loc[taxon_df['seqid'] == seqname, 'genus'].iloc[0])
+    if taxonomy is not None: # O(1) lookup by seqid
+        taxonname = str(taxonomy.label ("gff_taxonid", seqname))
+        genusname = str(taxonomy.label ("genus", seqname))
 
     def xtract_left_or_right (out, side, seqlen):
         y=[re.match(f"PRIMER_{side}_(\d+)_SEQUENCE=(.*)",x) for x in out] # most will be "None" since won't match
@@ -189,19 +187,22 @@ def extract_primer_from_output (output, seqname, seqlen, taxon_df = None):
     right = xtract_left_or_right (output, "RIGHT", seqlen)
     return left, right
 
+def read_sampled_fasta (fastafile, taxon, sampler):
+    ''' sequences from fastafile, only from genomes chosen by the stratified sampler (if any) '''
+    if sampler is None: return read_fasta_as_list (fastafile)
+    if taxon is None:
+        logger.warning (f"Genome sampling needs the merged table with taxonomic information, using all sequences")
+        return read_fasta_as_list (fastafile)
+    seqids = sampler.sample (taxon)
+    select = lambda description: description.split(None, 1)[0] in seqids if description else False
+    fas = list(fasta_iterator (fastafile, select = select, as_seqrecord = True))
+    logger.info (f"Using {len(fas)} sequences from the sampled genomes in {fastafile}")
+    return fas
+
 def get_taxonomy (taxon):
     if taxon is None:
         logger.info(f"No taxonomic information provided, will not calculate taxonomic representativity")
         return None
-    if not os.path.isfile(taxon):
-        logger.error(f"Taxonomic information file {taxon} not found")
-        return None
-    taxon_df = pd.read_csv (taxon, compression="infer", sep="\t", dtype='unicode')
     # use taxonid from gff file and NOT from GTDB taxonomy (since we may have fewer); however gtdb_taxonomy has e.g.
     # d__Bacteria;p__Firmicutes;c__Bacilli;o__Bacillales;f__Bacillaceae_H;g__Priestia;s__Priestia megaterium
-    taxon_df = taxon_df[["seqid","gff_taxonid", "gtdb_taxonomy"]]
-    taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, drop_gtdb_column = True) # True = drop original column
-    taxon_df = taxon_df.rename(columns={"gff_taxonid":"taxonid"})
-    taxon_df.fillna("unknown", inplace=True)
-    logger.info(f"Read {len(taxon_df)} entries with taxonomic information from file {taxon}")
-    return taxon_df
+    return read_taxonomy_index (taxon, columns = ["gff_taxonid"]) # None if file not found
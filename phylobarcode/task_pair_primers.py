@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from phylobarcode.pb_common import *  ## better to have it in json?
 import pandas as pd, numpy as np
+from phylobarcode.pb_taxonomy import TaxonomyIndex, ranks
 import itertools, io, multiprocessing
-from Bio.Blast import NCBIXML
 from Bio import Seq, SeqIO
 from Bio.SeqRecord import SeqRecord
 
@@ -25,9 +25,7 @@ def pair_primers_from_raw_tsv (tsv=None, output=None, taxon=None, nthreads=1):
         return
     
     if taxon is not None:
-        taxon_df = pd.read_csv (taxon, compression="infer", sep="\t", dtype='unicode')
-        taxon_df = taxon_df[["seqid","gff_taxonid", "gtdb_taxonomy"]]
-        taxon_df = split_gtdb_taxonomy_from_dataframe (taxon_df, drop_gtdb_column = True) # True = drop original column
+        taxon_df = TaxonomyIndex.from_file (taxon, columns = ["gff_taxonid"]).dataframe (["gff_taxonid"] + ranks)
         # use taxonid from gff file and NOT from GTDB taxonomy (since we may have fewer); use "genus" etc from GTDB
         taxon_df = taxon_df.rename(columns={"seqid":"sseqid", "gff_taxonid":"taxonid"})
         logger.info(f"Read {len(taxon_df)} entries with taxonomic information from file {taxon}")
@@ -56,6 +56,9 @@ setuptools.setup(
            'treeswift',
            'scikit-learn'
        ],
+    extras_require = { # faster (de)compression: zstd files and isa-l for gzip
+        'fast': ['zstandard', 'isal']
+        },
     classifiers = [
         "Development Status :: 2 - Pre-Alpha",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
@@ -0,0 +1,19 @@
+from phylobarcode import pb_faidx
+
+def write_and_index (tmp_path, text):
+    fname = str(tmp_path / "genome.fasta")
+    with open (fname, "w") as f: f.write (text)
+    return fname, pb_faidx.build_fasta_index (fname)
+
+def test_index_last_line_without_newline (tmp_path):
+    for text in [">s1\nACGT\nAC", ">s1\nACGT\nACGT", ">s0\nTTTT\nGG\n>s1\nACGT\nA"]:
+        fname, n_entries = write_and_index (tmp_path, text)
+        assert n_entries == text.count(">")
+        fasta = pb_faidx.IndexedFasta (fname)
+        last = text.split(">")[-1].split("\n", 1)[1].replace("\n", "")
+        assert fasta.fetch ("s1") == last
+        assert fasta.fetch ("s1", 3, len(last)) == last[3:]
+
+def test_index_rejects_lines_of_different_lengths (tmp_path):
+    for text in [">s1\nACGT\nAC\nACGT\n", ">s1\nAC\nACGT\n", ">s1\nACGT\nACGTA"]:
+        assert write_and_index (tmp_path, text)[1] is None
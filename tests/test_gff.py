@@ -0,0 +1,50 @@
+import gzip
+from phylobarcode import pb_gff
+
+# NCBI-like GFF3 with a frameshifted CDS (two lines with the same ID), a repeated CDS with another product, CDS lines
+# without ID, URL escapes (%2C and %3B), and sequences after a ##FASTA directive
+gff3_text = """\
+##gff-version 3
+##sequence-region NC_000913.3 1 4641652
+##sequence-region pX 1 5000
+NC_000913.3	RefSeq	region	1	4641652	.	+	.	ID=NC_000913.3:1..4641652;Dbxref=taxon:511145;Is_circular=true;Name=ANONYMOUS;gbkey=Src;genome=chromosome;mol_type=genomic DNA;strain=K-12;substrain=MG1655
+pX	RefSeq	region	1	5000	.	+	.	ID=pX:1..5000;Dbxref=taxon:511145;note=plasmid%2C with comma%3B and semicolon;genome=plasmid
+NC_000913.3	RefSeq	gene	3033193	3034294	.	-	.	ID=gene-b2891;Name=prfB;gbkey=Gene;gene=prfB
+NC_000913.3	RefSeq	CDS	3034221	3034292	.	-	0	ID=cds-NP_417367.1;Parent=gene-b2891;Name=NP_417367.1;exception=ribosomal slippage;gene=prfB;product=peptide chain release factor RF2
+NC_000913.3	RefSeq	CDS	3033193	3034219	.	-	0	ID=cds-NP_417367.1;Parent=gene-b2891;Name=NP_417367.1;exception=ribosomal slippage;gene=prfB;product=peptide chain release factor RF2
+NC_000913.3	RefSeq	CDS	3440000	3440300	.	-	0	ID=cds-rplB;gene=rplB;product=50S ribosomal subunit protein L2
+NC_000913.3	RefSeq	CDS	3440000	3440300	.	-	0	ID=cds-rplB;gene=rplB;product=50S ribosomal protein L2
+NC_000913.3	RefSeq	CDS	3450000	3450300	.	+	0	gene=rpsC;product=30S ribosomal protein S3%2C putative
+NC_000913.3	RefSeq	CDS	3460000	3460300	.	+	0	gene=rpsJ;product=30S ribosomal protein S10
+pX	RefSeq	CDS	100	400	.	+	0	ID=cds-px1;product=hypothetical protein%2C plasmid;Note=no gene
+##FASTA
+>pX
+ACGTACGTACGT
+"""
+
+keys = ("ID", "gene", "product")
+
+def write_gff3 (tmp_path, compressed = False):
+    fname = str(tmp_path / ("genome.gff3.gz" if compressed else "genome.gff3"))
+    with (gzip.open (fname, "wt") if compressed else open (fname, "w")) as f: f.write (gff3_text)
+    return fname
+
+def comparable_features (features):
+    ''' sorted by location, with attribute values as sets since gffutils does not keep their order '''
+    return sorted ([(*ft[:4], {k: set(v) for k, v in ft[4].items() if k in keys}) for ft in features], key = lambda x: x[:4])
+
+def test_cds_features_match_gffutils (tmp_path):
+    for compressed in [False, True]:
+        fname = write_gff3 (tmp_path, compressed)
+        expected = pb_gff.gff_cds_features_gffutils (fname, str(tmp_path / "cds.db"))
+        features = pb_gff.gff_cds_features (fname, keys)
+        assert len(features) == 6
+        assert comparable_features (features) == comparable_features (expected)
+
+def test_region_elements_match_gffutils (tmp_path):
+    for compressed in [False, True]:
+        fname = write_gff3 (tmp_path, compressed)
+        expected = pb_gff.gff_region_elements_gffutils (fname, str(tmp_path / "region.db"))
+        assert pb_gff.gff_region_elements (fname) == expected
+        assert pb_gff.gff_regions_and_cds_features (fname, keys)[0] == expected
+        assert expected[1][2]["note"] == ["plasmid, with comma; and semicolon"]
@@ -0,0 +1,16 @@
+from phylobarcode import pb_seqkernel, pb_kmer
+
+def brute_kmer_sets (sequences, k):
+    ''' reference: k-mers of each sequence, one python slice at a time '''
+    return [set(s[i:i+k] for i in range(len(s) - k + 1)) for s in sequences]
+
+def test_kmer_sets_short_sequence_first ():
+    sequences = ["ACG", "ACGTTGCA", "TTGCAAA"]
+    assert [x.size for x in pb_kmer.single_kmer_list (sequences, 5)] == [0, 4, 3]
+    assert [len(x) for x in pb_seqkernel.kmer_sets (sequences, 5)] == [len(x) for x in brute_kmer_sets (sequences, 5)]
+
+def test_kmer_sets_short_sequences_anywhere ():
+    sequences = ["ACGTTGCA", "", "ACG", "TTGCAAANNACGT", "ACGTT", "AC"]
+    for k in [1, 3, 5, 8]:
+        sizes = [len(x) for x in pb_seqkernel.kmer_sets (sequences, k)]
+        assert sizes == [len(x) for x in brute_kmer_sets (sequences, k)]
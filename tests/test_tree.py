@@ -0,0 +1,41 @@
+import random
+import numpy as np
+from phylobarcode import pb_tree
+
+def random_newick (n_leaves, zero_fraction = 0.5):
+    ''' random binary tree where a fraction of the branches have length zero '''
+    length = lambda: 0. if random.random() < zero_fraction else random.random()
+    nodes = [f"t{i}:{length()}" for i in range(n_leaves)]
+    while len(nodes) > 1:
+        a = nodes.pop(random.randrange(len(nodes)))
+        b = nodes.pop(random.randrange(len(nodes)))
+        nodes.append (f"({a},{b}):{length()}")
+    return nodes[0] + ";"
+
+def test_silhouette_samples_zero_length_branches ():
+    from sklearn.metrics import silhouette_samples
+    random.seed (42)
+    for n_leaves, n_classes in [(20, 3), (60, 8), (200, 20)]:
+        tree = pb_tree.ArrayTree.from_newick (random_newick (n_leaves))
+        labels = [random.randrange(n_classes) for _ in tree.leaves]
+        expected = silhouette_samples (tree.distance_matrix (dtype=np.float64), labels, metric="precomputed")
+        assert np.allclose (tree.silhouette_samples (labels), expected, atol=1e-9)
+
+def test_silhouette_samples_identical_leaves ():
+    from sklearn.metrics import silhouette_samples
+    # a,b,c,d are at distance zero, thus their a(i) = b(i) = 0 and their score must be exactly zero
+    tree = pb_tree.ArrayTree.from_newick ("((((a:0,b:0):0,(c:0,d:0):0):1.7154311,g:8.5590516):3.0974032,(e:4.2835880,f:5.4996626):8.8634796);")
+    for classes in ["0101222", "0011222", "0101012"]:
+        labels = [dict(zip("abcdgef", classes))[x] for x in tree.leaf_labels]
+        expected = silhouette_samples (tree.distance_matrix (dtype=np.float64), labels, metric="precomputed")
+        assert np.allclose (tree.silhouette_samples (labels), expected, atol=1e-9)
+
+def test_lca_index_built_on_demand ():
+    random.seed (7)
+    tree = pb_tree.ArrayTree.from_newick (random_newick (50))
+    labels = [random.randrange(4) for _ in tree.leaves]
+    tree.silhouette_samples (labels)
+    assert tree.sparse is None # matrix-free path does not need the LCA index
+    dist = tree.distance_matrix (dtype=np.float64)
+    assert tree.sparse is not None
+    assert np.allclose (dist, dist.T) and np.allclose (np.diag(dist), 0)